@@ -3,28 +3,40 @@ ReidProxy - Enhanced Version with Headless Chrome Support
 A web proxy with JavaScript rendering capabilities using Selenium
 """
 
-import socket
 import threading
-import select
 import os
-import re
+import sys
 from flask import Flask, request, Response, render_template_string, abort
 import requests
-from bs4 import BeautifulSoup
 from urllib.parse import urljoin, quote_plus, unquote_plus, urlparse, parse_qs
 import logging
 from functools import wraps
 import time
-from collections import defaultdict, deque
 
 # Selenium imports for headless Chrome
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, WebDriverException
 
+# Shared proxy modules (upstream pools, caches, ...) live next to app.py
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+import asset_cache
+import chrome_render
+import compression
+import conditional
+import dns_cache
+import http_range
+import metrics
+import page_cache
+import policy
+import rate_limit
+import render_queue
+import shared_state
+import tcp_proxy
+import upstream
+from chrome_pool import DriverPool
+from html_rewrite import normalize_url, rewrite_proxy_links
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -42,7 +54,42 @@ class Config:
     # Chrome/Selenium settings
     USE_HEADLESS_CHROME = True  # Enable/disable Chrome rendering
     CHROME_WAIT_TIME = 10  # Seconds to wait for page load
-    CHROME_POOL_SIZE = 3  # Number of Chrome instances to keep ready
+    CHROME_POOL_SIZE = 1  # Chrome processes kept ready (the pool never shrinks below this)
+    CHROME_POOL_MAX = 3  # ...and the most it grows to while renders queue for a tab
+    CHROME_TABS_PER_BROWSER = 4  # concurrent renders per Chrome process
+    CHROME_POOL_IDLE_TIMEOUT = 120  # seconds before an unused extra process is shut down
+    
+    # Admission control: renders beyond CHROME_POOL_MAX * CHROME_TABS_PER_BROWSER queue
+    # (interactive before background refreshes); a full queue or a wait longer than
+    # CHROME_QUEUE_WAIT seconds is answered per CHROME_QUEUE_OVERFLOW:
+    # "degrade" (fetch with requests instead) or "reject" (503 + Retry-After)
+    CHROME_QUEUE_DEPTH = 24
+    CHROME_QUEUE_WAIT = 5
+    CHROME_QUEUE_OVERFLOW = "degrade"
+    CHROME_MAX_PAGES = 100  # recycle a driver after this many renders...
+    CHROME_MAX_AGE = 30 * 60  # ...or this many seconds...
+    CHROME_MAX_RSS_MB = 1024  # ...or once Chrome's process tree exceeds this RSS
+    CHROME_HEALTH_INTERVAL = 15  # seconds between background checks of idle drivers
+    
+    # When a render counts as finished (see chrome_render.py); CHROME_WAIT_TIME
+    # is the hard deadline, navigation included
+    CHROME_READY_STRATEGY = "network_idle"  # "network_idle", "dom_quiet" or "load"
+    CHROME_NETWORK_IDLE_MS = 500
+    CHROME_DOM_QUIET_MS = 500
+    CHROME_READY_SELECTORS = {  # per domain (subdomains included): wait for this instead
+        'twitter.com': 'article',
+        'x.com': 'article',
+        'reddit.com': 'shreddit-post, [data-testid="post-container"]',
+        'youtube.com': 'ytd-rich-item-renderer, ytd-video-renderer, #movie_player',
+    }
+    
+    # Resources Chrome may skip during renders: only page_source is kept and clients
+    # refetch assets through the proxy.  Types: "image", "font", "media", "analytics"
+    CHROME_BLOCK_RESOURCES = ("image", "font", "media", "analytics")
+    CHROME_BLOCK_PATTERNS = ()  # extra Network.setBlockedURLs patterns, e.g. "*/ads/*"
+    CHROME_BLOCK_RULES = {  # per domain (subdomains included): types to block there
+        # 'example.com': ("media", "analytics"),  # keep images/fonts for this site
+    }
     
     # Triggers for using Chrome (instead of requests)
     USE_CHROME_FOR_DOMAINS = {
@@ -58,26 +105,101 @@ class Config:
     ENABLE_AUTH = False
     API_KEY = "your-secret-key-here"
     RATE_LIMIT = 2000
+    # Rate limit budgets and counters shared by every gunicorn worker on the
+    # host: files in this directory, e.g. shared_state.DEFAULT_DIR (/dev/shm),
+    # named after FLASK_PORT.  None keeps them per process
+    SHARED_STATE_DIR = None
+    RATE_LIMIT_SLOTS = 1 << 20  # clients tracked at once (16 bytes each)
     
     # Domain filtering
+    # Entries cover subdomains too; IPs/CIDRs are accepted (see policy.py)
     BLOCKED_DOMAINS = set(['malicious.com', 'spam.com'])
     ALLOWED_DOMAINS = set()
+    BLOCKLIST_FILES = []  # extra block entries, one per line (hosts-file format works)
     
     # Timeouts
     REQUEST_TIMEOUT = 20
     SOCKET_TIMEOUT = 10
+    
+    # TCP proxy engine: "asyncio" (event loop) or "threaded" (thread per connection)
+    PROXY_ENGINE = "asyncio"
+    PROXY_BACKLOG = 1024
+    PROXY_IDLE_TIMEOUT = 300  # close tunnels with no traffic in either direction
+    PROXY_RELAY = "splice"    # CONNECT relay: "splice" (Linux), "recv_into" or "stream"
+    PROXY_UPSTREAM_IDLE_PER_HOST = 8  # kept-alive origin connections for plain HTTP
+    PROXY_UPSTREAM_IDLE_MAX = 256     # ... over all hosts
+    PROXY_BLOCK_PRIVATE = True  # refuse targets that resolve to internal addresses (403)
+    
+    # DNS cache shared by the TCP proxy and upstream pools (see dns_cache.py)
+    DNS_CACHE_TTL = 60
+    DNS_NEGATIVE_TTL = 10
+    
+    # Upstream keep-alive pools (shared by every Flask fetch)
+    UPSTREAM_POOL_HOSTS = 100
+    UPSTREAM_POOL_MAXSIZE = 32
+    UPSTREAM_IDLE_TIMEOUT = 60
+    # Flask fetches go straight upstream over those pools; the TCP proxy is
+    # for external browser clients. True restores the old loopback hop
+    # through PROXY_HOST:PROXY_PORT (see benchmarks/bench_fetch_modes.py).
+    FETCH_VIA_TCP_PROXY = False
+    
+    # Compression: forward upstream gzip/br bytes as-is for assets,
+    # re-compress rewritten HTML with the client's preferred encoding
+    COMPRESSION_PASSTHROUGH = True
+    HTML_RECOMPRESS = True
+    HTML_COMPRESS_LEVEL = 5
+    
+    # Rewritten-page cache (0 disables). Chrome renders carry no cache
+    # headers, so they are kept for CHROME_PAGE_TTL seconds (then served
+    # stale for PAGE_CACHE_STALE_SECONDS while re-rendering in the background).
+    # Concurrent requests for the same page share one render.
+    PAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    PAGE_CACHE_STALE_SECONDS = 60
+    CHROME_PAGE_TTL = 30
+    CHROME_PAGE_FRESHNESS = {  # per domain (subdomains included): (fresh s, stale-while-revalidate s)
+        'twitter.com': (15, 60),
+        'x.com': (15, 60),
+        'reddit.com': (60, 300),
+        'youtube.com': (300, 900),
+    }
+    
+    # Sub-resource cache (0 disables). The stylesheets, scripts and images
+    # Chrome downloads while rendering are harvested into it, so the client's
+    # follow-up /proxy?url= requests for them are answered locally.
+    ASSET_CACHE_MAX_BYTES = 128 * 1024 * 1024
+    ASSET_CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024
+    CHROME_HARVEST_ASSETS = True
+    CHROME_HARVEST_MAX_BYTES = 16 * 1024 * 1024   # per render
+
+
+upstream.configure(
+    pool_hosts=Config.UPSTREAM_POOL_HOSTS,
+    pool_maxsize=Config.UPSTREAM_POOL_MAXSIZE,
+    idle_timeout=Config.UPSTREAM_IDLE_TIMEOUT,
+    block_private=Config.PROXY_BLOCK_PRIVATE,  # direct fetches get the proxy's SSRF guard
+)
 
 
 # ---------------- CHROME DRIVER POOL ----------------
 
-class ChromeDriverPool:
-    """Manages a pool of Chrome WebDriver instances for better performance"""
-    
-    def __init__(self, pool_size=3):
-        self.pool_size = pool_size
-        self.drivers = []
-        self.lock = threading.Lock()
-        self._initialize_pool()
+class ChromeDriverPool(DriverPool):
+    """Pool of Chrome WebDriver instances, health-checked and recycled in the
+    background (see chrome_pool.py)"""
+    
+    def __init__(self, pool_size=1, max_size=3, tabs_per_browser=4):
+        super().__init__(
+            self._create_driver,
+            size=pool_size,
+            max_size=max_size,
+            tabs_per_driver=tabs_per_browser,
+            idle_timeout=Config.CHROME_POOL_IDLE_TIMEOUT,
+            max_pages=Config.CHROME_MAX_PAGES,
+            max_age=Config.CHROME_MAX_AGE,
+            max_rss_mb=Config.CHROME_MAX_RSS_MB,
+            check_interval=Config.CHROME_HEALTH_INTERVAL,
+        )
+        logger.info(f"Initializing Chrome pool: {pool_size}-{max_size} browsers x {tabs_per_browser} tabs...")
+        self.start()
     
     def _create_driver(self):
         """Create a new Chrome WebDriver instance"""
@@ -89,6 +211,15 @@ class ChromeDriverPool:
         chrome_options.add_argument('--window-size=1920,1080')
         chrome_options.add_argument('--disable-blink-features=AutomationControlled')
         chrome_options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36')
+        # Tabs render side by side: keep background tabs at full speed
+        chrome_options.add_argument('--disable-background-timer-throttling')
+        chrome_options.add_argument('--disable-backgrounding-occluded-windows')
+        chrome_options.add_argument('--disable-renderer-backgrounding')
+        # driver.get() returns at DOMContentLoaded; readiness is decided by chrome_render
+        chrome_options.page_load_strategy = 'eager'
+        # Network events only: used to count blocked requests and bytes per render
+        chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+        chrome_options.add_experimental_option('perfLoggingPrefs', {'enableNetwork': True, 'enablePage': False})
         
         try:
             driver = webdriver.Chrome(options=chrome_options)
@@ -98,96 +229,85 @@ class ChromeDriverPool:
         except Exception as e:
             logger.error(f"Failed to create Chrome driver: {e}")
             return None
-    
-    def _initialize_pool(self):
-        """Initialize the driver pool"""
-        logger.info(f"Initializing Chrome driver pool with {self.pool_size} instances...")
-        for i in range(self.pool_size):
-            driver = self._create_driver()
-            if driver:
-                self.drivers.append(driver)
-        logger.info(f"Chrome driver pool ready with {len(self.drivers)} instances")
-    
-    def get_driver(self):
-        """Get a driver from the pool and verify it is alive"""
-        with self.lock:
-            while self.drivers:
-                driver = self.drivers.pop()
-                try:
-                    # Quick check to see if driver is still responsive
-                    driver.current_url
-                    return driver
-                except WebDriverException:
-                    logger.warning("Found dead driver in pool, discarding.")
-                    try:
-                        driver.quit()
-                    except:
-                        pass
-            
-            # Pool is empty or all drivers were dead, create a new one
-            logger.warning("Driver pool empty (or dead), creating new instance")
-            return self._create_driver()
-    
-    def return_driver(self, driver):
-        """Return a driver to the pool"""
-        with self.lock:
-            if len(self.drivers) < self.pool_size:
-                self.drivers.append(driver)
-            else:
-                # Pool is full, quit this driver
-                try:
-                    driver.quit()
-                except:
-                    pass
-    
-    def shutdown(self):
-        """Shutdown all drivers in the pool"""
-        logger.info("Shutting down Chrome driver pool...")
-        with self.lock:
-            for driver in self.drivers:
-                try:
-                    driver.quit()
-                except:
-                    pass
-            self.drivers.clear()
 
 
 # Initialize Chrome driver pool if enabled
 chrome_pool = None
 if Config.USE_HEADLESS_CHROME:
-    chrome_pool = ChromeDriverPool(Config.CHROME_POOL_SIZE)
+    chrome_pool = ChromeDriverPool(Config.CHROME_POOL_SIZE, Config.CHROME_POOL_MAX, Config.CHROME_TABS_PER_BROWSER)
 
 
 # ---------------- CHROME RENDERING ----------------
 
-def fetch_with_chrome(url):
+READY_DEFAULT = chrome_render.ReadyRule(
+    Config.CHROME_READY_STRATEGY,
+    idle_ms=Config.CHROME_NETWORK_IDLE_MS,
+    quiet_ms=Config.CHROME_DOM_QUIET_MS,
+)
+READY_RULES = {
+    domain: chrome_render.ReadyRule(chrome_render.READY_SELECTOR, selector=selector)
+    for domain, selector in Config.CHROME_READY_SELECTORS.items()
+}
+RENDER_STATS = chrome_render.RenderStats()
+BLOCK_DEFAULT = chrome_render.block_patterns(Config.CHROME_BLOCK_RESOURCES, Config.CHROME_BLOCK_PATTERNS)
+BLOCK_RULES = {
+    domain: chrome_render.block_patterns(types, Config.CHROME_BLOCK_PATTERNS)
+    for domain, types in Config.CHROME_BLOCK_RULES.items()
+}
+
+
+def block_patterns_for(host):
+    patterns = policy.match_suffix(BLOCK_RULES, host)
+    return BLOCK_DEFAULT if patterns is None else patterns
+
+
+RENDER_QUEUE = render_queue.RenderQueue(
+    Config.CHROME_POOL_MAX * Config.CHROME_TABS_PER_BROWSER, Config.CHROME_QUEUE_DEPTH
+)
+DEGRADED_HEADER = "X-Render-Degraded"
+
+
+def fetch_with_chrome(url, priority=render_queue.PRIORITY_INTERACTIVE):
     """
     Fetch a URL using headless Chrome for JavaScript rendering
-    Returns: (html_content, status_code, content_type)
+    Returns: (html_content, status_code, content_type, final_url, headers)
+    Raises render_queue.Overloaded when no render slot frees up in time
     """
     if not chrome_pool:
         raise Exception("Chrome driver pool not initialized")
     
-    driver = chrome_pool.get_driver()
+    with RENDER_QUEUE.slot(priority, time.monotonic() + Config.CHROME_QUEUE_WAIT):
+        return _render_with_chrome(url)
+
+
+def _render_with_chrome(url):
+    """Render url in a pooled Chrome tab (the caller holds a render slot)"""
+    # a tab of a pooled browser (see chrome_pool.Tab); waits for one when all are busy
+    driver = chrome_pool.get_driver(timeout=Config.CHROME_WAIT_TIME)
     if not driver:
         raise Exception("Failed to get Chrome driver")
     
     try:
         logger.info(f"Fetching with Chrome: {url}")
+        start = time.monotonic()
+        deadline = start + Config.CHROME_WAIT_TIME
+        instrumented = chrome_render.instrument(driver)
+        host = urlparse(url).hostname or ""
+        patterns = block_patterns_for(host)
+        blocking = chrome_render.apply_blocking(driver, patterns) and bool(patterns)
+        chrome_render.drain_network_log(driver)  # drop events from before this render
         
         # Navigate to URL
-        driver.get(url)
-        
-        # Wait for page to load (wait for body element)
         try:
-            WebDriverWait(driver, Config.CHROME_WAIT_TIME).until(
-                EC.presence_of_element_located((By.TAG_NAME, "body"))
-            )
+            driver.get(url)
         except TimeoutException:
-            logger.warning(f"Timeout waiting for page load: {url}")
+            logger.warning(f"Timeout waiting for navigation: {url}")
         
-        # Optional: Wait for specific elements or AJAX to complete
-        time.sleep(1)  # Give dynamic content time to render
+        # Return as soon as the page is ready by its domain's rule (or the deadline passes)
+        rule = chrome_render.rule_for(host, READY_DEFAULT, READY_RULES)
+        readiness = chrome_render.wait_until_ready(driver, rule, deadline, instrumented)
+        if not readiness.ready:
+            logger.warning(f"Page not ready by deadline ({rule.strategy}): {url}")
         
         # Get the rendered HTML
         html_content = driver.page_source
@@ -195,14 +315,24 @@ def fetch_with_chrome(url):
         # Get final URL (in case of redirects)
         final_url = driver.current_url
         
+        events = chrome_render.drain_network_log(driver)
+        network = chrome_render.summarize_network(events)
+        if ASSET_CACHE and Config.CHROME_HARVEST_ASSETS:
+            network["harvested"] = harvest_assets(driver, events)
+        
         chrome_pool.return_driver(driver)
+        RENDER_STATS.record(url, readiness, time.monotonic() - start, network, blocking)
+        logger.info(f"Rendered {url}: {readiness.strategy} "
+                    f"{'ready' if readiness.ready else 'deadline'} after {readiness.seconds * 1000:.0f} ms, "
+                    f"{network['blocked']} requests blocked, {network['bytes']} bytes, "
+                    f"{network.get('harvested', 0)} assets harvested")
         
-        return html_content, 200, "text/html", final_url
+        return html_content, 200, "text/html", final_url, {}
         
     except WebDriverException as e:
         logger.error(f"Chrome WebDriver error: {e}")
         try:
-            chrome_pool.return_driver(driver)
+            chrome_pool.return_driver(driver, failed=True)
         except:
             pass
         raise Exception(f"Chrome rendering failed: {str(e)}")
@@ -210,29 +340,43 @@ def fetch_with_chrome(url):
     except Exception as e:
         logger.error(f"Chrome fetch error: {e}")
         try:
-            chrome_pool.return_driver(driver)
+            chrome_pool.return_driver(driver, failed=True)
         except:
             pass
         raise
 
 
-def fetch_with_requests(url):
+def harvest_assets(driver, events):
+    """Seed ASSET_CACHE with the cacheable sub-resources the tab just downloaded"""
+    def wanted(url, headers):
+        entry = ASSET_CACHE.peek(asset_cache.make_key(url))
+        return (entry is None or not entry.is_fresh()) and asset_cache.freshness_lifetime(headers) is not None
+    
+    harvested = chrome_render.harvest_responses(driver, events, max_bytes=Config.CHROME_HARVEST_MAX_BYTES,
+                                                wanted=wanted)
+    return sum(ASSET_CACHE.seed(asset_cache.make_key(item.url), item.status, item.headers, item.body)
+               for item in harvested)
+
+
+def fetch_with_requests(url, headers=None):
     """
     Fetch a URL using requests library (no JavaScript)
-    Returns: (content, status_code, content_type, final_url)
+    Returns: (content, status_code, content_type, final_url, headers)
     """
-    PROXY_BACKEND = {
-        "http": f"http://{Config.PROXY_HOST}:{Config.PROXY_PORT}",
-        "https": f"http://{Config.PROXY_HOST}:{Config.PROXY_PORT}"
-    }
-    
-    resp = requests.get(
+    proxies = None
+    if Config.FETCH_VIA_TCP_PROXY:
+        proxies = {
+            "http": f"http://{Config.PROXY_HOST}:{Config.PROXY_PORT}",
+            "https": f"http://{Config.PROXY_HOST}:{Config.PROXY_PORT}"
+        }
+    
+    resp = upstream.get_client().get(
         url,
         stream=True,
         timeout=Config.REQUEST_TIMEOUT,
-        proxies=PROXY_BACKEND,
+        proxies=proxies,
         allow_redirects=True,
-        headers={'User-Agent': 'Mozilla/5.0 (compatible; ReidProxy/2.0)'}
+        headers={'User-Agent': 'Mozilla/5.0 (compatible; ReidProxy/2.0)', **(headers or {})}
     )
     resp.raise_for_status()
     
@@ -243,7 +387,41 @@ def fetch_with_requests(url):
     else:
         content = resp.content
     
-    return content, resp.status_code, content_type, resp.url
+    return content, resp.status_code, content_type, resp.url, resp.headers
+
+
+# ---------------- HOST POLICY ----------------
+
+_policy = None
+_policy_key = None
+
+
+def get_policy():
+    """Config's domain lists compiled into one HostPolicy.
+
+    Recompiled when a list is reassigned or changes size; call
+    reload_policy() after editing a list in place or a blocklist file.
+    """
+    global _policy, _policy_key
+    lists = (Config.BLOCKED_DOMAINS, Config.ALLOWED_DOMAINS, Config.USE_CHROME_FOR_DOMAINS,
+             Config.BLOCKLIST_FILES)
+    key = tuple(len(entries) for entries in lists)
+    if (_policy is None or key != _policy_key[0]
+            or any(a is not b for a, b in zip(lists, _policy_key[1]))):
+        reload_policy()
+        _policy_key = (key, lists)  # holds the lists, so identity checks stay valid
+    return _policy
+
+
+def reload_policy():
+    global _policy
+    block = list(Config.BLOCKED_DOMAINS)
+    for path in Config.BLOCKLIST_FILES:
+        block += policy.load_list(path)
+    _policy = policy.HostPolicy(block=block, allow=Config.ALLOWED_DOMAINS,
+                                chrome=Config.USE_CHROME_FOR_DOMAINS)
+    logger.info(f"Host policy compiled: {_policy.snapshot()['lists']}")
+    return _policy
 
 
 def should_use_chrome(url):
@@ -251,46 +429,36 @@ def should_use_chrome(url):
     if not Config.USE_HEADLESS_CHROME:
         return False
     
-    parsed = urlparse(url)
-    domain = parsed.netloc.lower()
-    
-    # Remove 'www.' prefix
-    if domain.startswith('www.'):
-        domain = domain[4:]
-    
-    # Check if domain is in the Chrome list
-    for chrome_domain in Config.USE_CHROME_FOR_DOMAINS:
-        if chrome_domain in domain:
-            return True
-    
-    return False
+    # reddit.com covers www.reddit.com and old.reddit.com, not notreddit.com
+    return "chrome" in get_policy().matches(urlparse(url).hostname or "")
 
 
 # ---------------- RATE LIMITING ----------------
 
-class RateLimiter:
-    def __init__(self, max_requests=60, window=60):
-        self.max_requests = max_requests
-        self.window = window
-        self.requests = defaultdict(deque)
-        self.lock = threading.Lock()
-    
-    def is_allowed(self, identifier):
-        now = time.time()
-        
-        with self.lock:
-            # Remove expired requests from the left
-            while self.requests[identifier] and now - self.requests[identifier][0] >= self.window:
-                self.requests[identifier].popleft()
+# GCRA, one timestamp per client; idle clients are swept in the background
+RateLimiter = rate_limit.RateLimiter
+
 
-            if len(self.requests[identifier]) >= self.max_requests:
-                return False
+def make_rate_limiter():
+    """One budget per client across all workers when shared state is available."""
+    if Config.SHARED_STATE_DIR:
+        path = os.path.join(Config.SHARED_STATE_DIR, f"reidproxy-{Config.FLASK_PORT}-ratelimit")
+        try:
+            return shared_state.SharedRateLimiter(path, Config.RATE_LIMIT, 60, Config.RATE_LIMIT_SLOTS)
+        except OSError as e:
+            logger.error(f"Shared rate limiting disabled ({Config.SHARED_STATE_DIR}): {e}")
+    return RateLimiter(Config.RATE_LIMIT).start()
 
-            self.requests[identifier].append(now)
-            return True
 
+rate_limiter = make_rate_limiter()
 
-rate_limiter = RateLimiter(Config.RATE_LIMIT)
+# /health totals for every worker, not just the one answering
+if Config.SHARED_STATE_DIR:
+    try:
+        shared_state.share_stats(Config.SHARED_STATE_DIR, f"reidproxy-{Config.FLASK_PORT}",
+                                 compression, http_range, conditional)
+    except OSError as e:
+        logger.error(f"Shared counters disabled ({Config.SHARED_STATE_DIR}): {e}")
 
 
 # ---------------- SECURITY HELPERS ----------------
@@ -310,15 +478,15 @@ def require_auth(f):
 
 def is_domain_allowed(url):
     try:
-        domain = urlparse(url).netloc.lower()
-        if ':' in domain:
-            domain = domain.split(':')[0]
+        domain = (urlparse(url).hostname or "").lower()
+        host_policy = get_policy()
+        matched = host_policy.matches(domain)
         
-        if domain in Config.BLOCKED_DOMAINS:
+        if "block" in matched:
             logger.warning(f"Blocked domain: {domain}")
             return False
         
-        if Config.ALLOWED_DOMAINS and domain not in Config.ALLOWED_DOMAINS:
+        if host_policy.has("allow") and "allow" not in matched:
             logger.warning(f"Domain not in whitelist: {domain}")
             return False
         
@@ -330,218 +498,176 @@ def is_domain_allowed(url):
 
 # ---------------- TCP PROXY ----------------
 
-def handle_client(client_socket):
-    try:
-        request_data = client_socket.recv(1024)
-        if not request_data:
-            client_socket.close()
-            return
-
-        first_line = request_data.split(b'\n')[0]
-        method = first_line.split(b' ')[0]
-
-        if method == b'CONNECT':
-            handle_https_request(client_socket, request_data)
-        else:
-            handle_http_request(client_socket, request_data)
-    except Exception as e:
-        logger.error(f"Client handling error: {e}")
-    finally:
-        try:
-            client_socket.close()
-        except:
-            pass
+# Engine for the port-6767 forward proxy (see tcp_proxy.py)
+tcp_server = None
+dns_cache.configure(ttl=Config.DNS_CACHE_TTL, negative_ttl=Config.DNS_NEGATIVE_TTL)
 
 
-def handle_http_request(client_socket, request_data):
-    try:
-        first_line = request_data.decode('ascii', errors='ignore').split('\n')[0]
-        parts = first_line.split(' ')
-        
-        if len(parts) < 3:
-            raise ValueError("Invalid HTTP request")
-        
-        method, url, _ = parts
-        http_pos = url.find("://")
-        temp = url if http_pos == -1 else url[http_pos + 3:]
-
-        port_pos = temp.find(":")
-        webserver_pos = temp.find("/")
-        if webserver_pos == -1:
-            webserver_pos = len(temp)
-
-        if port_pos == -1 or webserver_pos < port_pos:
-            port = 80
-            webserver = temp[:webserver_pos]
-        else:
-            webserver = temp[:port_pos]
-            port = int(temp[port_pos + 1:webserver_pos])
+def start_proxy_server(host, port):
+    global tcp_server
+    if Config.PROXY_ENGINE == "threaded":
+        tcp_proxy.serve_threaded(host, port, Config.PROXY_BACKLOG, Config.SOCKET_TIMEOUT,
+                                 block_private=Config.PROXY_BLOCK_PRIVATE)
+        return
+    tcp_server = tcp_proxy.AsyncTcpProxy(
+        host, port,
+        backlog=Config.PROXY_BACKLOG,
+        idle_timeout=Config.PROXY_IDLE_TIMEOUT,
+        connect_timeout=Config.SOCKET_TIMEOUT,
+        relay_mode=Config.PROXY_RELAY,
+        upstream_idle_per_host=Config.PROXY_UPSTREAM_IDLE_PER_HOST,
+        upstream_idle_max=Config.PROXY_UPSTREAM_IDLE_MAX,
+        block_private=Config.PROXY_BLOCK_PRIVATE,
+    )
+    tcp_server.run()
 
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(Config.SOCKET_TIMEOUT)
-        s.connect((webserver, port))
-        s.sendall(request_data)
 
-        while True:
-            data = s.recv(4096)
-            if not data:
-                break
-            client_socket.sendall(data)
+# ---------------- FLASK WEB PROXY ----------------
 
-        s.close()
-    except Exception as e:
-        logger.error(f"HTTP proxy error: {e}")
-    finally:
-        try:
-            client_socket.close()
-        except:
-            pass
+app = Flask(__name__)
 
 
-def handle_https_request(client_socket, request_data):
-    s = None
+def rewrite_html(base_url, html_text):
+    """Rewrite HTML links to route through proxy"""
     try:
-        first_line = request_data.split(b'\n')[0]
-        parts = first_line.split(b' ')
-        
-        if len(parts) < 2:
-            raise ValueError("Invalid CONNECT request")
-        
-        host_port = parts[1]
-        if b':' not in host_port:
-            raise ValueError("Invalid host:port format")
-        
-        host, port = host_port.split(b':')
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(Config.SOCKET_TIMEOUT)
-        s.connect((host.decode(), int(port)))
-        
-        client_socket.sendall(b"HTTP/1.1 200 Connection Established\r\n\r\n")
-        sockets = [client_socket, s]
-        
-        while True:
-            try:
-                readable, _, exceptional = select.select(sockets, [], sockets, Config.SOCKET_TIMEOUT)
-                
-                if exceptional:
-                    break
-                
-                if not readable:
-                    continue
-                
-                for sock in readable:
-                    data = sock.recv(4096)
-                    if not data:
-                        return
-                    
-                    other_sock = s if sock is client_socket else client_socket
-                    other_sock.sendall(data)
-                    
-            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
-                logger.debug("Connection closed by peer")
-                break
-                
+        return rewrite_proxy_links(base_url, html_text)
     except Exception as e:
-        logger.error(f"HTTPS proxy error: {e}")
-    finally:
-        try:
-            client_socket.close()
-        except:
-            pass
-        if s:
-            try:
-                s.close()
-            except:
-                pass
-
+        logger.error(f"HTML rewrite error: {e}")
+        return html_text
 
-def start_proxy_server(host, port):
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((host, port))
-    server.listen(5)
-    logger.info(f"TCP Proxy listening on {host}:{port}")
 
-    while True:
-        try:
-            client_socket, addr = server.accept()
-            logger.debug(f"Connection from {addr}")
-            
-            threading.Thread(
-                target=handle_client,
-                args=(client_socket,),
-                daemon=True
-            ).start()
-        except Exception as e:
-            logger.error(f"Server accept error: {e}")
+# ---------------- PAGE CACHE ----------------
 
+PAGE_CACHE = (
+    page_cache.PageCache(Config.PAGE_CACHE_MAX_BYTES, Config.PAGE_CACHE_STALE_SECONDS)
+    if Config.PAGE_CACHE_MAX_BYTES > 0 else None
+)
 
-# ---------------- FLASK WEB PROXY ----------------
+# Sub-resources keyed by absolute URL (the url= of their rewritten /proxy link)
+ASSET_CACHE = (
+    asset_cache.AssetCache(Config.ASSET_CACHE_MAX_BYTES, Config.ASSET_CACHE_MAX_ENTRY_BYTES)
+    if Config.ASSET_CACHE_MAX_BYTES > 0 else None
+)
 
-app = Flask(__name__)
+# Upstream headers kept with a cached page (freshness and validators)
+PAGE_HEADERS = ('cache-control', 'expires', 'date', 'age', 'etag', 'last-modified')
 
 
-def normalize_url(url):
+def render_page(url, use_chrome, validators=None, priority=render_queue.PRIORITY_INTERACTIVE):
     """
-    Normalize URLs to fix common issues:
-    - Replace backslashes with forward slashes
-    - Handle spaces properly
-    - Remove duplicate slashes
+    Fetch a page (Chrome or requests) and rewrite it if it is HTML
+    Returns: (body_bytes, status_code, content_type, upstream_headers)
     """
-    if not url:
-        return url
+    if use_chrome:
+        logger.info(f"Using Chrome for: {url}")
+        try:
+            html, status_code, content_type, final_url, headers = fetch_with_chrome(url, priority)
+        except render_queue.Overloaded as e:
+            # only users get the degraded page; background refreshes just wait for next time
+            if Config.CHROME_QUEUE_OVERFLOW != "degrade" or priority != render_queue.PRIORITY_INTERACTIVE:
+                raise
+            logger.warning(f"Chrome {e}; falling back to requests for: {url}")
+            RENDER_QUEUE.count("degraded")
+            html, status_code, content_type, final_url, headers = fetch_with_requests(url, validators)
+            headers = dict(headers)
+            headers[DEGRADED_HEADER] = "1"
+    else:
+        logger.info(f"Using requests for: {url}")
+        html, status_code, content_type, final_url, headers = fetch_with_requests(url, validators)
     
-    url = url.strip()
-
-    # Replace backslashes with forward slashes
-    url = url.replace('\\', '/')
+    if status_code == 304 or "text/html" not in content_type:
+        return (html if isinstance(html, bytes) else html.encode()), status_code, content_type, headers
     
-    # Handle spaces
-    url = url.replace(' ', '%20')
-
-    # Remove duplicate slashes (except after protocol or at the beginning)
-    url = re.sub(r'(?<!:)(?<!^)//+', '/', url)
+    parsed = urlparse(final_url)
+    
+    path = parsed.path
+    if path and not path.endswith('/'):
+        path = os.path.dirname(path)
+    if not path.endswith('/'):
+        path += '/'
     
-    return url
+    base_url = f"{parsed.scheme}://{parsed.netloc}{path}"
+    
+    return rewrite_html(base_url, html).encode("utf-8"), status_code, content_type, headers
 
 
-def rewrite_html(base_url, html_text):
-    """Rewrite HTML links to route through proxy"""
-    try:
-        soup = BeautifulSoup(html_text, "html.parser")
-
-        def proxify(raw_url):
-            if not raw_url:
-                return raw_url
-            raw_url = raw_url.strip()
-            
-            skip_prefixes = ("#", "mailto:", "javascript:", "data:", "tel:", "/proxy?url=")
-            if raw_url.startswith(skip_prefixes):
-                return raw_url
-            
-            # Normalize the URL (fix backslashes, etc.)
-            raw_url = normalize_url(raw_url)
-            
-            absolute = urljoin(base_url, raw_url)
-            
-            # Normalize again after joining
-            absolute = normalize_url(absolute)
-            
-            return f"/proxy?url={quote_plus(absolute)}"
-
-        for tag in soup.find_all(href=True):
-            tag["href"] = proxify(tag["href"])
-        
-        for tag in soup.find_all(src=True):
-            tag["src"] = proxify(tag["src"])
-        
-        for tag in soup.find_all("form", action=True):
-            tag["action"] = proxify(tag["action"])
+def page_cache_headers(upstream_headers, body, use_chrome):
+    """Freshness and validators of a rewritten page; Chrome renders have none
+    upstream, so they are validated by a hash of the page"""
+    if use_chrome:
+        return {"ETag": conditional.content_etag(body)}
+    return {k: v for k, v in upstream_headers.items() if k.lower() in PAGE_HEADERS}
 
-        return str(soup)
-    except Exception as e:
-        logger.error(f"HTML rewrite error: {e}")
-        return html_text
+
+def store_page(page_key, status_code, body, upstream_headers, use_chrome):
+    if use_chrome and DEGRADED_HEADER in upstream_headers:
+        return None  # not what Chrome would have rendered; let the next request try again
+    headers = page_cache_headers(upstream_headers, body, use_chrome)
+    headers["Content-Type"] = "text/html; charset=utf-8"
+    lifetime = stale = None
+    if use_chrome:
+        lifetime, stale = (policy.match_suffix(Config.CHROME_PAGE_FRESHNESS, urlparse(page_key[0]).hostname or "")
+                           or (Config.CHROME_PAGE_TTL, None))
+    return PAGE_CACHE.store(page_key, status_code, headers, body, lifetime, stale)
+
+
+def render_and_store(page_key, entry, url, use_chrome, validators=None,
+                     priority=render_queue.PRIORITY_INTERACTIVE):
+    """render_page() plus the page-cache update; run once per key via PAGE_CACHE.coalesce()
+    Returns: (body_bytes, status_code, content_type, upstream_headers, cache_entry)
+    """
+    body, status_code, content_type, headers = render_page(url, use_chrome, validators, priority)
+    if status_code == 304:
+        # without an entry the validators were the client's: nothing to store
+        if entry is not None:
+            conditional.revalidated(entry.raw_size)
+            entry = PAGE_CACHE.revalidated(page_key, entry, headers)
+    elif "text/html" in content_type:
+        entry = store_page(page_key, status_code, body, headers, use_chrome)
+    else:
+        PAGE_CACHE.discard(page_key)
+        entry = None
+    return body, status_code, content_type, headers, entry
+
+
+def refresh_page(page_key, entry, url, use_chrome):
+    """Stale-while-revalidate: revalidate or re-render a cached page in the background"""
+    validators = None if use_chrome else entry.conditional_headers()
+    # Its own flight: a user joining a background render would wait at background
+    # priority and share its Overloaded (no degraded fallback) instead
+    PAGE_CACHE.coalesce((page_key, "refresh"), lambda: render_and_store(
+        page_key, entry, url, use_chrome, validators, render_queue.PRIORITY_BACKGROUND))
+
+
+def cached_page_response(entry, cache_status="HIT"):
+    not_modified = conditional.not_modified(request.headers, entry.response_headers(cache_status), entry.size)
+    if not_modified is not None:
+        return Response(b"", status=304, headers=not_modified)
+    body, headers = PAGE_CACHE.body_for(entry, request.headers.get('Accept-Encoding', ''), cache_status)
+    return Response(body, status=entry.status, headers=conditional.browser_cache_headers(headers))
+
+
+def cached_asset_response(url):
+    """Serve url (or the requested byte range of it) from ASSET_CACHE when a fresh
+    copy is held (e.g. harvested from a render)"""
+    if not ASSET_CACHE:
+        return None
+    entry = ASSET_CACHE.lookup(asset_cache.make_key(url))
+    if entry is None or not entry.is_fresh():
+        return None
+    headers = entry.response_headers()
+    headers["Accept-Ranges"] = "bytes"
+    not_modified = conditional.not_modified(request.headers, headers, entry.size)
+    if not_modified is not None:
+        return Response(b"", status=304, headers=not_modified)
+    selected = http_range.select(request.headers, entry.headers, entry.size)
+    if selected == http_range.UNSATISFIABLE:
+        return Response(b"", status=416, headers=http_range.unsatisfiable_headers(entry.size))
+    if selected is not None:
+        start, end = selected
+        return Response(http_range.slice_chunks(ASSET_CACHE.serve(entry), start, end), status=206,
+                        headers=http_range.partial_headers(headers, start, end, entry.size))
+    return Response(ASSET_CACHE.serve(entry), status=entry.status, headers=headers)
 
 
 @app.route("/")
@@ -566,7 +692,20 @@ def health():
         "chrome_enabled": Config.USE_HEADLESS_CHROME
     }
     if chrome_pool:
-        status["chrome_pool_size"] = len(chrome_pool.drivers)
+        status["chrome_pool_size"] = len(chrome_pool.drivers)  # free tabs
+        status["chrome_pool"] = chrome_pool.snapshot()
+        status["chrome_render"] = RENDER_STATS.snapshot()
+        status["render_queue"] = RENDER_QUEUE.snapshot()
+    status["upstream"] = upstream.get_client().snapshot()
+    status["compression"] = compression.stats.snapshot()
+    status["ranges"] = http_range.stats.snapshot()
+    status["conditional"] = conditional.stats.snapshot()
+    status["page_cache"] = PAGE_CACHE.snapshot() if PAGE_CACHE else None
+    status["asset_cache"] = ASSET_CACHE.snapshot() if ASSET_CACHE else None
+    status["tcp_proxy"] = tcp_server.snapshot() if tcp_server else None
+    status["dns"] = dns_cache.get_resolver().snapshot()
+    status["rate_limit"] = rate_limiter.snapshot()
+    status["policy"] = get_policy().snapshot()
     return status, 200
 
 
@@ -607,16 +746,46 @@ def catch_all_assets(path):
     
     logger.info(f"Dynamic Asset Routing: /{path} -> {target_url}")
     
+    cached = cached_asset_response(target_url)
+    if cached is not None:
+        return cached
+    
+    client_encodings = request.headers.get('Accept-Encoding', '')
+    # Media seeks: Range / If-Range go upstream and a 206 / 416 comes back verbatim
+    range_headers = http_range.forward_headers(request.headers)
     try:
-        resp = requests.get(target_url, stream=True, timeout=Config.REQUEST_TIMEOUT)
+        resp = upstream.get_client().get(
+            target_url,
+            stream=True,
+            timeout=Config.REQUEST_TIMEOUT,
+            headers={'Accept-Encoding': compression.upstream_accept_encoding(
+                client_encodings, decodable_only=not Config.COMPRESSION_PASSTHROUGH
+            ), **range_headers, **conditional.forward_headers(request.headers)}
+        )
+        if range_headers and resp.status_code in (206, 416):
+            return Response(*http_range.upstream_partial(resp))
+        if resp.status_code == 304:
+            return Response(*conditional.upstream_not_modified(resp))
         resp.raise_for_status()
         
+        # Forward the body still compressed when the client can take it
+        if Config.COMPRESSION_PASSTHROUGH and compression.can_passthrough(resp, client_encodings):
+            return Response(compression.iter_raw(resp), resp.status_code,
+                            compression.passthrough_headers(resp))
+        
         # Exclude hop-by-hop headers before returning the proxy response
         excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
         headers = [(name, value) for (name, value) in resp.raw.headers.items()
                    if name.lower() not in excluded_headers]
         
-        return Response(resp.content, resp.status_code, headers)
+        def generate():
+            # streamed: large .wasm / .data / media files are never held in memory
+            try:
+                yield from resp.iter_content(8192)
+            finally:
+                resp.close()
+        
+        return Response(generate(), resp.status_code, headers)
     except requests.exceptions.RequestException as e:
         logger.warning(f"Asset not found or connection failed: {target_url} - {e}")
         abort(404)
@@ -634,7 +803,8 @@ def proxy():
     # Rate limiting
     client_ip = request.remote_addr
     if not rate_limiter.is_allowed(client_ip):
-        abort(429, "Rate limit exceeded")
+        return Response("Rate limit exceeded", 429, content_type="text/plain",
+                        headers={"Retry-After": str(rate_limiter.retry_after(client_ip))})
     
     # Get URL
     if request.method == "POST" and "url" in request.form:
@@ -662,37 +832,79 @@ def proxy():
     logger.info(f"Proxying: {url}")
     
     try:
+        # Sub-resources harvested from an earlier render need no upstream request
+        cached = cached_asset_response(url)
+        if cached is not None:
+            return cached
+        
         # Decide whether to use Chrome or requests
         use_chrome = should_use_chrome(url)
+        mode = page_cache.MODE_CHROME if use_chrome else page_cache.MODE_REQUESTS
+        page_key = page_cache.make_key(url, mode)
+        
+        page = PAGE_CACHE.lookup(page_key) if PAGE_CACHE else None
+        validators = None
+        if page is not None:
+            if page.is_fresh():
+                return cached_page_response(page)
+            if page.can_serve_stale():
+                PAGE_CACHE.refresh_async(page_key, lambda: refresh_page(page_key, page, url, use_chrome))
+                return cached_page_response(page, "STALE")
+            if not use_chrome:
+                validators = page.conditional_headers()
+        
+        # Holding no copy, a plain fetch sends the client's own validators upstream;
+        # the answer (perhaps a 304) is then this client's alone, so it is not coalesced
+        forwarded = conditional.forward_headers(request.headers) if not use_chrome and page is None else {}
         
-        if use_chrome:
-            logger.info(f"Using Chrome for: {url}")
-            html, status_code, content_type, final_url = fetch_with_chrome(url)
+        if PAGE_CACHE and not forwarded:
+            # concurrent misses for this page wait for one render (and one cache store)
+            body, status_code, content_type, upstream_headers, page = PAGE_CACHE.coalesce(
+                page_key, lambda: render_and_store(page_key, page, url, use_chrome, validators))
+        elif PAGE_CACHE:
+            body, status_code, content_type, upstream_headers, page = render_and_store(
+                page_key, page, url, use_chrome, forwarded)
         else:
-            logger.info(f"Using requests for: {url}")
-            content, status_code, content_type, final_url = fetch_with_requests(url)
-            html = content if isinstance(content, str) else content.decode('utf-8', errors='replace')
+            body, status_code, content_type, upstream_headers = render_page(url, use_chrome,
+                                                                            validators or forwarded)
+        
+        if status_code == 304:
+            if page is not None:
+                return cached_page_response(page, "REVALIDATED")
+            return Response(*conditional.passed_not_modified(upstream_headers))
         
-        # Rewrite HTML content
         if "text/html" in content_type:
-            parsed = urlparse(final_url)
-            
-            path = parsed.path
-            if path and not path.endswith('/'):
-                path = os.path.dirname(path)
-            if not path.endswith('/'):
-                path += '/'
-            
-            base_url = f"{parsed.scheme}://{parsed.netloc}{path}"
-            
-            return Response(
-                rewrite_html(base_url, html),
-                content_type="text/html; charset=utf-8"
-            )
+            # Renders are shared by every client waiting on them, so the client's own
+            # validators are checked here rather than sent upstream
+            headers = page_cache_headers(upstream_headers, body, use_chrome)
+            not_modified = conditional.not_modified(request.headers, headers, len(body))
+            if not_modified is not None:
+                return Response(b"", status=304, headers=not_modified)
+            headers = conditional.browser_cache_headers(
+                {k: v for k, v in headers.items() if k.lower() not in ('date', 'age')})
+            headers["Content-Type"] = "text/html; charset=utf-8"
+            encoding = None
+            if Config.HTML_RECOMPRESS:
+                encoding = compression.negotiate(request.headers.get('Accept-Encoding', ''))
+            if encoding:
+                return Response(
+                    compression.compress_stream(compression.chunked(body), encoding, Config.HTML_COMPRESS_LEVEL),
+                    headers=compression.encoded_headers(headers, encoding)
+                )
+            return Response(body, headers=headers)
         
-        # Return non-HTML content as-is
-        return Response(html if isinstance(html, bytes) else html.encode(), content_type=content_type)
-
+        # Non-HTML content as is, with its validators and freshness
+        headers = conditional.browser_cache_headers(
+            {k: v for k, v in upstream_headers.items() if k.lower() in PAGE_HEADERS and k.lower() not in ('date', 'age')})
+        not_modified = conditional.not_modified(request.headers, headers, len(body))
+        if not_modified is not None:
+            return Response(b"", status=304, headers=not_modified)
+        headers["Content-Type"] = content_type
+        return Response(body, headers=headers)
+
+    except render_queue.Overloaded as e:
+        return Response("Rendering capacity exhausted, try again shortly", status=503,
+                        headers={"Retry-After": str(e.retry_after)}, content_type="text/plain")
     except requests.Timeout:
         abort(504, "Request timeout")
     except requests.RequestException as e:
@@ -703,6 +915,47 @@ def proxy():
         abort(500, f"Internal error: {str(e)}")
 
 
+# ---------------- METRICS ----------------
+
+# Live state, read when /metrics is scraped (each worker has its own Chrome
+# pool and TCP proxy, so these describe the worker that answers)
+def queue_metric(read):
+    return lambda: read(RENDER_QUEUE.snapshot())
+
+
+def chrome_metric(read):
+    return lambda: read(chrome_pool.snapshot()) if chrome_pool else None
+
+
+def tcp_metric(read):
+    return lambda: read(tcp_server.stats) if tcp_server else None
+
+
+metrics.callback("reidproxy_chrome_queue_renders", "Renders waiting for a Chrome slot and rendering now.",
+                 queue_metric(lambda q: {"waiting": q["depth"], "rendering": q["inflight"]}),
+                 labelnames=("state",))
+metrics.callback("reidproxy_chrome_queue_rejected_total",
+                 "Renders refused a slot: queue full, deadline passed, or degraded to a plain fetch.",
+                 queue_metric(lambda q: {"full": q["rejected_full"], "timeout": q["timed_out"],
+                                         "degraded": q["degraded"]}),
+                 kind="counter", labelnames=("reason",))
+metrics.callback("reidproxy_chrome_browsers", "Chrome processes running.", chrome_metric(lambda s: s["browsers"]))
+metrics.callback("reidproxy_chrome_tabs", "Chrome tabs, busy and total.",
+                 chrome_metric(lambda s: {"busy": s["busy_tabs"], "total": s["tabs"]}), labelnames=("state",))
+metrics.callback("reidproxy_tcp_proxy_active_connections", "Client connections open on the TCP proxy.",
+                 tcp_metric(lambda s: s.active))
+metrics.callback("reidproxy_tcp_proxy_connections_total", "Client connections accepted, by kind.",
+                 tcp_metric(lambda s: {"all": s.connections, "connect_tunnel": s.connect_tunnels}),
+                 kind="counter", labelnames=("kind",))
+metrics.callback("reidproxy_tcp_proxy_bytes_total", "Bytes relayed by the TCP proxy (up: client to upstream).",
+                 tcp_metric(lambda s: {"up": s.bytes_up, "down": s.bytes_down}),
+                 kind="counter", labelnames=("direction",))
+
+# After every route: routes are label values
+metrics.instrument(app, os.path.join(Config.SHARED_STATE_DIR, f"reidproxy-{Config.FLASK_PORT}-metrics")
+                   if Config.SHARED_STATE_DIR else None)
+
+
 # ---------------- ENTRY POINT ----------------
 
 def main():
@@ -76,9 +76,30 @@ def test_rate_limiter():
     assert limiter.is_allowed("user1") is False
     assert limiter.is_allowed("user2") is True
 
-@patch('app_with_chrome.BeautifulSoup')
-def test_rewrite_html(mock_bs):
-    base_url = "https://example.com/"
-    html = '<html></html>'
-    rewrite_html(base_url, html)
-    mock_bs.assert_called_once()
+def test_rewrite_html():
+    base_url = "https://example.com/dir/"
+    html = ('<html><a href="page?a=1&amp;b=2">x</a><img src=/i.png>'
+            '<script>var a = \'<a href="/skip">\';</script><a href="#top">t</a></html>')
+    out = rewrite_html(base_url, html)
+    assert '<a href="/proxy?url=https%3A%2F%2Fexample.com%2Fdir%2Fpage%3Fa%3D1%26b%3D2">' in out
+    assert '<img src="/proxy?url=https%3A%2F%2Fexample.com%2Fi.png">' in out
+    assert '<a href="/skip">' in out
+    assert '<a href="#top">' in out
+
+def test_host_policy_suffix_matching():
+    original_use = Config.USE_HEADLESS_CHROME
+    original_domains = Config.USE_CHROME_FOR_DOMAINS
+    Config.USE_HEADLESS_CHROME = True
+    Config.USE_CHROME_FOR_DOMAINS = {'reddit.com'}
+    Config.BLOCKED_DOMAINS = {'malicious.com', '10.0.0.0/8'}
+
+    assert should_use_chrome("https://old.reddit.com:443/r/python") is True
+    assert should_use_chrome("https://notreddit.com.evil/") is False
+    assert should_use_chrome("https://reddit.com.evil/") is False
+    assert is_domain_allowed("https://cdn.malicious.com/x.js") is False
+    assert is_domain_allowed("https://notmalicious.com/") is True
+    assert is_domain_allowed("http://10.1.2.3/") is False
+
+    Config.USE_HEADLESS_CHROME = original_use
+    Config.USE_CHROME_FOR_DOMAINS = original_domains
+    Config.BLOCKED_DOMAINS = set()
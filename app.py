@@ -1,12 +1,24 @@
 # app.py - Stealth Proxy Server (merged improvements 2025/2026)
 from flask import Flask, request, Response, send_from_directory, jsonify
+from werkzeug.wsgi import wrap_file
 from urllib.parse import urlparse, unquote
 import requests
-import re
 import os
 import logging
 import traceback
-from ipaddress import ip_address
+
+import asset_cache
+import compression
+import conditional
+import disk_cache
+import dns_cache
+import http_range
+import metrics
+import page_cache
+import policy
+import shared_state
+import upstream
+from html_rewrite import StreamingHtmlRewriter
 
 # ────────────────────────────────────────────────
 # Logging ─ very verbose for development
@@ -24,17 +36,89 @@ app.config['PROPAGATE_EXCEPTIONS'] = True
 SUBRESOURCE_TIMEOUT_SECONDS = int(os.environ.get("SUBRESOURCE_TIMEOUT_SECONDS", "15"))
 UPSTREAM_TIMEOUT_SECONDS = int(os.environ.get("UPSTREAM_TIMEOUT_SECONDS", "25"))
 
+# Forward upstream gzip/br bytes untouched for non-rewritten responses, and
+# re-compress rewritten HTML with the encoding the client asked for
+COMPRESSION_PASSTHROUGH = os.environ.get("COMPRESSION_PASSTHROUGH", "true").lower() == "true"
+HTML_RECOMPRESS = os.environ.get("HTML_RECOMPRESS", "true").lower() == "true"
+HTML_COMPRESS_LEVEL = int(os.environ.get("HTML_COMPRESS_LEVEL", "5"))
+
+# Shared in-memory cache for /p/<netloc>/<path> sub-resources (0 disables)
+ASSET_CACHE_MAX_BYTES = int(os.environ.get("ASSET_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+ASSET_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("ASSET_CACHE_MAX_ENTRY_BYTES", str(16 * 1024 * 1024)))
+ASSET_CACHE = (
+    asset_cache.AssetCache(ASSET_CACHE_MAX_BYTES, ASSET_CACHE_MAX_ENTRY_BYTES)
+    if ASSET_CACHE_MAX_BYTES > 0 else None
+)
+
+# Persistent content-addressed store shared by all gunicorn workers ("" disables)
+DISK_CACHE_DIR = os.environ.get(
+    "DISK_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "assets")
+)
+DISK_CACHE_MAX_BYTES = int(os.environ.get("DISK_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+DISK_CACHE_INDEX_SLOTS = int(os.environ.get("DISK_CACHE_INDEX_SLOTS", "65536"))
+DISK_CACHE = None
+if DISK_CACHE_DIR:
+    try:
+        DISK_CACHE = disk_cache.DiskCache(DISK_CACHE_DIR, DISK_CACHE_MAX_BYTES, DISK_CACHE_INDEX_SLOTS)
+    except OSError as e:
+        logger.error(f"Disk cache disabled ({DISK_CACHE_DIR}): {e}")
+
+# Finished /p/ pages (rewritten and compressed), served again without a
+# fetch while fresh and refreshed in the background while stale (0 disables)
+PAGE_CACHE_MAX_BYTES = int(os.environ.get("PAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+PAGE_CACHE_STALE_SECONDS = int(os.environ.get("PAGE_CACHE_STALE_SECONDS", "60"))
+PAGE_CACHE = (
+    page_cache.PageCache(PAGE_CACHE_MAX_BYTES, PAGE_CACHE_STALE_SECONDS)
+    if PAGE_CACHE_MAX_BYTES > 0 else None
+)
+
+# Cached DNS answers; upstream connections go to the exact addresses that
+# passed the private-network check (see dns_cache.py)
+dns_cache.configure(
+    ttl=float(os.environ.get("DNS_CACHE_TTL_SECONDS", "60")),
+    negative_ttl=float(os.environ.get("DNS_NEGATIVE_TTL_SECONDS", "10")),
+)
+
+# Shared keep-alive pools for every upstream fetch (see upstream.py)
+upstream.configure(
+    pool_hosts=int(os.environ.get("UPSTREAM_POOL_HOSTS", "100")),
+    pool_maxsize=int(os.environ.get("UPSTREAM_POOL_MAXSIZE", "32")),
+    idle_timeout=float(os.environ.get("UPSTREAM_IDLE_TIMEOUT_SECONDS", "60")),
+    block_private=True,
+)
+
+# Counters in /debug and /metrics totalled over every gunicorn worker on the
+# host, kept in files under this directory (see shared_state.py), e.g.
+# /dev/shm.  Unset keeps them per worker.  Every deployment on the host
+# needs its own prefix: workers with the same one share the files
+SHARED_STATE_DIR = os.environ.get("SHARED_STATE_DIR", "")
+SHARED_STATE_PREFIX = os.environ.get("SHARED_STATE_PREFIX", "reidproxy-app")
+if SHARED_STATE_DIR:
+    try:
+        shared_state.share_stats(SHARED_STATE_DIR, SHARED_STATE_PREFIX, compression, http_range, conditional)
+    except OSError as e:
+        logger.error(f"Shared counters disabled ({SHARED_STATE_DIR}): {e}")
+
 # ────────────────────────────────────────────────
 # SSRF / private network protection
 # ────────────────────────────────────────────────
-DENY_LIST_SUBSTRINGS = [
-    "localhost", "127.0.0.1", "0.0.0.0", "::1",
-    "192.168.", "10.", "172.16.", "172.17.", "172.18.", "172.19.",
-    "172.20.", "172.21.", "172.22.", "172.23.", "172.24.", "172.25.",
-    "172.26.", "172.27.", "172.28.", "172.29.", "172.30.", "172.31.",
-    "169.254.",
+DENY_LIST = [
+    "localhost", "0.0.0.0/8", "127.0.0.0/8", "::1", "10.0.0.0/8", "172.16.0.0/12",
+    "192.168.0.0/16", "169.254.0.0/16", "fc00::/7", "fe80::/10",
 ]
 
+
+def build_policy():
+    """DENY_LIST plus the files named in BLOCKLIST_FILES (os.pathsep-separated)."""
+    entries = list(DENY_LIST)
+    for path in filter(None, os.environ.get("BLOCKLIST_FILES", "").split(os.pathsep)):
+        entries += policy.load_list(path)
+    return policy.HostPolicy(block=entries)
+
+
+POLICY = build_policy()
+
+
 def is_dangerous_url(url_str: str) -> bool:
     parsed = urlparse(url_str)
     host = (parsed.hostname or "").lower()
@@ -42,25 +126,21 @@ def is_dangerous_url(url_str: str) -> bool:
     if not host:
         return True
 
-    for block in DENY_LIST_SUBSTRINGS:
-        if block in host:
-            return True
+    if "block" in POLICY.matches(host):
+        return True
 
+    # IP literals and resolved names alike: the answer is cached and the same
+    # addresses are re-checked at connect time (redirects included) by the
+    # upstream client, so what passes here is what gets connected to
     try:
-        ip = ip_address(host)
-        if (
-            ip.is_private
-            or ip.is_loopback
-            or ip.is_link_local
-            or ip.is_multicast
-            or ip.is_reserved
-            or ip.is_unspecified
-        ):
-            return True
-    except ValueError:
-        pass
-
-    return False
+        addresses = dns_cache.get_resolver().resolve(host, check=True)
+    except dns_cache.BlockedAddressError:
+        return True
+    except (OSError, UnicodeError):
+        return False  # unresolvable: the fetch fails on its own
+
+    # blocklisted networks apply to what the name resolves to as well
+    return any("block" in POLICY.address_matches(address) for address in addresses)
 
 # ────────────────────────────────────────────────
 # Debug endpoint
@@ -83,7 +163,16 @@ def debug_info():
         },
         "python": {
             "version": os.sys.version.splitlines()[0],
-        }
+        },
+        "upstream": upstream.get_client().snapshot(),
+        "dns": dns_cache.get_resolver().snapshot(),
+        "policy": POLICY.snapshot(),
+        "compression": compression.stats.snapshot(),
+        "ranges": http_range.stats.snapshot(),
+        "conditional": conditional.stats.snapshot(),
+        "asset_cache": ASSET_CACHE.snapshot() if ASSET_CACHE else None,
+        "disk_cache": DISK_CACHE.snapshot() if DISK_CACHE else None,
+        "page_cache": PAGE_CACHE.snapshot() if PAGE_CACHE else None,
     }
     return jsonify(info), 200
 
@@ -102,6 +191,48 @@ def serve_assets(filename):
 def serve_static_files(filename):
     return send_from_directory("static", filename)
 
+def cached_asset_response(entry, cache_status="HIT"):
+    """Serve a memory or disk cache entry, or the byte range the client asked for;
+    whole disk bodies go out via wsgi.file_wrapper (sendfile)"""
+    headers = entry.response_headers(cache_status)
+    headers["Accept-Ranges"] = "bytes"
+    on_disk = isinstance(entry, disk_cache.DiskEntry)
+    not_modified = conditional.not_modified(request.headers, headers, entry.size)
+    if not_modified is not None:
+        if on_disk:
+            entry.close()
+        return Response(b"", status=304, headers=not_modified)
+    selected = http_range.select(request.headers, entry.headers, entry.size)
+    if selected == http_range.UNSATISFIABLE:
+        if on_disk:
+            entry.close()
+        return Response(b"", status=416, headers=http_range.unsatisfiable_headers(entry.size))
+    if selected is not None:
+        start, end = selected
+        if on_disk:
+            body = http_range.read_file_range(DISK_CACHE.serve(entry), start, end)
+        else:
+            body = http_range.slice_chunks(ASSET_CACHE.serve(entry), start, end)
+        return Response(body, status=206, headers=http_range.partial_headers(headers, start, end, entry.size))
+    if on_disk:
+        body = wrap_file(request.environ, DISK_CACHE.serve(entry))
+        return Response(body, status=entry.status, headers=headers, direct_passthrough=True)
+    return Response(ASSET_CACHE.serve(entry), status=entry.status, headers=headers)
+
+def seed_from_disk(cache_key, entry):
+    """Replace this worker's stale memory copy with a fresh disk entry (left ready to serve)."""
+    if entry.size > ASSET_CACHE.max_entry_bytes:
+        return
+    try:
+        body = entry.file.read()
+        entry.file.seek(0)
+    except OSError as e:
+        logger.warning(f"Disk cache read failed: {e}")
+        return
+    if len(body) == entry.size:
+        ASSET_CACHE.put(cache_key, asset_cache.CacheEntry(entry.status, entry.headers, (body,),
+                                                          entry.expires_at - entry.stored_at, entry.stored_at))
+
 # ────────────────────────────────────────────────
 # Sub-resource proxy   /p/example.com/style.css   →   https://example.com/style.css
 # MUST COME BEFORE the main /p/<path> route
@@ -120,17 +251,47 @@ def sub_resource_proxy(netloc, subpath):
     http_target = with_query(f"http://{netloc}/{subpath}")
 
     logger.info(f"Sub-resource: {request.url} → {https_target}")
+    client_encodings = request.headers.get("Accept-Encoding", "")
+    upstream_encodings = compression.upstream_accept_encoding(
+        client_encodings, decodable_only=not COMPRESSION_PASSTHROUGH
+    )
+
+    # Shared cache: fresh hits never touch upstream, stale ones revalidate
+    cache_key = asset_cache.make_key(https_target, upstream_encodings)
+    cached = ASSET_CACHE.lookup(cache_key) if ASSET_CACHE else None
+    if DISK_CACHE and (cached is None or not cached.is_fresh()):
+        # Another worker may have stored a fresh copy since ours went stale
+        disk_entry = DISK_CACHE.lookup(cache_key)
+        if disk_entry is not None and cached is not None and disk_entry.is_fresh():
+            seed_from_disk(cache_key, disk_entry)
+            cached = disk_entry
+        elif disk_entry is not None and cached is not None:
+            disk_entry.close()
+        elif disk_entry is not None:
+            cached = disk_entry
+    if cached is not None and cached.is_fresh():
+        return cached_asset_response(cached)
+    on_disk = isinstance(cached, disk_cache.DiskEntry)
 
     try:
         headers = {
             "User-Agent": request.headers.get("User-Agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"),
             "Accept": request.headers.get("Accept", "*/*"),
             "Referer": request.headers.get("Referer", f"https://{netloc}/"),
-            "Accept-Encoding": "gzip, deflate, br",
+            "Accept-Encoding": upstream_encodings,
         }
+        range_headers = http_range.forward_headers(request.headers)
+        headers.update(range_headers)
+        if cached is not None:
+            headers.update(cached.conditional_headers())
+            if ASSET_CACHE:
+                ASSET_CACHE.note_revalidation()
+        else:
+            headers.update(conditional.forward_headers(request.headers))
 
+        client = upstream.get_client()
         try:
-            resp = requests.get(
+            resp = client.get(
                 https_target,
                 headers=headers,
                 timeout=SUBRESOURCE_TIMEOUT_SECONDS,
@@ -139,25 +300,54 @@ def sub_resource_proxy(netloc, subpath):
             )
         except requests.RequestException:
             logger.info(f"Sub-resource HTTPS failed, retrying over HTTP: {http_target}")
-            resp = requests.get(
+            resp = client.get(
                 http_target,
                 headers=headers,
                 timeout=SUBRESOURCE_TIMEOUT_SECONDS,
                 stream=True,
                 allow_redirects=True
             )
+        if range_headers and resp.status_code in (206, 416):
+            if on_disk:
+                cached.close()
+            return Response(*http_range.upstream_partial(resp))
         resp.raise_for_status()
 
-        excluded = ["content-encoding", "content-length", "transfer-encoding", "connection"]
-        out_headers = {k: v for k, v in resp.headers.items() if k.lower() not in excluded}
+        if cached is not None and resp.status_code == 304:
+            resp.close()
+            conditional.revalidated(cached.size)
+            cached = (DISK_CACHE if on_disk else ASSET_CACHE).revalidated(cache_key, cached, resp.headers)
+            return cached_asset_response(cached, "REVALIDATED")
+        if resp.status_code == 304:
+            return Response(*conditional.upstream_not_modified(resp))
+        if on_disk:
+            cached.close()
+
+        if COMPRESSION_PASSTHROUGH and compression.can_passthrough(resp, client_encodings):
+            out_headers = compression.passthrough_headers(resp)
+            body = compression.iter_raw(resp)
+        else:
+            excluded = ["content-encoding", "content-length", "transfer-encoding", "connection"]
+            out_headers = {k: v for k, v in resp.headers.items() if k.lower() not in excluded}
+
+            def generate():
+                try:
+                    for chunk in resp.iter_content(8192):
+                        yield chunk
+                finally:
+                    resp.close()
 
-        def generate():
-            for chunk in resp.iter_content(8192):
-                yield chunk
+            body = generate()
 
-        return Response(generate(), status=resp.status_code, headers=out_headers)
+        if DISK_CACHE:
+            body = DISK_CACHE.tee(cache_key, resp.status_code, out_headers, body)
+        if ASSET_CACHE:
+            body = ASSET_CACHE.tee(cache_key, resp.status_code, out_headers, body)
+        return Response(body, status=resp.status_code, headers=out_headers)
 
     except Exception as e:
+        if on_disk:
+            cached.close()
         logger.error(f"Sub-resource failed https://{netloc}/{subpath}: {str(e)}")
         if request.args.get("debug") == "1":
             return f"<pre>Sub-resource error:\n{traceback.format_exc()}</pre>", 502
@@ -166,6 +356,43 @@ def sub_resource_proxy(netloc, subpath):
 # ────────────────────────────────────────────────
 # Main proxy route   /p/https://example.com/path   or   /p/example.com
 # ────────────────────────────────────────────────
+def rewritten_html_headers(resp, content_type):
+    headers = {
+        k: v for k, v in resp.headers.items()
+        if k.lower() not in ["content-encoding", "content-length", "transfer-encoding", "connection"]
+    }
+    headers["Content-Type"] = content_type
+    return headers
+
+
+def cached_page_response(entry, client_encodings, cache_status="HIT"):
+    not_modified = conditional.not_modified(request.headers, entry.response_headers(cache_status), entry.size)
+    if not_modified is not None:
+        return Response(b"", status=304, headers=not_modified)
+    body, headers = PAGE_CACHE.body_for(entry, client_encodings, cache_status)
+    return Response(body, status=entry.status, headers=conditional.browser_cache_headers(headers))
+
+
+def refresh_page(page_key, entry, target_url, headers):
+    """Stale-while-revalidate: revalidate or re-rewrite a cached page off the request path."""
+    headers = dict(headers, **entry.conditional_headers())
+    resp = upstream.get_client().get(target_url, headers=headers,
+                                     timeout=UPSTREAM_TIMEOUT_SECONDS, allow_redirects=True)
+    if resp.status_code == 304:
+        conditional.revalidated(entry.raw_size)
+        PAGE_CACHE.revalidated(page_key, entry, resp.headers)
+        return
+    resp.raise_for_status()
+    if resp.status_code != 200:
+        return  # e.g. a 206: nothing that could replace the cached page
+    content_type = resp.headers.get("Content-Type", "").lower()
+    if "text/html" not in content_type:
+        PAGE_CACHE.discard(page_key)
+        return
+    html = StreamingHtmlRewriter(urlparse(target_url).netloc).rewrite(resp.content)
+    PAGE_CACHE.store(page_key, resp.status_code, rewritten_html_headers(resp, content_type), html)
+
+
 @app.route("/p/<path:encoded_url>")
 def stealth_proxy(encoded_url):
     debug_mode = request.args.get("debug", "0") == "1"
@@ -182,86 +409,114 @@ def stealth_proxy(encoded_url):
         if is_dangerous_url(target_url):
             return "Blocked: internal / private address", 403
 
+        client_encodings = request.headers.get("Accept-Encoding", "")
         headers = {
             "User-Agent": request.headers.get("User-Agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"),
             "Accept": request.headers.get("Accept", "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"),
             "Accept-Language": request.headers.get("Accept-Language", "en-US,en;q=0.9"),
-            "Accept-Encoding": "gzip, deflate, br",
+            # HTML may need rewriting, so only ask for codings we can decode
+            "Accept-Encoding": compression.upstream_accept_encoding(client_encodings, decodable_only=True),
             "Referer": request.headers.get("Referer", ""),
             "Connection": "keep-alive",
         }
+        # Media seeks: the slice comes back as a verbatim 206 (see http_range.py)
+        range_headers = http_range.forward_headers(request.headers)
+        headers.update(range_headers)
+
+        page_key = page_cache.make_key(target_url, page_cache.MODE_STEALTH)
+        page = PAGE_CACHE.lookup(page_key) if PAGE_CACHE else None
+        if page is not None:
+            if page.is_fresh():
+                return cached_page_response(page, client_encodings)
+            if page.can_serve_stale():
+                # The refresh fetches the whole page, whatever slice this client asked for
+                refresh_headers = {k: v for k, v in headers.items() if k not in range_headers}
+                PAGE_CACHE.refresh_async(page_key, lambda: refresh_page(page_key, page, target_url, refresh_headers))
+                return cached_page_response(page, client_encodings, "STALE")
+            headers.update(page.conditional_headers())
+        else:
+            headers.update(conditional.forward_headers(request.headers))
 
-        resp = requests.get(
+        resp = upstream.get_client().get(
             target_url,
             headers=headers,
             timeout=UPSTREAM_TIMEOUT_SECONDS,
             allow_redirects=True,
             stream=True
         )
+        if resp.status_code == 304 and page is not None:
+            resp.close()
+            conditional.revalidated(page.raw_size)
+            page = PAGE_CACHE.revalidated(page_key, page, resp.headers)
+            return cached_page_response(page, client_encodings, "REVALIDATED")
+        if resp.status_code == 304:
+            return Response(*conditional.upstream_not_modified(resp))
+        if range_headers and resp.status_code in (206, 416):
+            return Response(*http_range.upstream_partial(resp))
         resp.raise_for_status()
 
         content_type = resp.headers.get("Content-Type", "").lower()
 
-        content = b""
         if "text/html" in content_type:
+            # Rewrite root-relative, protocol-relative, same-domain absolute and
+            # url(/...) links in a single streaming pass (see html_rewrite.py)
+            rewriter = StreamingHtmlRewriter(urlparse(target_url).netloc)
+            out_headers = rewritten_html_headers(resp, content_type)
+
+            def stream_rewritten():
+                # Keep a copy for the page cache; only a complete page is stored
+                parts = [] if PAGE_CACHE else None
+                size = 0
+                try:
+                    for chunk in resp.iter_content(chunk_size=8192):
+                        out = rewriter.feed(chunk)
+                        if out:
+                            if parts is not None:
+                                size += len(out)
+                                if size > PAGE_CACHE.max_bytes:
+                                    parts = None
+                                else:
+                                    parts.append(out)
+                            yield out
+                    out = rewriter.flush()
+                    if parts is not None:
+                        parts.append(out)
+                        PAGE_CACHE.store(page_key, resp.status_code, out_headers, b"".join(parts))
+                    yield out
+                except Exception as e:
+                    logger.error(f"HTML rewrite failed mid-stream {target_url}: {e}")
+                finally:
+                    resp.close()
+
+            body = stream_rewritten()
+            encoding = compression.negotiate(client_encodings) if HTML_RECOMPRESS else None
+            response_headers = conditional.browser_cache_headers(out_headers)
+            if encoding:
+                body = compression.compress_stream(body, encoding, HTML_COMPRESS_LEVEL)
+                response_headers = compression.encoded_headers(response_headers, encoding)
+
+            return Response(body, status=resp.status_code, headers=response_headers)
+
+        if COMPRESSION_PASSTHROUGH and compression.can_passthrough(resp, client_encodings):
+            return Response(compression.iter_raw(resp), status=resp.status_code,
+                            headers=compression.passthrough_headers(resp), content_type=content_type)
+
+        # Stream non-HTML directly
+        def stream_content():
             try:
-                html = resp.content.decode("utf-8", errors="replace")
-                parsed = urlparse(target_url)
-                netloc = parsed.netloc
-                proxy_prefix = f"/p/{netloc}"
-
-                # Rewrite root-relative, protocol-relative, same-domain absolute
-                for attr in ['href', 'src', 'action', 'data-src', 'poster', 'data-background', 'data-lazy-src', 'data-poster']:
-                    html = re.sub(
-                        rf'({attr})=["\']/(?!/)',
-                        rf'\1="{proxy_prefix}/',
-                        html, flags=re.IGNORECASE
-                    )
-                    html = re.sub(
-                        rf'({attr})=["\']//',
-                        rf'\1="{proxy_prefix}/',
-                        html, flags=re.IGNORECASE
-                    )
-                    html = re.sub(
-                        rf'({attr})=["\']https?://{re.escape(netloc)}',
-                        rf'\1="{proxy_prefix}',
-                        html, flags=re.IGNORECASE
-                    )
-
-                # Basic inline style url(/path) → url(/p/netloc/path)
-                html = re.sub(
-                    r'url\(\s*["\']?/(?!/)',
-                    f'url({proxy_prefix}/',
-                    html, flags=re.IGNORECASE
-                )
-
-                content = html.encode("utf-8")
-            except Exception as e:
-                logger.error(f"HTML rewrite failed: {e}")
-                content = resp.content
-        else:
-            # Stream non-HTML directly
-            def stream_content():
                 for chunk in resp.iter_content(chunk_size=8192):
                     yield chunk
-
-            return Response(
-                stream_content(),
-                status=resp.status_code,
-                headers={k: v for k, v in resp.headers.items() if k.lower() not in [
-                    "content-encoding", "content-length", "transfer-encoding", "connection"
-                ]},
-                content_type=content_type
-            )
-
-        # Final headers
-        out_headers = {
-            k: v for k, v in resp.headers.items()
-            if k.lower() not in ["content-encoding", "content-length", "transfer-encoding", "connection"]
-        }
-        out_headers["Content-Type"] = content_type
-
-        return Response(content, status=resp.status_code, headers=out_headers)
+            finally:
+                resp.close()
+
+        return Response(
+            stream_content(),
+            status=resp.status_code,
+            headers={k: v for k, v in resp.headers.items() if k.lower() not in [
+                "content-encoding", "content-length", "transfer-encoding", "connection"
+            ]},
+            content_type=content_type
+        )
 
     except requests.RequestException as e:
         logger.error(f"Fetch failed {target_url}: {str(e)}")
@@ -285,6 +540,12 @@ def page_not_found(e):
     return "<h2>404 - Not Found</h2><p>Try /debug or check URL format</p>", 404
 
 
+# ────────────────────────────────────────────────
+# Prometheus metrics  GET /metrics  (after every route: routes are label values)
+# ────────────────────────────────────────────────
+metrics.instrument(app, os.path.join(SHARED_STATE_DIR, f"{SHARED_STATE_PREFIX}-metrics") if SHARED_STATE_DIR else None)
+
+
 if __name__ == "__main__":
     # For HTTPS (recommended for crypto.subtle / secure context):
     #   1. mkcert -install
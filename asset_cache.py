@@ -0,0 +1,293 @@
+# asset_cache.py - shared, byte-bounded HTTP cache for proxied sub-resources
+#
+# Most of what /p/<netloc>/<path> serves is immutable CDN content (CSS, JS,
+# fonts, images) that every visitor refetches.  This cache follows upstream
+# Cache-Control / Expires / ETag / Last-Modified, keeps entries in an LRU
+# bounded by total bytes, revalidates stale entries with If-None-Match /
+# If-Modified-Since, and fills itself from the body as it streams to the
+# first client (the chunks are kept as they pass; nothing is re-read).
+# Complete bodies obtained elsewhere (responses harvested from a headless
+# Chrome render) are added with seed().
+import logging
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+# Never replayed from a shared cache
+_UNSHARED_HEADERS = ("set-cookie", "set-cookie2", "age", "x-cache")
+# Heuristic freshness for responses with only Last-Modified (RFC 9111 §4.2.2)
+_HEURISTIC_FRACTION = 0.1
+_HEURISTIC_MAX = 24 * 3600
+
+
+# ────────────────────────────────────────────────
+# Header helpers
+# ────────────────────────────────────────────────
+def parse_cache_control(value: str) -> dict:
+    """'public, max-age=60' → {'public': None, 'max-age': '60'}"""
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.strip().lower()] = arg.strip().strip('"') or None
+    return directives
+
+
+def parse_http_date(value):
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def get_header(headers, name):
+    """Case-insensitive lookup that also works on plain dicts."""
+    value = headers.get(name)
+    if value is None:
+        lower = name.lower()
+        for key, v in headers.items():
+            if key.lower() == lower:
+                return v
+    return value
+
+
+def freshness_lifetime(headers, now=None):
+    """Seconds the response may be served without revalidation.
+
+    Returns None when a shared cache must not store it at all.
+    """
+    now = time.time() if now is None else now
+    cc = parse_cache_control(get_header(headers, "Cache-Control"))
+    if "no-store" in cc or "private" in cc:
+        return None
+    vary = (get_header(headers, "Vary") or "").lower()
+    if vary and any(v.strip() not in ("", "accept-encoding") for v in vary.split(",")):
+        return None
+
+    age = 0
+    try:
+        age = max(0, int(get_header(headers, "Age") or 0))
+    except ValueError:
+        pass
+
+    if "no-cache" in cc:
+        lifetime = 0
+    elif "s-maxage" in cc or "max-age" in cc:
+        try:
+            lifetime = int(cc.get("s-maxage") or cc.get("max-age") or 0)
+        except ValueError:
+            lifetime = 0
+    else:
+        date = parse_http_date(get_header(headers, "Date")) or now
+        expires = parse_http_date(get_header(headers, "Expires"))
+        last_modified = parse_http_date(get_header(headers, "Last-Modified"))
+        if get_header(headers, "Expires") is not None:
+            lifetime = (expires or 0) - date
+        elif last_modified is not None:
+            lifetime = min((date - last_modified) * _HEURISTIC_FRACTION, _HEURISTIC_MAX)
+        else:
+            lifetime = 0
+
+    lifetime = max(0, lifetime - age)
+    has_validator = get_header(headers, "ETag") or get_header(headers, "Last-Modified")
+    if lifetime <= 0 and not has_validator:
+        return None
+    return lifetime
+
+
+def make_key(url, accept_encoding=""):
+    """Entries vary on the Accept-Encoding sent upstream (bodies are kept encoded)."""
+    return (url, accept_encoding)
+
+
+# ────────────────────────────────────────────────
+# Entries
+# ────────────────────────────────────────────────
+def shareable_headers(headers) -> dict:
+    """Headers safe to replay to other clients from a shared cache."""
+    return {k: v for k, v in headers.items() if k.lower() not in _UNSHARED_HEADERS}
+
+
+class StoredResponse:
+    """Status, headers and freshness of a cached response (body kept by subclasses)."""
+
+    __slots__ = ("status", "headers", "size", "stored_at", "expires_at")
+
+    def __init__(self, status, headers, size, lifetime, now=None):
+        now = time.time() if now is None else now
+        self.status = status
+        self.headers = shareable_headers(headers)
+        self.size = size
+        self.stored_at = now
+        self.expires_at = now + lifetime
+
+    def is_fresh(self, now=None):
+        return (time.time() if now is None else now) < self.expires_at
+
+    def conditional_headers(self) -> dict:
+        """Validators to send upstream when revalidating this entry."""
+        headers = {}
+        etag = get_header(self.headers, "ETag")
+        last_modified = get_header(self.headers, "Last-Modified")
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def response_headers(self, cache_status="HIT", now=None) -> dict:
+        now = time.time() if now is None else now
+        headers = dict(self.headers)
+        if get_header(headers, "Content-Length") is None:
+            headers["Content-Length"] = str(self.size)
+        headers["Age"] = str(int(max(0, now - self.stored_at)))
+        headers["X-Cache"] = cache_status
+        return headers
+
+
+def merge_revalidation(stored_headers, headers) -> dict:
+    """Apply the headers of a 304 to a stored header set."""
+    skip = _UNSHARED_HEADERS + ("content-length", "content-encoding",
+                                "transfer-encoding", "connection")
+    updates = {k: v for k, v in headers.items() if k.lower() not in skip}
+    lowered = {k.lower() for k in updates}
+    merged = {k: v for k, v in stored_headers.items() if k.lower() not in lowered}
+    merged.update(updates)
+    return merged
+
+
+class CacheEntry(StoredResponse):
+    __slots__ = ("chunks",)
+
+    def __init__(self, status, headers, chunks, lifetime, now=None):
+        self.chunks = tuple(chunks)
+        super().__init__(status, headers, sum(len(c) for c in self.chunks), lifetime, now)
+
+
+# ────────────────────────────────────────────────
+# Cache
+# ────────────────────────────────────────────────
+class AssetCache:
+    """Thread-safe LRU of CacheEntry objects bounded by total body bytes."""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_entry_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(
+            ("hits", "misses", "revalidations", "revalidated", "stores", "evictions",
+             "seeded", "bytes_served"), 0)
+
+    def _count(self, field, n=1):
+        with self._lock:
+            self._stats[field] += n
+
+    def lookup(self, key):
+        """Return the entry for key (fresh or stale) and record a hit or miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            self._stats["misses" if entry is None or not entry.is_fresh() else "hits"] += 1
+            return entry
+
+    def peek(self, key):
+        """Entry for key without counting a lookup or refreshing its LRU position."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key, entry):
+        if entry.size > self.max_entry_bytes:
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            self._stats["stores"] += 1
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self._stats["evictions"] += 1
+        return True
+
+    def revalidated(self, key, entry, headers, now=None):
+        """Apply a 304 from upstream: refresh headers and freshness in place."""
+        merged = merge_revalidation(entry.headers, headers)
+        lifetime = freshness_lifetime(merged, now)
+        self._count("revalidated")
+        if lifetime is None:
+            self.discard(key)
+            return entry
+        fresh = CacheEntry(entry.status, merged, entry.chunks, lifetime, now)
+        self.put(key, fresh)
+        return fresh
+
+    def note_revalidation(self):
+        self._count("revalidations")
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry.size
+
+    def serve(self, entry):
+        """Yield a cached body, counting the bytes served from memory."""
+        self._count("bytes_served", entry.size)
+        return iter(entry.chunks)
+
+    def tee(self, key, status, headers, chunks):
+        """Pass chunks through unchanged, storing them once the body completes.
+
+        Nothing is stored if the response is not cacheable, grows past
+        max_entry_bytes, or the client disconnects before the end.
+        """
+        lifetime = freshness_lifetime(headers) if status == 200 else None
+        if lifetime is None:
+            yield from chunks
+            return
+
+        parts = []
+        size = 0
+        complete = False
+        try:
+            for chunk in chunks:
+                if parts is not None:
+                    size += len(chunk)
+                    if size > self.max_entry_bytes:
+                        parts = None
+                    else:
+                        parts.append(chunk)
+                yield chunk
+            complete = True
+        finally:
+            if complete and parts is not None:
+                self.put(key, CacheEntry(status, headers, parts, lifetime))
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+
+    def seed(self, key, status, headers, body: bytes):
+        """Store a complete body fetched outside the proxy if it is cacheable."""
+        lifetime = freshness_lifetime(headers) if status == 200 else None
+        if lifetime is None or not self.put(key, CacheEntry(status, headers, (body,), lifetime)):
+            return False
+        self._count("seeded")
+        return True
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            info = dict(self._stats)
+            info.update(entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
+        lookups = info["hits"] + info["misses"]
+        info["hit_ratio"] = round(info["hits"] / lookups, 4) if lookups else 0.0
+        return info
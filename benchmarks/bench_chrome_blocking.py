@@ -0,0 +1,88 @@
+"""
+Benchmark: headless Chrome render time and bytes with and without resource blocking
+
+    python benchmarks/bench_chrome_blocking.py URL [URL ...] [--rounds 3] [--block image,font,media,analytics]
+
+Needs selenium and a local Chrome/chromedriver.  Each URL is rendered
+--rounds times with blocking off and on (alternating, same driver, readiness
+rule network_idle), and the medians of render time, requests, blocked
+requests and bytes received are printed per URL and overall.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+import chrome_render  # noqa: E402
+
+
+def make_driver():
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+
+    options = Options()
+    for arg in ("--headless", "--no-sandbox", "--disable-dev-shm-usage", "--disable-gpu",
+                "--window-size=1920,1080"):
+        options.add_argument(arg)
+    options.page_load_strategy = "eager"
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": True, "enablePage": False})
+    driver = webdriver.Chrome(options=options)
+    driver.set_page_load_timeout(30)
+    return driver
+
+
+def render(driver, url, patterns, timeout):
+    chrome_render.apply_blocking(driver, patterns)
+    driver.get("about:blank")
+    chrome_render.drain_network_log(driver)
+    instrumented = chrome_render.instrument(driver)
+    start = time.monotonic()
+    driver.get(url)
+    readiness = chrome_render.wait_until_ready(driver, chrome_render.ReadyRule(), start + timeout, instrumented)
+    driver.page_source
+    elapsed = time.monotonic() - start
+    summary = chrome_render.summarize_network(chrome_render.drain_network_log(driver))
+    summary.update(ms=elapsed * 1000, ready=readiness.ready)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("urls", nargs="+")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--block", default="image,font,media,analytics")
+    parser.add_argument("--timeout", type=float, default=15.0)
+    args = parser.parse_args()
+    patterns = chrome_render.block_patterns(args.block.split(","))
+
+    driver = make_driver()
+    totals = {"off": [], "on": []}
+    try:
+        print(f"{'url':<40}{'mode':>5}{'ms':>9}{'requests':>10}{'blocked':>9}{'KB':>9}")
+        for url in args.urls:
+            results = {"off": [], "on": []}
+            for _ in range(args.rounds):
+                for mode, mode_patterns in (("off", ()), ("on", patterns)):
+                    results[mode].append(render(driver, url, mode_patterns, args.timeout))
+            for mode, runs in results.items():
+                totals[mode].extend(runs)
+                med = {k: statistics.median(r[k] for r in runs) for k in ("ms", "requests", "blocked", "bytes")}
+                print(f"{url[:39]:<40}{mode:>5}{med['ms']:>9.0f}{med['requests']:>10.0f}"
+                      f"{med['blocked']:>9.0f}{med['bytes'] / 1024:>9.0f}")
+    finally:
+        driver.quit()
+
+    off = statistics.median(r["ms"] for r in totals["off"])
+    on = statistics.median(r["ms"] for r in totals["on"])
+    kb_off = sum(r["bytes"] for r in totals["off"]) / 1024
+    kb_on = sum(r["bytes"] for r in totals["on"]) / 1024
+    print(f"\nmedian render {off:.0f} ms → {on:.0f} ms with blocking; "
+          f"{kb_off:.0f} KB → {kb_on:.0f} KB received")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark: browser-per-slot vs tab-multiplexed Chrome pools
+
+    python benchmarks/bench_chrome_pool.py URL [URL ...] [--layouts 3x1,1x4,2x4] [--renders 40]
+
+Needs selenium and a local Chrome/chromedriver.  For each layout
+(browsers x tabs per browser) a DriverPool is filled, then --renders renders
+of the URLs run with as many concurrent workers as the layout has tabs.
+Reports throughput, median render time, peak RSS of all Chrome process trees
+and concurrent renders per GB of that RSS.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+import chrome_render  # noqa: E402
+from chrome_pool import DriverPool, driver_pid, process_tree_rss  # noqa: E402
+
+
+def make_driver():
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+
+    options = Options()
+    for arg in ("--headless", "--no-sandbox", "--disable-dev-shm-usage", "--disable-gpu",
+                "--window-size=1920,1080", "--disable-background-timer-throttling",
+                "--disable-backgrounding-occluded-windows", "--disable-renderer-backgrounding"):
+        options.add_argument(arg)
+    options.page_load_strategy = "eager"
+    driver = webdriver.Chrome(options=options)
+    driver.set_page_load_timeout(30)
+    return driver
+
+
+def render(pool, url, timeout, times):
+    tab = pool.get_driver()
+    try:
+        instrumented = chrome_render.instrument(tab)
+        chrome_render.apply_blocking(tab, chrome_render.block_patterns(("image", "font", "media")))
+        start = time.monotonic()
+        tab.get(url)
+        chrome_render.wait_until_ready(tab, chrome_render.ReadyRule(), start + timeout, instrumented)
+        tab.page_source
+        times.append(time.monotonic() - start)
+    finally:
+        pool.return_driver(tab)
+
+
+def bench(layout, args):
+    browsers, tabs = (int(n) for n in layout.split("x"))
+    pool = DriverPool(make_driver, size=browsers, max_size=browsers, tabs_per_driver=tabs,
+                      max_pages=0, max_rss_mb=0, check_interval=3600).start()
+    peak = [0]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            with pool.lock:
+                drivers = [b.driver for b in pool._browsers.values()]
+            peak[0] = max(peak[0], sum(process_tree_rss(driver_pid(d)) or 0 for d in drivers))
+            time.sleep(0.2)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    times, queue = [], [args.urls[i % len(args.urls)] for i in range(args.renders)]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                url = queue.pop()
+            render(pool, url, args.timeout, times)
+
+    start = time.monotonic()
+    workers = [threading.Thread(target=worker) for _ in range(browsers * tabs)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.monotonic() - start
+    done.set()
+    sampler.join()
+    pool.shutdown()
+    gb = peak[0] / 1024 ** 3 or float("nan")
+    return browsers * tabs, len(times) / elapsed, statistics.median(times) * 1000, peak[0] / 1048576, browsers * tabs / gb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("urls", nargs="+")
+    parser.add_argument("--layouts", default="3x1,1x4,2x4")
+    parser.add_argument("--renders", type=int, default=40)
+    parser.add_argument("--timeout", type=float, default=15.0)
+    args = parser.parse_args()
+
+    print(f"{'layout':<8}{'slots':>6}{'renders/s':>11}{'p50 ms':>9}{'peak RSS MB':>13}{'slots/GB':>10}")
+    for layout in args.layouts.split(","):
+        slots, rate, p50, rss, per_gb = bench(layout, args)
+        print(f"{layout:<8}{slots:>6}{rate:>11.2f}{p50:>9.0f}{rss:>13.0f}{per_gb:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Benchmark: Flask-side fetches direct over the pooled client vs through the TCP proxy
+
+    python benchmarks/bench_fetch_modes.py [--requests 2000] [--concurrency 8] [--size 16384]
+
+Starts a keep-alive HTTP/1.1 backend and each TCP proxy engine in their own
+processes, then issues --requests GETs from --concurrency threads with the
+same upstream.UpstreamClient that fetch_with_requests uses: once directly
+(Config.FETCH_VIA_TCP_PROXY = False) and once per engine with proxies=
+pointing at the local proxy (the old path).  Reports latency percentiles,
+throughput and how many new connections the client had to open.
+
+The threaded engine relays a plain-HTTP response until the upstream closes,
+so with a keep-alive backend every request would stall for the socket
+timeout; it is driven with Connection: close (one connection and one proxy
+thread per request), which is how that path behaved in production.
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+import tcp_proxy  # noqa: E402
+import upstream  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+
+
+def run_backend(port, size):
+    body = os.urandom(size)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # headers and body are separate writes
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def run_proxy(engine, port):
+    import logging
+    logging.basicConfig(level=logging.CRITICAL)
+    if engine == "threaded":
+        tcp_proxy.serve_threaded("127.0.0.1", port, socket_timeout=10)
+    else:
+        tcp_proxy.AsyncTcpProxy("127.0.0.1", port).run()
+
+
+def drive(args, url, proxies, headers):
+    client = upstream.UpstreamClient(pool_maxsize=args.concurrency)
+    client.get(url, proxies=proxies, headers=headers).content  # warm up one connection
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            client.get(url, proxies=proxies, headers=headers, timeout=10).content
+        except Exception:
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(one, range(args.requests)))
+    total = time.perf_counter() - start
+    info = client.snapshot()
+    client.close()
+    latencies = sorted(r for r in results if r is not None)
+    return latencies, total, info["pool_misses"], len(results) - len(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--size", type=int, default=16384)
+    parser.add_argument("--modes", default="direct,asyncio,threaded")
+    args = parser.parse_args()
+
+    backend_port = free_port()
+    backend = multiprocessing.Process(target=run_backend, args=(backend_port, args.size), daemon=True)
+    backend.start()
+    wait_for_port(backend_port)
+    url = f"http://127.0.0.1:{backend_port}/asset"
+
+    print(f"{args.requests} GETs of {args.size} bytes from {args.concurrency} threads\n")
+    print(f"{'mode':<10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'mean ms':>9}{'req/s':>9}"
+          f"{'new conns':>11}{'failed':>8}")
+    for mode in args.modes.split(","):
+        proc = None
+        proxies = None
+        if mode != "direct":
+            port = free_port()
+            proc = multiprocessing.Process(target=run_proxy, args=(mode, port), daemon=True)
+            proc.start()
+            wait_for_port(port)
+            proxies = {"http": f"http://127.0.0.1:{port}", "https": f"http://127.0.0.1:{port}"}
+        try:
+            headers = {"Connection": "close"} if mode == "threaded" else None
+            lat, total, misses, failed = drive(args, url, proxies, headers)
+        finally:
+            if proc is not None:
+                proc.kill()
+                proc.join()
+        ms = [x * 1000 for x in lat]
+        print(f"{mode:<10}{statistics.median(ms):>9.2f}{ms[int(len(ms) * 0.95) - 1]:>9.2f}"
+              f"{ms[int(len(ms) * 0.99) - 1]:>9.2f}{statistics.fmean(ms):>9.2f}"
+              f"{len(ms) / total:>9.0f}{misses:>11}{failed:>8}")
+
+    backend.kill()
+
+
+if __name__ == "__main__":
+    main()
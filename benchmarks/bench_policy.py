@@ -0,0 +1,82 @@
+"""
+Benchmark: compiled HostPolicy vs the linear matchers it replaced
+
+    python benchmarks/bench_policy.py [--sizes 10,1000,100000,500000] [--lookups 20000]
+
+For each list size builds N domains plus N/10 CIDRs, then times per-lookup
+cost for the old substring scan (`entry in host` over the list), the
+compiled trie with a cold verdict cache, and the same hosts again with a
+warm cache.  Compile time and the linear scan's blow-up are reported too.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from policy import HostPolicy  # noqa: E402
+
+
+def build_lists(n, rng):
+    domains = [f"ads{i}.tracker{i % 97}.example{i % 13}.com" for i in range(n)]
+    networks = [f"{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.0/24"
+                for _ in range(max(1, n // 10))]
+    return domains, networks
+
+
+def build_hosts(count, domains, rng):
+    hosts = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            hosts.append("www." + rng.choice(domains))            # blocked subdomain
+        elif kind == 1:
+            hosts.append(f"site{i}.unlisted{i % 50}.org")        # miss
+        elif kind == 2:
+            hosts.append(f"{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.7")
+        else:
+            hosts.append("not" + rng.choice(domains))            # near miss
+    return hosts
+
+
+def per_lookup_us(fn, hosts):
+    start = time.perf_counter()
+    for host in hosts:
+        fn(host)
+    return (time.perf_counter() - start) / len(hosts) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10,1000,100000,500000")
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--linear-max", type=int, default=100000,
+                        help="skip the linear scan above this many entries")
+    args = parser.parse_args()
+    rng = random.Random(1)
+
+    print(f"{'entries':>9}{'compile s':>11}{'linear us':>11}{'cold us':>9}{'warm us':>9}")
+    for n in (int(s) for s in args.sizes.split(",")):
+        domains, networks = build_lists(n, rng)
+        hosts = build_hosts(args.lookups, domains, rng)
+
+        start = time.perf_counter()
+        policy = HostPolicy(cache_size=args.lookups * 2, block=domains + networks)
+        compile_s = time.perf_counter() - start
+
+        cold = per_lookup_us(policy.matches, hosts)
+        warm = per_lookup_us(policy.matches, hosts)
+        if n <= args.linear_max:
+            entries = domains + networks
+            sample = hosts[:max(10, args.lookups * 10 // max(n, 1))]
+            linear = per_lookup_us(lambda h: any(e in h for e in entries), sample)
+            linear_s = f"{linear:>11.1f}"
+        else:
+            linear_s = f"{'-':>11}"
+        print(f"{n:>9}{compile_s:>11.2f}{linear_s}{cold:>9.2f}{warm:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
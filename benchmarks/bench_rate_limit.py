@@ -0,0 +1,175 @@
+"""
+Benchmark: per-client rate limiter memory and check latency vs number of distinct clients
+
+    python benchmarks/bench_rate_limit.py [--clients 1000000] [--sample 20000] [--legacy-max 1000000]
+                                          [--workers 4]
+
+Feeds --clients distinct IPv4 addresses, one request each, into the GCRA
+limiter (rate_limit.RateLimiter), the shared-memory one every worker maps
+(shared_state.SharedRateLimiter) and the deque-per-IP limiter that
+3.1/app_with_chrome.py used before.  At each checkpoint it reports the
+memory the limiter holds (tracemalloc, key strings excluded: they exist
+before the run; the shared table is a fixed-size mapping outside the Python
+heap) and the cost of one check: for --sample new clients and for --sample
+repeat requests from random known clients.  It then times one sweep that
+evicts every idle key, and has --workers forked processes hammer the same
+clients through each limiter to show how many requests get through.
+"""
+
+import argparse
+import gc
+import itertools
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+import rate_limit  # noqa: E402
+import shared_state  # noqa: E402
+
+
+class LegacyRateLimiter:
+    """The deque-of-timestamps limiter formerly in 3.1/app_with_chrome.py."""
+
+    def __init__(self, max_requests=60, window=60):
+        self.max_requests = max_requests
+        self.window = window
+        self.requests = defaultdict(deque)
+        self.lock = threading.Lock()
+
+    def is_allowed(self, identifier):
+        now = time.time()
+        with self.lock:
+            while self.requests[identifier] and now - self.requests[identifier][0] >= self.window:
+                self.requests[identifier].popleft()
+            if len(self.requests[identifier]) >= self.max_requests:
+                return False
+            self.requests[identifier].append(now)
+            return True
+
+
+def make_ips(n):
+    return [f"{10 + (i >> 24)}.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}" for i in range(n)]
+
+
+def checkpoints(clients):
+    points, n = [], 1000
+    while n < clients:
+        points.append(n)
+        n *= 10
+    return points + [clients]
+
+
+def per_check_ns(fn, keys):
+    start = time.perf_counter_ns()
+    for key in keys:
+        fn(key)
+    return (time.perf_counter_ns() - start) / len(keys)
+
+
+def run(name, limiter, ips, points, sample, track_memory):
+    """Fill to each checkpoint; returns rows of (clients, bytes, new ns, repeat ns)."""
+    rows = []
+    filled = 0
+    rng = random.Random(1)
+    check = limiter.is_allowed
+    if track_memory:
+        gc.collect()
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+    for point in points:
+        lead = max(filled, point - sample)
+        for key in ips[filled:lead]:
+            check(key)
+        new_ns = per_check_ns(check, ips[lead:point])
+        filled = point
+        repeat_ns = per_check_ns(check, [ips[rng.randrange(filled)] for _ in range(sample)])
+        used = tracemalloc.get_traced_memory()[0] - base if track_memory else None
+        rows.append((point, used, new_ns, repeat_ns))
+    if track_memory:
+        tracemalloc.stop()
+    return rows
+
+
+def hammer(limiter, clients, per_client, results):
+    check = limiter.is_allowed
+    start = time.perf_counter_ns()
+    allowed = sum(check(ip) for _ in range(per_client) for ip in clients)
+    results.put((allowed, (time.perf_counter_ns() - start) / (per_client * len(clients))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1_000_000)
+    parser.add_argument("--sample", type=int, default=20_000)
+    parser.add_argument("--legacy-max", type=int, default=1_000_000,
+                        help="stop the deque limiter at this many clients (it needs ~700 B each)")
+    parser.add_argument("--limit", type=int, default=2000, help="requests per window (Config.RATE_LIMIT)")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    shm_dir = tempfile.mkdtemp(dir=shared_state.DEFAULT_DIR)
+    shm_paths = (os.path.join(shm_dir, str(n)) for n in itertools.count())
+
+    ips = make_ips(args.clients)
+    points = checkpoints(args.clients)
+    print(f"{args.clients} distinct clients, {args.limit} requests / 60 s each\n")
+    print(f"{'limiter':<8}{'clients':>10}{'memory':>12}{'B/client':>10}{'new ns':>9}{'repeat ns':>11}")
+
+    limiters = [("gcra", lambda: rate_limit.RateLimiter(args.limit, 60)),
+                ("shm", lambda: shared_state.SharedRateLimiter(next(shm_paths), args.limit, 60)),
+                ("deque", lambda: LegacyRateLimiter(args.limit, 60))]
+    for name, factory in limiters:
+        limit_points = [p for p in points if name != "deque" or p <= args.legacy_max]
+        if not limit_points:
+            continue
+        # Timing and memory come from separate runs: tracemalloc slows every allocation
+        timed = run(name, factory(), ips, limit_points, args.sample, track_memory=False)
+        gc.collect()
+        measured = run(name, factory(), ips, limit_points, args.sample, track_memory=True)
+        gc.collect()
+        for (clients, _, new_ns, repeat_ns), (_, used, _, _) in zip(timed, measured):
+            print(f"{name:<8}{clients:>10}{used / 2**20:>10.1f}MB{used / clients:>10.0f}"
+                  f"{new_ns:>9.0f}{repeat_ns:>11.0f}")
+
+    limiter = rate_limit.RateLimiter(args.limit, 60)
+    for key in ips:
+        limiter.is_allowed(key)
+    start = time.perf_counter()
+    evicted = limiter.sweep(now=time.monotonic() + 60)
+    elapsed = time.perf_counter() - start
+    print(f"\nsweep evicted {evicted} idle clients in {elapsed * 1000:.0f} ms "
+          f"({elapsed / len(limiter._shards) * 1000:.1f} ms per shard lock hold); {len(limiter)} left")
+
+    # Every worker sends the whole budget for the same 100 clients
+    clients = ips[:100]
+    print(f"\n{args.workers} workers x {args.limit} requests for each of {len(clients)} clients "
+          f"(budget {args.limit} each)")
+    print(f"{'limiter':<8}{'allowed/client':>16}{'ns/check':>10}")
+    fork = multiprocessing.get_context("fork")
+    for name, factory in (("gcra", lambda: rate_limit.RateLimiter(args.limit, 60)),
+                          ("shm", lambda: shared_state.SharedRateLimiter(next(shm_paths), args.limit, 60))):
+        limiter = factory()  # created before the fork, as under gunicorn --preload
+        results = fork.Queue()
+        procs = [fork.Process(target=hammer, args=(limiter, clients, args.limit, results))
+                 for _ in range(args.workers)]
+        for p in procs:
+            p.start()
+        outcome = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+        allowed = sum(a for a, _ in outcome)
+        ns = statistics.fmean(n for _, n in outcome)
+        print(f"{name:<8}{allowed / len(clients):>16.0f}{ns:>10.0f}")
+    shutil.rmtree(shm_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
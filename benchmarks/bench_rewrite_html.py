@@ -0,0 +1,96 @@
+"""
+Benchmark: tokenizer rewrite_proxy_links() vs the BeautifulSoup rewrite path
+
+    python benchmarks/bench_rewrite_html.py [--size-mb 2] [--rounds 5]
+
+Builds a synthetic Chrome-sized DOM, checks that both rewriters produce the
+same attribute values (tag by tag), then times each one.
+"""
+
+import argparse
+import os
+import sys
+import time
+from html.parser import HTMLParser
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from html_rewrite import proxify_url, rewrite_links_soup, rewrite_proxy_links  # noqa: E402
+
+BLOCK = """
+<div class="card" data-id="{i}">
+  <a href="/item/{i}?ref=home&amp;page={p}">Item {i}</a>
+  <a href="https://cdn{c}.example.net/assets/{i}.html" target="_blank">mirror</a>
+  <img src="//img.example.net/thumbs/{i}.jpg" alt="thumb {i} &gt; preview" loading=lazy>
+  <img src=relative/{i}.png>
+  <a href="#comments-{i}">comments</a> <a href="javascript:void(0)">share</a>
+  <form action="/vote/{i}" method="post"><input type="submit" value="+1"></form>
+  <!-- <a href="/hidden/{i}">old link</a> -->
+  <script>var u{i} = '<a href="/in-script/{i}">';</script>
+  <p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.</p>
+</div>"""
+
+
+def build_page(size_mb):
+    target = int(size_mb * 1024 * 1024)
+    parts = ["<!DOCTYPE html><html><head><link rel=stylesheet href=/static/site.css>"
+             "<style>body{background:url(/bg.png)}</style></head><body>"]
+    total = 0
+    i = 0
+    while total < target:
+        block = BLOCK.format(i=i, p=i % 7, c=i % 3)
+        parts.append(block)
+        total += len(block)
+        i += 1
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+class _AttrCollector(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tags = []
+
+    def handle_starttag(self, tag, attrs):
+        self.tags.append((tag, sorted(attrs, key=lambda kv: kv[0])))
+
+
+def attributes(html_text):
+    collector = _AttrCollector()
+    collector.feed(html_text)
+    collector.close()
+    return collector.tags
+
+
+def timed(fn, *args, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        proxify_url.cache_clear()
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=2.0)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    base_url = "https://www.example.com/section/"
+    page = build_page(args.size_mb)
+    print(f"page: {len(page) / 1024 / 1024:.2f} MB, best of {args.rounds} rounds")
+
+    soup_time, soup_out = timed(rewrite_links_soup, base_url, page, rounds=args.rounds)
+    lex_time, lex_out = timed(rewrite_proxy_links, base_url, page, rounds=args.rounds)
+
+    same = attributes(soup_out) == attributes(lex_out)
+    print(f"attribute values identical: {same}")
+    print(f"beautifulsoup : {soup_time * 1000:8.1f} ms")
+    print(f"tokenizer     : {lex_time * 1000:8.1f} ms   ({soup_time / lex_time:.1f}x faster)")
+    if not same:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
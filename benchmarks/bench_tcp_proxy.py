@@ -0,0 +1,191 @@
+"""
+Benchmark: asyncio TCP proxy engine vs the thread-per-connection engine
+
+    python benchmarks/bench_tcp_proxy.py [--tunnels 2000] [--messages 5] [--size 4096]
+
+Starts an echo backend and each proxy engine in their own processes, opens
+--tunnels concurrent CONNECT tunnels through the proxy (all held open at the
+same time), runs --messages echo round trips of --size bytes on each, and
+reports setup time, round-trip latency, failures and the proxy's peak RSS and
+thread count (Linux /proc).  The threaded engine runs with --threaded-backlog
+(5 by default, as the original listen(5)).
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+import tcp_proxy  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_echo(port, ready):
+    tcp_proxy.raise_fd_limit()
+
+    async def echo(reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(echo, "127.0.0.1", port, backlog=4096)
+        ready.set()
+        await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def run_proxy(engine, port, backlog):
+    import logging
+    logging.basicConfig(level=logging.CRITICAL)
+    tcp_proxy.raise_fd_limit()
+    if engine == "threaded":
+        tcp_proxy.serve_threaded("127.0.0.1", port, backlog, socket_timeout=10)
+    else:
+        tcp_proxy.AsyncTcpProxy("127.0.0.1", port, backlog=backlog).run()
+
+
+def proc_status(pid):
+    info = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "Threads"):
+                    info[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return info
+
+
+async def tunnel(proxy_port, echo_port, messages, payload, opened, release, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+    try:
+        writer.write(f"CONNECT 127.0.0.1:{echo_port} HTTP/1.1\r\n\r\n".encode())
+        status = await reader.readuntil(b"\r\n\r\n")
+        if b" 200 " not in status:
+            raise ConnectionError(status[:40])
+        opened.append(1)
+        await release.wait()
+        for _ in range(messages):
+            start = time.perf_counter()
+            writer.write(payload)
+            await reader.readexactly(len(payload))
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def drive(args, proxy_pid, proxy_port, echo_port):
+    payload = os.urandom(args.size)
+    opened, latencies = [], []
+    release = asyncio.Event()
+    peak = {"VmRSS": 0, "Threads": 0}
+
+    async def sample():
+        while True:
+            for key, value in proc_status(proxy_pid).items():
+                peak[key] = max(peak[key], value)
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample())
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(tunnel(proxy_port, echo_port, args.messages, payload,
+                                        opened, release, latencies))
+             for _ in range(args.tunnels)]
+    while len(opened) + sum(t.done() for t in tasks) < args.tunnels:
+        await asyncio.sleep(0.01)
+        if time.perf_counter() - start > args.timeout:
+            break
+    setup = time.perf_counter() - start
+    concurrent = len(opened)
+    release.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    total = time.perf_counter() - start
+    sampler.cancel()
+    failed = sum(isinstance(r, BaseException) for r in results)
+    return {
+        "concurrent": concurrent,
+        "failed": failed,
+        "setup_s": setup,
+        "total_s": total,
+        "latencies": sorted(latencies),
+        "peak": peak,
+    }
+
+
+def bench(engine, args, echo_port):
+    port = free_port()
+    backlog = args.threaded_backlog if engine == "threaded" else args.backlog
+    proc = multiprocessing.Process(target=run_proxy, args=(engine, port, backlog), daemon=True)
+    proc.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    try:
+        return asyncio.run(drive(args, proc.pid, port, echo_port))
+    finally:
+        proc.kill()
+        proc.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tunnels", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--backlog", type=int, default=1024)
+    parser.add_argument("--threaded-backlog", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--engines", default="threaded,asyncio")
+    args = parser.parse_args()
+
+    limit = tcp_proxy.raise_fd_limit()
+    if limit and args.tunnels + 64 > limit:
+        sys.exit(f"open-files limit {limit} is too low for {args.tunnels} tunnels")
+
+    ready = multiprocessing.Event()
+    echo_port = free_port()
+    echo = multiprocessing.Process(target=run_echo, args=(echo_port, ready), daemon=True)
+    echo.start()
+    ready.wait(10)
+
+    print(f"{args.tunnels} tunnels x {args.messages} round trips of {args.size} bytes\n")
+    print(f"{'engine':<10}{'held':>7}{'failed':>8}{'setup s':>9}{'total s':>9}"
+          f"{'p50 ms':>9}{'p99 ms':>9}{'MB/s':>8}{'RSS MB':>8}{'threads':>9}")
+    for engine in args.engines.split(","):
+        r = bench(engine, args, echo_port)
+        lat = r["latencies"]
+        p50 = statistics.median(lat) * 1000 if lat else float("nan")
+        p99 = lat[int(len(lat) * 0.99) - 1] * 1000 if lat else float("nan")
+        mbps = len(lat) * args.size * 2 / r["total_s"] / 1e6
+        print(f"{engine:<10}{r['concurrent']:>7}{r['failed']:>8}{r['setup_s']:>9.2f}{r['total_s']:>9.2f}"
+              f"{p50:>9.2f}{p99:>9.2f}{mbps:>8.1f}{r['peak']['VmRSS'] / 1024:>8.1f}{r['peak']['Threads']:>9}")
+
+    echo.kill()
+
+
+if __name__ == "__main__":
+    main()
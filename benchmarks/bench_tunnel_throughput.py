@@ -0,0 +1,155 @@
+"""
+Benchmark: CONNECT tunnel throughput and CPU per GB for each relay mode
+
+    python benchmarks/bench_tunnel_throughput.py [--mb 1024] [--streams 1] [--direction down]
+
+A local source/sink pair moves --mb megabytes per tunnel through the proxy
+(running in its own process) for the threaded engine and every asyncio relay
+mode (stream, recv_into, splice).  Reports MB/s and the proxy process's CPU
+seconds per GB, read from /proc/<pid>/stat (Linux).
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+import tcp_proxy  # noqa: E402
+
+CHUNK = 1024 * 1024
+MODES = ("threaded", tcp_proxy.RELAY_STREAM, tcp_proxy.RELAY_RECV_INTO, tcp_proxy.RELAY_SPLICE)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def send_bytes(sock, total):
+    view = memoryview(b"\0" * CHUNK)
+    remaining = total
+    while remaining:
+        n = min(remaining, CHUNK)
+        sock.sendall(view[:n])
+        remaining -= n
+
+
+def drain(sock):
+    buf = bytearray(CHUNK)
+    total = 0
+    while True:
+        n = sock.recv_into(buf)
+        if not n:
+            return total
+        total += n
+
+
+def run_backend(port, total, direction):
+    """Source (down) or sink (up) server; closes each connection when done."""
+    server = socket.create_server(("127.0.0.1", port), backlog=128)
+
+    def serve(conn):
+        with conn:
+            if direction == "down":
+                send_bytes(conn, total)
+            else:
+                received = drain(conn)
+                conn.sendall(str(received).encode())
+
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+
+def run_proxy(mode, port):
+    import logging
+    logging.basicConfig(level=logging.CRITICAL)
+    if mode == "threaded":
+        tcp_proxy.serve_threaded("127.0.0.1", port, 128, socket_timeout=30)
+    else:
+        tcp_proxy.AsyncTcpProxy("127.0.0.1", port, relay_mode=mode).run()
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def one_tunnel(proxy_port, backend_port, total, direction, results):
+    with socket.create_connection(("127.0.0.1", proxy_port)) as sock:
+        sock.sendall(f"CONNECT 127.0.0.1:{backend_port} HTTP/1.1\r\n\r\n".encode())
+        head = b""
+        while b"\r\n\r\n" not in head:
+            head += sock.recv(1)
+        if direction == "down":
+            results.append(drain(sock))
+        else:
+            send_bytes(sock, total)
+            sock.shutdown(socket.SHUT_WR)  # half-close; the sink replies with its count
+            results.append(int(sock.recv(64) or 0))
+
+
+def bench(mode, args, backend_port, total):
+    port = free_port()
+    proc = multiprocessing.Process(target=run_proxy, args=(mode, port), daemon=True)
+    proc.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    try:
+        results = []
+        cpu_before = cpu_seconds(proc.pid)
+        start = time.perf_counter()
+        threads = [threading.Thread(target=one_tunnel,
+                                    args=(port, backend_port, total, args.direction, results))
+                   for _ in range(args.streams)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        cpu = cpu_seconds(proc.pid) - cpu_before
+    finally:
+        proc.kill()
+        proc.join()
+    moved = sum(results)
+    ok = moved == total * args.streams
+    return moved, elapsed, cpu, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mb", type=int, default=1024, help="megabytes per tunnel")
+    parser.add_argument("--streams", type=int, default=1, help="concurrent tunnels")
+    parser.add_argument("--direction", choices=("down", "up"), default="down")
+    parser.add_argument("--modes", default=",".join(MODES))
+    args = parser.parse_args()
+
+    total = args.mb * 1024 * 1024
+    backend_port = free_port()
+    backend = multiprocessing.Process(target=run_backend, args=(backend_port, total, args.direction),
+                                      daemon=True)
+    backend.start()
+    time.sleep(0.3)
+
+    print(f"{args.streams} x {args.mb} MB {args.direction} through the proxy\n")
+    print(f"{'mode':<12}{'MB/s':>9}{'proxy CPU s':>13}{'CPU s/GB':>10}  complete")
+    for mode in args.modes.split(","):
+        moved, elapsed, cpu, ok = bench(mode, args, backend_port, total)
+        gb = moved / 1024 ** 3 or float("nan")
+        print(f"{mode:<12}{moved / elapsed / 1e6:>9.1f}{cpu:>13.2f}{cpu / gb:>10.2f}  {'yes' if ok else 'NO'}")
+
+    backend.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+# chrome_pool.py - autoscaled pool of browser tabs with health checks and recycling
+#
+# The Chrome pool used to probe liveness with driver.current_url while holding
+# its lock, so a dead pool stalled every request behind inline Chrome
+# start-ups, and drivers lived forever while their RSS crept into gigabytes.
+# Here a maintenance thread does the probing on idle browsers, retires them
+# after max_pages renders, max_age seconds or max_rss_mb of process-tree RSS,
+# and starts replacements before requests need them.
+#
+# One browser per render slot also capped concurrency at the pool size while
+# each slot cost hundreds of MB.  Each browser now carries tabs_per_driver
+# tabs; a checkout hands out a Tab, a driver-like view that switches the
+# browser to its window before every command and navigates with CDP
+# Page.navigate so one tab's page load does not hold the others up.  The pool
+# grows from min_size towards max_size browsers while renders wait for a free
+# tab and shrinks back after idle_timeout.  The pool is Selenium-agnostic: it
+# takes a factory and only uses the WebDriver calls listed on Tab.
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_tree_rss(pid):
+    """Resident bytes of pid and all its descendants (Linux /proc), or None."""
+    if not isinstance(pid, int) or not os.path.isdir("/proc"):
+        return None
+    children, rss = {}, {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        rss[int(entry)] = int(fields[21]) * _PAGE_SIZE
+    if pid not in rss:
+        return None
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        total += rss.get(current, 0)
+        stack.extend(children.get(current, ()))
+    return total
+
+
+def driver_pid(driver):
+    """PID of the chromedriver service process (Chrome runs beneath it)."""
+    process = getattr(getattr(driver, "service", None), "process", None)
+    return getattr(process, "pid", None)
+
+
+def _quit(driver):
+    try:
+        driver.quit()
+    except Exception:
+        pass
+
+
+# ────────────────────────────────────────────────
+# Browsers and tabs
+# ────────────────────────────────────────────────
+class Tab:
+    """One tab of a pooled browser, usable where a WebDriver is expected.
+
+    Commands are serialized per browser; the window is switched only when the
+    previous command went to another tab.
+    """
+
+    def __init__(self, browser, handle):
+        self.browser = browser
+        self.handle = handle
+
+    def _call(self, fn, *args):
+        browser = self.browser
+        with browser.command_lock:
+            if browser.current != self.handle:
+                browser.driver.switch_to.window(self.handle)
+                browser.current = self.handle
+            return fn(*args)
+
+    def get(self, url):
+        if len(self.browser.tabs) == 1:
+            return self._call(self.browser.driver.get, url)
+        # returns once the navigation commits instead of blocking the browser until load
+        return self._call(self.browser.driver.execute_cdp_cmd, "Page.navigate", {"url": url})
+
+    def execute_script(self, script, *args):
+        return self._call(self.browser.driver.execute_script, script, *args)
+
+    def execute_cdp_cmd(self, cmd, params):
+        return self._call(self.browser.driver.execute_cdp_cmd, cmd, params)
+
+    @property
+    def page_source(self):
+        return self._call(lambda: self.browser.driver.page_source)
+
+    @property
+    def current_url(self):
+        return self._call(lambda: self.browser.driver.current_url)
+
+    def get_log(self, kind):
+        return self.browser.take_log(self.handle, kind)
+
+
+class PooledDriver:
+    """A browser process and its tabs: age, renders, last health check and RSS."""
+
+    def __init__(self, driver, driver_id, handles):
+        self.driver = driver
+        self.id = driver_id
+        self.created = time.monotonic()
+        self.last_check = self.last_used = self.created
+        self.pages = 0
+        self.rss = None
+        self.draining = False       # retire once its last busy tab comes back
+        self.suspect = False        # a render failed; health-check before reuse
+        self.checking = False
+        self.command_lock = threading.RLock()
+        self.current = handles[0] if handles else None
+        self.tabs = [Tab(self, handle) for handle in handles]
+        self.free = list(self.tabs)
+        self._logs = {}             # window handle -> buffered log entries
+
+    @property
+    def busy(self):
+        return len(self.tabs) - len(self.free)
+
+    def available(self):
+        return bool(self.free) and not (self.draining or self.suspect or self.checking)
+
+    def age(self, now=None):
+        return (time.monotonic() if now is None else now) - self.created
+
+    def take_log(self, handle, kind):
+        """Log entries of one tab; other tabs' entries stay buffered for them."""
+        with self.command_lock:
+            entries = self.driver.get_log(kind) or []
+            if len(self.tabs) == 1:
+                return entries
+            for entry in entries:
+                try:
+                    owner = json.loads(entry["message"]).get("webview")
+                except (KeyError, TypeError, ValueError):
+                    owner = None
+                self._logs.setdefault(owner or handle, []).append(entry)
+            return self._logs.pop(handle, [])
+
+    def info(self, now):
+        return {
+            "id": self.id,
+            "state": "draining" if self.draining else "busy" if self.busy else "idle",
+            "tabs": len(self.tabs),
+            "busy_tabs": self.busy,
+            "age_s": round(self.age(now), 1),
+            "pages": self.pages,
+            "rss_mb": round(self.rss / 1048576, 1) if self.rss is not None else None,
+        }
+
+
+def open_tabs(driver, count):
+    """Window handles of `count` tabs in driver (the first is the existing window)."""
+    handles = [driver.current_window_handle]
+    for _ in range(count - 1):
+        driver.switch_to.new_window("tab")
+        handles.append(driver.current_window_handle)
+    if count > 1:
+        driver.switch_to.window(handles[0])
+    return handles
+
+
+# ────────────────────────────────────────────────
+# Pool
+# ────────────────────────────────────────────────
+class DriverPool:
+    """Keeps min_size..max_size healthy browsers of tabs_per_driver tabs;
+    get_driver() never probes, and only starts a browser when every tab is busy."""
+
+    def __init__(self, factory, size=3, max_size=None, tabs_per_driver=1, max_pages=100,
+                 max_age=1800, max_rss_mb=1024, check_interval=15.0, idle_timeout=120.0,
+                 rss_probe=process_tree_rss):
+        self.factory = factory
+        self.min_size = size
+        self.max_size = max(size, max_size or size)
+        self.tabs_per_driver = max(1, tabs_per_driver)
+        self.max_pages = max_pages
+        self.max_age = max_age
+        self.max_rss = max_rss_mb * 1048576 if max_rss_mb else None
+        self.check_interval = check_interval
+        self.idle_timeout = idle_timeout
+        self.rss_probe = rss_probe
+        self.lock = threading.Lock()
+        self._cond = threading.Condition(self.lock)
+        self._browsers = {}         # id -> PooledDriver
+        self._spawning = 0
+        self._waiting = 0
+        self._next_id = 0
+        self._stats = dict.fromkeys(
+            ("created", "create_failures", "checkouts", "inline_creates", "waits", "wait_timeouts",
+             "health_checks", "health_failures", "retired_dead", "retired_pages", "retired_age",
+             "retired_rss", "retired_idle"), 0)
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    # ── lifecycle ──
+    def start(self):
+        """Start min_size browsers, then keep the pool healthy from a background thread."""
+        self._top_up()
+        logger.info(f"Chrome pool ready: {len(self._browsers)} browsers x {self.tabs_per_driver} tabs")
+        self._thread = threading.Thread(target=self._maintain, name="driver-pool", daemon=True)
+        self._thread.start()
+        return self
+
+    def shutdown(self):
+        self._stopped.set()
+        self._wake.set()
+        with self._cond:
+            browsers = list(self._browsers.values())
+            self._browsers.clear()
+            self._cond.notify_all()
+        for browser in browsers:
+            _quit(browser.driver)
+
+    def _spawn(self):
+        """Start a browser and register it; the caller has counted it in _spawning."""
+        driver = self.factory()
+        handles = None
+        if driver is not None:
+            try:
+                handles = open_tabs(driver, self.tabs_per_driver)
+            except Exception as e:
+                logger.error(f"Could not open tabs: {e}")
+                _quit(driver)
+        with self._cond:
+            self._spawning -= 1
+            if not handles:
+                self._stats["create_failures"] += 1
+                return None
+            self._next_id += 1
+            browser = PooledDriver(driver, self._next_id, handles)
+            self._browsers[browser.id] = browser
+            self._stats["created"] += 1
+            self._cond.notify_all()
+        return browser
+
+    def _retire(self, browser, reason=None):
+        with self._cond:
+            if self._browsers.pop(browser.id, None) is None:
+                return
+            if reason:
+                self._stats[f"retired_{reason}"] += 1
+        if reason:
+            logger.info(f"Retiring Chrome browser #{browser.id} ({reason}: {browser.pages} pages, "
+                        f"{browser.age():.0f}s old)")
+        _quit(browser.driver)
+        self._wake.set()
+
+    # ── request path ──
+    def _free_tab(self):
+        # pack renders onto the busiest browser so idle ones can be shrunk away
+        candidates = [b for b in self._browsers.values() if b.available()]
+        if not candidates:
+            return None
+        browser = max(candidates, key=lambda b: b.busy)
+        browser.last_used = time.monotonic()
+        return browser.free.pop()
+
+    def get_driver(self, timeout=None):
+        """A free tab; starts a browser if all are busy and the pool is below
+        max_size, else waits up to timeout (None: no limit) and returns None."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._stats["checkouts"] += 1
+            waited = False
+            while True:
+                tab = self._free_tab()
+                if tab is not None:
+                    return tab
+                if len(self._browsers) + self._spawning < self.max_size:
+                    self._spawning += 1
+                    self._stats["inline_creates"] += 1
+                    break
+                if self._stopped.is_set():
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._stats["wait_timeouts"] += 1
+                    return None
+                if not waited:
+                    waited = True
+                    self._stats["waits"] += 1
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+        logger.warning("No free Chrome tab, starting a browser")
+        self._wake.set()
+        browser = self._spawn()
+        with self._cond:
+            if browser is not None and browser.id in self._browsers and browser.free:
+                browser.last_used = time.monotonic()
+                return browser.free.pop()
+            self._stats["checkouts"] -= 1
+        if browser is None:
+            return None
+        return self.get_driver(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+    def return_driver(self, tab, failed=False):
+        """Hand a tab back; failed=True has its browser health-checked before reuse."""
+        browser = tab.browser
+        with self._cond:
+            browser.pages += 1
+            browser.last_used = time.monotonic()
+            browser.free.append(tab)
+            if failed:
+                browser.suspect = True
+            reason = self._expired(browser, browser.last_used)
+            if reason:
+                browser.draining = True
+            retire = browser.id in self._browsers and browser.draining and not browser.busy
+            if not retire:
+                self._cond.notify()
+        if failed:
+            self._wake.set()
+        if retire:
+            self._retire(browser, reason)
+        elif browser.id not in self._browsers:
+            _quit(browser.driver)  # pool was shut down
+
+    def _expired(self, browser, now):
+        """Reason to recycle browser, or None."""
+        if self.max_pages and browser.pages >= self.max_pages:
+            return "pages"
+        if self.max_age and browser.age(now) >= self.max_age:
+            return "age"
+        if self.max_rss and browser.rss is not None and browser.rss > self.max_rss:
+            return "rss"
+        return None
+
+    # ── maintenance ──
+    def _maintain(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.check_interval)
+            self._wake.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.maintain_once()
+            except Exception as e:
+                logger.error(f"Driver pool maintenance failed: {e}")
+
+    def maintain_once(self):
+        """Probe idle browsers due for a check, recycle expired ones, scale, refill."""
+        now = time.monotonic()
+        with self._cond:
+            due = []
+            for browser in self._browsers.values():
+                reason = self._expired(browser, now)
+                if reason:
+                    browser.draining = True
+                if browser.busy or browser.checking:
+                    continue
+                if browser.draining or browser.suspect or now - browser.last_check >= self.check_interval:
+                    browser.checking = True
+                    due.append((browser, reason))
+
+        for browser, reason in due:
+            if reason is None:
+                reason = self._check(browser)
+            with self._cond:
+                browser.checking = False
+                if reason is None:
+                    browser.suspect = False
+                    self._cond.notify_all()
+                    continue
+            self._retire(browser, reason)
+
+        self._shrink(now)
+        self._top_up()
+
+    def _check(self, browser):
+        with self._cond:
+            self._stats["health_checks"] += 1
+        try:
+            with browser.command_lock:
+                browser.driver.current_url
+        except Exception as e:
+            logger.warning(f"Chrome browser #{browser.id} failed its health check: {e}")
+            with self._cond:
+                self._stats["health_failures"] += 1
+            return "dead"
+        browser.last_check = time.monotonic()
+        if self.rss_probe is not None:
+            browser.rss = self.rss_probe(driver_pid(browser.driver))
+        return self._expired(browser, browser.last_check)
+
+    def _shrink(self, now):
+        """Retire browsers idle for idle_timeout while above min_size."""
+        with self._cond:
+            idle = [b for b in self._browsers.values()
+                    if not b.busy and not b.checking and now - b.last_used >= self.idle_timeout]
+            surplus = len(self._browsers) - self.min_size
+            idle = sorted(idle, key=lambda b: b.last_used)[:max(0, surplus)]
+            for browser in idle:
+                browser.draining = True
+        for browser in idle:
+            self._retire(browser, "idle")
+
+    def _top_up(self):
+        """Refill to min_size, plus one more browser while renders wait for a tab."""
+        with self._cond:
+            live = len(self._browsers) + self._spawning
+            want = max(self.min_size, live + 1 if self._waiting else 0)
+            missing = max(0, min(want, self.max_size) - live)
+            self._spawning += missing
+        for _ in range(missing):
+            if self._stopped.is_set():
+                with self._cond:
+                    self._spawning -= 1
+                continue
+            self._spawn()
+
+    # ── reporting ──
+    @property
+    def drivers(self):
+        """Free tabs (kept for callers that only want a count)."""
+        with self._cond:
+            return [tab for b in self._browsers.values() if b.available() for tab in b.free]
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._cond:
+            info = dict(self._stats)
+            browsers = list(self._browsers.values())
+            info.update(
+                browsers=len(browsers), spawning=self._spawning, waiting=self._waiting,
+                tabs=sum(len(b.tabs) for b in browsers), busy_tabs=sum(b.busy for b in browsers),
+                drivers=[b.info(now) for b in browsers],
+            )
+        info.update(min_size=self.min_size, max_size=self.max_size,
+                    tabs_per_driver=self.tabs_per_driver, max_pages=self.max_pages,
+                    max_age=self.max_age, max_rss_mb=self.max_rss // 1048576 if self.max_rss else None)
+        return info
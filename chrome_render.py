@@ -0,0 +1,339 @@
+# chrome_render.py - deciding when a headless Chrome render is finished
+#
+# fetch_with_chrome waited for <body> and then slept a fixed second: simple
+# pages paid for a second they did not need and heavy SPAs were captured
+# half-rendered anyway.  A small script installed before any page script runs
+# counts in-flight fetch/XHR requests, notes when resources last finished
+# loading and when the DOM last changed; the render then polls for one of
+#
+#   network_idle  document complete, nothing in flight for idle_ms
+#   dom_quiet     parsed and no DOM mutation for quiet_ms
+#   selector      a per-domain CSS selector is present
+#   load          document.readyState == "complete"
+#
+# and returns as soon as the condition holds or the deadline passes.  Every
+# render records its strategy and time to ready.
+#
+# Renders only keep page_source, and the client refetches every asset through
+# the proxy anyway, so images, fonts, media and analytics fetched by Chrome are
+# pure waste.  block_patterns() turns resource types into URL patterns for
+# Network.setBlockedURLs (per domain, see apply_blocking); the driver's
+# performance log tells us how many requests were blocked and how many bytes
+# actually came over the wire.
+#
+# The stylesheets, scripts and images Chrome did download are requested again
+# by the client moments later.  harvest_responses() pulls their bodies out of
+# the tab (Network.getResponseBody) so the caller can seed its asset cache.
+import base64
+import json
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+import metrics
+from policy import match_suffix
+
+logger = logging.getLogger(__name__)
+
+READY_NETWORK_IDLE = "network_idle"
+READY_DOM_QUIET = "dom_quiet"
+READY_SELECTOR = "selector"
+READY_LOAD = "load"
+STRATEGIES = (READY_NETWORK_IDLE, READY_DOM_QUIET, READY_SELECTOR, READY_LOAD)
+
+POLL_INTERVAL = 0.05
+
+INSTRUMENT_JS = """
+(function () {
+  if (window.__reidproxy) { return; }
+  var rp = window.__reidproxy = {inflight: 0, activity: performance.now(), mutation: performance.now()};
+  function touch() { rp.activity = performance.now(); }
+  function done() { rp.inflight = Math.max(0, rp.inflight - 1); touch(); }
+  if (window.fetch) {
+    var fetch = window.fetch;
+    window.fetch = function () {
+      rp.inflight++; touch();
+      return fetch.apply(this, arguments).then(
+        function (r) { done(); return r; }, function (e) { done(); throw e; });
+    };
+  }
+  var send = XMLHttpRequest.prototype.send;
+  XMLHttpRequest.prototype.send = function () {
+    rp.inflight++; touch();
+    this.addEventListener('loadend', done);
+    return send.apply(this, arguments);
+  };
+  try { new PerformanceObserver(touch).observe({type: 'resource', buffered: true}); } catch (e) {}
+  new MutationObserver(function () { rp.mutation = performance.now(); }).observe(
+    document, {childList: true, subtree: true, attributes: true, characterData: true});
+})();
+"""
+
+STATE_JS = """
+var rp = window.__reidproxy, now = performance.now();
+var found = arguments[0] ? !!document.querySelector(arguments[0]) : false;
+return [document.readyState, rp ? rp.inflight : 0, rp ? now - rp.activity : null,
+        rp ? now - rp.mutation : null, found];
+"""
+
+Readiness = namedtuple("Readiness", "strategy ready seconds")
+Harvested = namedtuple("Harvested", "url status headers body")
+
+# Network.ResourceType values worth keeping for the client's follow-up requests
+HARVEST_TYPES = ("Stylesheet", "Script", "Image", "Font")
+# getResponseBody returns the decoded body, so the wire framing no longer applies
+_HARVEST_SKIP_HEADERS = ("content-encoding", "content-length", "transfer-encoding", "connection")
+
+# Resource types → Network.setBlockedURLs patterns ("*" matches anything, query strings included)
+RESOURCE_PATTERNS = {
+    "image": ("*.png*", "*.jpg*", "*.jpeg*", "*.gif*", "*.webp*", "*.avif*", "*.ico*", "*.bmp*"),
+    "font": ("*.woff*", "*.ttf*", "*.otf*", "*.eot*"),
+    "media": ("*.mp4*", "*.webm*", "*.m3u8*", "*.mpd*", "*.m4s*", "*.mp3*", "*.ogg*", "*.wav*"),
+    "analytics": ("*google-analytics.com/*", "*googletagmanager.com/*", "*doubleclick.net/*",
+                  "*googlesyndication.com/*", "*connect.facebook.net/*", "*hotjar.com/*",
+                  "*segment.io/*", "*scorecardresearch.com/*", "*quantserve.com/*",
+                  "*newrelic.com/*", "*nr-data.net/*", "*sentry.io/*", "*branch.io/*"),
+}
+
+
+class ReadyRule:
+    """How to decide a page is rendered: a strategy plus its parameters."""
+
+    __slots__ = ("strategy", "selector", "idle_ms", "quiet_ms")
+
+    def __init__(self, strategy=READY_NETWORK_IDLE, selector=None, idle_ms=500, quiet_ms=500):
+        if selector and strategy != READY_SELECTOR:
+            strategy = READY_SELECTOR
+        if strategy not in STRATEGIES or (strategy == READY_SELECTOR and not selector):
+            raise ValueError(f"bad readiness rule: {strategy!r} {selector!r}")
+        self.strategy = strategy
+        self.selector = selector
+        self.idle_ms = idle_ms
+        self.quiet_ms = quiet_ms
+
+    def satisfied(self, state) -> bool:
+        ready_state, inflight, idle_ms, quiet_ms, found = state
+        if self.strategy == READY_SELECTOR:
+            return bool(found)
+        if self.strategy == READY_LOAD:
+            return ready_state == "complete"
+        if self.strategy == READY_DOM_QUIET:
+            return ready_state != "loading" and quiet_ms is not None and quiet_ms >= self.quiet_ms
+        return (ready_state == "complete" and not inflight
+                and idle_ms is not None and idle_ms >= self.idle_ms)
+
+
+def rule_for(host, default: ReadyRule, rules: dict) -> ReadyRule:
+    """Per-domain rule (keys cover subdomains), else the default."""
+    return match_suffix(rules, host) or default
+
+
+def instrument(driver):
+    """Install INSTRUMENT_JS for every future document of driver (once per driver)."""
+    if getattr(driver, "_reidproxy_instrumented", False):
+        return True
+    try:
+        driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": INSTRUMENT_JS})
+    except Exception as e:
+        logger.debug(f"CDP unavailable, instrumenting after navigation: {e}")
+        return False
+    driver._reidproxy_instrumented = True
+    return True
+
+
+def wait_until_ready(driver, rule: ReadyRule, deadline: float, instrumented=True) -> Readiness:
+    """Poll the page until rule holds or time.monotonic() passes deadline.
+
+    `deadline` is absolute, so time spent in driver.get() counts against it.
+    """
+    start = time.monotonic()
+    if not instrumented:
+        try:
+            driver.execute_script(INSTRUMENT_JS)
+        except Exception as e:
+            logger.debug(f"Could not instrument page: {e}")
+    while True:
+        try:
+            state = driver.execute_script(STATE_JS, rule.selector)
+            if state and rule.satisfied(state):
+                return Readiness(rule.strategy, True, time.monotonic() - start)
+        except Exception as e:
+            logger.debug(f"Readiness probe failed: {e}")
+        if time.monotonic() + POLL_INTERVAL >= deadline:
+            return Readiness(rule.strategy, False, time.monotonic() - start)
+        time.sleep(POLL_INTERVAL)
+
+
+# ────────────────────────────────────────────────
+# Resource blocking
+# ────────────────────────────────────────────────
+def block_patterns(types, extra=()) -> tuple:
+    """URL patterns for the given resource types (see RESOURCE_PATTERNS) plus extra patterns."""
+    patterns = []
+    for kind in types:
+        if kind not in RESOURCE_PATTERNS:
+            raise ValueError(f"unknown resource type: {kind!r}")
+        patterns.extend(RESOURCE_PATTERNS[kind])
+    patterns.extend(extra)
+    return tuple(dict.fromkeys(patterns))
+
+
+def apply_blocking(driver, patterns: tuple) -> bool:
+    """Make driver refuse requests matching patterns (an empty tuple lifts the block).
+
+    The CDP call is skipped when the driver already has the same patterns.
+    """
+    if getattr(driver, "_reidproxy_blocked", ()) == patterns:
+        return True
+    try:
+        if not hasattr(driver, "_reidproxy_blocked"):
+            driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(patterns)})
+    except Exception as e:
+        logger.debug(f"Could not set blocked URLs: {e}")
+        return False
+    driver._reidproxy_blocked = patterns
+    return True
+
+
+def drain_network_log(driver) -> list:
+    """Network.* events logged since the last drain (needs goog:loggingPrefs performance)."""
+    try:
+        entries = driver.get_log("performance")
+    except Exception:
+        return []
+    events = []
+    for entry in entries or ():
+        try:
+            message = json.loads(entry["message"])["message"]
+        except (KeyError, TypeError, ValueError):
+            continue
+        if message.get("method", "").startswith("Network."):
+            events.append(message)
+    return events
+
+
+def summarize_network(events) -> dict:
+    """Requests started, blocked, failed and bytes received in a list of Network events."""
+    summary = dict.fromkeys(("requests", "blocked", "failed", "bytes"), 0)
+    for event in events:
+        method, params = event.get("method"), event.get("params") or {}
+        if method == "Network.requestWillBeSent":
+            summary["requests"] += 1
+        elif method == "Network.loadingFailed":
+            summary["blocked" if params.get("blockedReason") else "failed"] += 1
+        elif method == "Network.loadingFinished":
+            summary["bytes"] += int(params.get("encodedDataLength") or 0)
+    return summary
+
+
+def _charset(headers):
+    for name, value in headers.items():
+        if name.lower() == "content-type" and "charset=" in value.lower():
+            return value.lower().split("charset=", 1)[1].split(";")[0].strip().strip('"') or "utf-8"
+    return "utf-8"
+
+
+def harvest_responses(driver, events, types=HARVEST_TYPES, max_bytes=16 * 1024 * 1024,
+                      wanted=None) -> list:
+    """Bodies of the completed 200 responses in events, as Harvested tuples.
+
+    Must run before the tab navigates away.  `wanted(url, headers)` returning
+    False skips a response before its body is fetched; at most max_bytes of
+    bodies are collected.
+    """
+    responses = {}
+    finished = []
+    for event in events:
+        method, params = event.get("method"), event.get("params") or {}
+        if method == "Network.responseReceived" and params.get("type") in types:
+            response = params.get("response") or {}
+            if response.get("status") == 200 and response.get("url", "").startswith(("http://", "https://")):
+                responses[params.get("requestId")] = response
+        elif method == "Network.loadingFinished" and params.get("requestId") in responses:
+            finished.append(params["requestId"])
+
+    harvested = []
+    budget = max_bytes
+    for request_id in finished:
+        response = responses[request_id]
+        url = response["url"]
+        headers = {name: str(value).replace("\n", ", ")
+                   for name, value in (response.get("headers") or {}).items()
+                   if name.lower() not in _HARVEST_SKIP_HEADERS}
+        if wanted is not None and not wanted(url, headers):
+            continue
+        try:
+            result = driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": request_id})
+        except Exception as e:
+            logger.debug(f"No body for {url}: {e}")
+            continue
+        body = result.get("body") or ""
+        try:
+            body = base64.b64decode(body) if result.get("base64Encoded") else body.encode(_charset(headers))
+        except (LookupError, UnicodeError, ValueError):
+            continue
+        if len(body) > budget:
+            continue
+        budget -= len(body)
+        harvested.append(Harvested(url, 200, headers, body))
+    return harvested
+
+
+# ────────────────────────────────────────────────
+# Per-render accounting
+# ────────────────────────────────────────────────
+RENDER_SECONDS = metrics.histogram("reidproxy_chrome_render_seconds",
+                                   "Chrome render time (navigation to HTML), by whether the page became ready "
+                                   "or hit the deadline.", ("outcome",), (("ready", "deadline"),),
+                                   buckets=metrics.RENDER_BUCKETS)
+
+
+class RenderStats:
+    """Counts and timings per readiness strategy and with / without resource
+    blocking, plus the most recent renders."""
+
+    def __init__(self, recent=50):
+        self._lock = threading.Lock()
+        self._by_strategy = {}
+        self._by_blocking = {}
+        self._recent = deque(maxlen=recent)
+
+    def record(self, url, readiness: Readiness, total_seconds: float, network=None, blocking=False):
+        network = network or {}
+        RENDER_SECONDS.observe(total_seconds, "ready" if readiness.ready else "deadline")
+        with self._lock:
+            b = self._by_blocking.setdefault("blocking" if blocking else "unblocked", dict.fromkeys(
+                ("renders", "render_seconds", "requests", "blocked", "bytes"), 0))
+            b["renders"] += 1
+            b["render_seconds"] += total_seconds
+            for field in ("requests", "blocked", "bytes"):
+                b[field] += network.get(field, 0)
+            s = self._by_strategy.setdefault(readiness.strategy, dict.fromkeys(
+                ("renders", "ready", "deadline", "wait_seconds", "wait_max_seconds", "render_seconds"), 0))
+            s["renders"] += 1
+            s["ready" if readiness.ready else "deadline"] += 1
+            s["wait_seconds"] += readiness.seconds
+            s["wait_max_seconds"] = max(s["wait_max_seconds"], readiness.seconds)
+            s["render_seconds"] += total_seconds
+            self._recent.append({"url": url, "strategy": readiness.strategy, "ready": readiness.ready,
+                                 "wait_ms": round(readiness.seconds * 1000, 1),
+                                 "render_ms": round(total_seconds * 1000, 1),
+                                 "blocked": network.get("blocked", 0), "bytes": network.get("bytes", 0)})
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            strategies = {name: dict(s) for name, s in self._by_strategy.items()}
+            blocking = {name: dict(b) for name, b in self._by_blocking.items()}
+            recent = list(self._recent)
+        for b in blocking.values():
+            n = b["renders"]
+            b["render_avg_ms"] = round(b.pop("render_seconds") / n * 1000, 1)
+            b["bytes_per_render"] = b["bytes"] // n
+        for s in strategies.values():
+            n = s["renders"]
+            s["wait_avg_ms"] = round(s.pop("wait_seconds") / n * 1000, 1)
+            s["wait_max_ms"] = round(s.pop("wait_max_seconds") * 1000, 1)
+            s["render_avg_ms"] = round(s.pop("render_seconds") / n * 1000, 1)
+        return {"strategies": strategies, "blocking": blocking, "recent": recent}
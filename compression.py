@@ -0,0 +1,224 @@
+# compression.py - Content-Encoding negotiation, raw passthrough and streaming recompression
+#
+# requests transparently inflates gzip/deflate/br bodies, so without this
+# module every proxied asset was decompressed on our CPU and sent to the
+# client uncompressed.  Non-rewritten responses are now forwarded as the raw
+# upstream bytes (Content-Encoding intact); rewritten HTML is re-compressed on
+# the fly with whatever encoding the client negotiated.
+import logging
+import time
+import zlib
+
+import metrics
+from shared_state import SharedableStats
+
+try:
+    import brotli
+except ImportError:  # optional: br is passed through but never produced/decoded
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Encodings we can produce (and decode, for pages we rewrite), best first
+PRODUCIBLE = ("br", "gzip", "deflate") if brotli else ("gzip", "deflate")
+# Encodings we are willing to forward untouched
+PASSTHROUGH = ("br", "gzip", "deflate")
+
+
+# ────────────────────────────────────────────────
+# Counters
+# ────────────────────────────────────────────────
+class CompressionStats(SharedableStats):
+    """Bytes and CPU spent on compression, shared by all routes."""
+
+    FIELDS = ("passthrough_responses", "passthrough_bytes",
+              "recompressed_responses", "recompress_bytes_in", "recompress_bytes_out",
+              "recompress_cpu_seconds")
+
+    def snapshot(self) -> dict:
+        counts = super().snapshot()
+        counts["recompress_bytes_saved"] = counts["recompress_bytes_in"] - counts["recompress_bytes_out"]
+        counts["recompress_cpu_seconds"] = round(counts["recompress_cpu_seconds"], 6)
+        return counts
+
+
+stats = CompressionStats()
+RECOMPRESS_CPU = metrics.counter("reidproxy_recompress_cpu_seconds_total",
+                                 "CPU time spent re-compressing rewritten bodies, by encoding.",
+                                 ("encoding",), (PASSTHROUGH,))
+
+
+# ────────────────────────────────────────────────
+# Negotiation
+# ────────────────────────────────────────────────
+def parse_accept_encoding(header: str) -> dict:
+    """Parse an Accept-Encoding header into {coding: q}."""
+    codings = {}
+    for part in (header or "").split(","):
+        fields = part.strip().split(";")
+        coding = fields[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def accepted(header: str, candidates) -> list:
+    """Candidates the client accepts (q > 0), in our order of preference."""
+    codings = parse_accept_encoding(header)
+    wildcard = codings.get("*", 0.0)
+    return [c for c in candidates if codings.get(c, wildcard) > 0]
+
+
+def negotiate(header: str, candidates=PRODUCIBLE):
+    """Best encoding to produce for this client, or None for identity."""
+    options = accepted(header, candidates)
+    return options[0] if options else None
+
+
+def upstream_accept_encoding(client_header: str, decodable_only: bool = False) -> str:
+    """Accept-Encoding to send upstream.
+
+    Only codings the client itself accepts are requested, so whatever comes
+    back can be forwarded verbatim.  When the body may have to be rewritten,
+    the list is further limited to codings we can decode.
+    """
+    candidates = PRODUCIBLE if decodable_only else PASSTHROUGH
+    options = accepted(client_header, candidates)
+    return ", ".join(options) if options else "identity"
+
+
+# ────────────────────────────────────────────────
+# Raw passthrough
+# ────────────────────────────────────────────────
+HOP_BY_HOP = ("transfer-encoding", "connection", "keep-alive")
+
+
+def can_passthrough(resp, client_header: str) -> bool:
+    """True if resp's body can be sent to this client exactly as received."""
+    encoding = resp.headers.get("Content-Encoding", "").strip().lower()
+    if not encoding or encoding == "identity":
+        return True
+    return encoding in accepted(client_header, PASSTHROUGH)
+
+
+def passthrough_headers(resp, excluded=()) -> dict:
+    """Upstream headers for a verbatim body: keeps Content-Encoding/-Length."""
+    skip = set(HOP_BY_HOP) | {h.lower() for h in excluded}
+    headers = {k: v for k, v in resp.headers.items() if k.lower() not in skip}
+    if "Content-Encoding" in resp.headers:
+        _vary_on_encoding(headers)
+    return headers
+
+
+def iter_raw(resp, chunk_size=8192):
+    """Yield the upstream body still encoded, then release the connection."""
+    sent = 0
+    try:
+        for chunk in resp.raw.stream(chunk_size, decode_content=False):
+            sent += len(chunk)
+            yield chunk
+    finally:
+        resp.close()
+        stats.incr("passthrough_responses")
+        stats.incr("passthrough_bytes", sent)
+
+
+def _vary_on_encoding(headers: dict):
+    existing = ""
+    for key in [k for k in headers if k.lower() == "vary"]:
+        existing = headers.pop(key)
+    fields = [v.strip() for v in existing.split(",") if v.strip()]
+    if "accept-encoding" not in (v.lower() for v in fields):
+        fields.append("Accept-Encoding")
+    headers["Vary"] = ", ".join(fields)
+
+
+# ────────────────────────────────────────────────
+# Streaming recompression
+# ────────────────────────────────────────────────
+class StreamCompressor:
+    """Incremental gzip/deflate/br encoder.
+
+    Each compress() call ends with a sync flush so the client can render what
+    it has so far; CPU time is measured per thread (thread_time) so it is
+    accurate under a threaded server.
+    """
+
+    def __init__(self, encoding: str, level: int = 5):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=min(level, 11))
+        else:
+            wbits = zlib.MAX_WBITS | 16 if encoding == "gzip" else zlib.MAX_WBITS
+            self._zlib = zlib.compressobj(level, zlib.DEFLATED, wbits)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def _timed(self, fn, *args):
+        start = time.thread_time()
+        out = fn(*args)
+        self.cpu_seconds += time.thread_time() - start
+        self.bytes_out += len(out)
+        return out
+
+    def compress(self, data: bytes) -> bytes:
+        if not data:
+            return b""
+        self.bytes_in += len(data)
+        if self.encoding == "br":
+            return self._timed(lambda d: self._brotli.process(d) + self._brotli.flush(), data)
+        return self._timed(lambda d: self._zlib.compress(d) + self._zlib.flush(zlib.Z_SYNC_FLUSH), data)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            out = self._timed(self._brotli.finish)
+        else:
+            out = self._timed(self._zlib.flush)
+        stats.incr("recompressed_responses")
+        stats.incr("recompress_bytes_in", self.bytes_in)
+        stats.incr("recompress_bytes_out", self.bytes_out)
+        stats.incr("recompress_cpu_seconds", self.cpu_seconds)
+        RECOMPRESS_CPU.inc(self.encoding, amount=self.cpu_seconds)
+        return out
+
+
+def compress_stream(chunks, encoding, level=5):
+    """Wrap an iterator of body chunks in a streaming encoder."""
+    compressor = StreamCompressor(encoding, level)
+    try:
+        for chunk in chunks:
+            out = compressor.compress(chunk)
+            if out:
+                yield out
+        yield compressor.finish()
+    finally:
+        # Client went away mid-body: let the inner generator release upstream
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+
+
+def chunked(data: bytes, size: int = 65536):
+    """Split an already-built body so it can be fed to compress_stream()."""
+    view = memoryview(data)
+    for start in range(0, len(data), size):
+        yield bytes(view[start:start + size])
+
+
+def encoded_headers(headers: dict, encoding: str) -> dict:
+    """Mark a header dict as carrying a body re-encoded with `encoding`."""
+    headers = {k: v for k, v in headers.items()
+               if k.lower() not in ("content-encoding", "content-length")}
+    headers["Content-Encoding"] = encoding
+    _vary_on_encoding(headers)
+    return headers
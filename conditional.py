@@ -0,0 +1,114 @@
+# conditional.py - conditional requests (If-None-Match / If-Modified-Since, 304)
+#
+# Returning browsers revalidate what they already hold, but no route
+# forwarded their validators: upstream always answered 200 and every byte
+# was streamed to a client that already had it.  When we hold nothing for a
+# URL the client's validators now go upstream and a 304 comes back without
+# a body; when a cached copy is fresh (or was just revalidated with our own
+# validators) the client's are checked against it and answered with a local
+# 304.  Bytes not sent are counted.
+import hashlib
+import re
+
+from asset_cache import get_header, parse_http_date
+from shared_state import SharedableStats
+
+FORWARDED = ("If-None-Match", "If-Modified-Since")
+# What a 304 carries (RFC 9110 §15.4.5), plus our cache markers
+_NOT_MODIFIED_HEADERS = ("cache-control", "content-location", "date", "etag", "expires",
+                         "last-modified", "vary", "age", "x-cache")
+_ETAG = re.compile(r'(?:W/)?"[^"]*"')
+
+
+# ────────────────────────────────────────────────
+# Counters
+# ────────────────────────────────────────────────
+class ConditionalStats(SharedableStats):
+    """304s by origin, and bytes not transferred because of them.
+
+    bytes_avoided counts bodies not sent to clients (known for local 304s
+    only); upstream_bytes_avoided counts cached bodies upstream confirmed
+    with a 304 instead of sending them again.
+    """
+
+    FIELDS = ("forwarded", "upstream_not_modified", "local_not_modified",
+              "bytes_avoided", "upstream_bytes_avoided")
+
+
+stats = ConditionalStats()
+
+
+# ────────────────────────────────────────────────
+# Evaluation
+# ────────────────────────────────────────────────
+def forward_headers(request_headers) -> dict:
+    """The client's validators, to send upstream when we hold no copy of our own."""
+    headers = {name: request_headers.get(name) for name in FORWARDED if request_headers.get(name)}
+    if headers:
+        stats.incr("forwarded")
+    return headers
+
+
+def _opaque(tag: str) -> str:
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def is_not_modified(request_headers, headers) -> bool:
+    """RFC 9110 §13.2.2 for GET: If-None-Match (weak comparison) wins over If-Modified-Since."""
+    if_none_match = request_headers.get("If-None-Match")
+    if if_none_match:
+        etag = (get_header(headers, "ETag") or "").strip()
+        if not etag:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        return _opaque(etag) in {_opaque(tag) for tag in _ETAG.findall(if_none_match)}
+    since = parse_http_date(request_headers.get("If-Modified-Since"))
+    modified = parse_http_date(get_header(headers, "Last-Modified"))
+    return since is not None and modified is not None and modified <= since
+
+
+def not_modified_headers(headers) -> dict:
+    return {k: v for k, v in headers.items() if k.lower() in _NOT_MODIFIED_HEADERS}
+
+
+def not_modified(request_headers, headers, size=0):
+    """Headers for a local 304 when the client already holds this response, else None.
+
+    `size` is the body the 304 saves sending.
+    """
+    if not is_not_modified(request_headers, headers):
+        return None
+    stats.incr("local_not_modified")
+    stats.incr("bytes_avoided", size)
+    return not_modified_headers(headers)
+
+
+def upstream_not_modified(resp):
+    """(body, status, headers) passing an upstream 304 for the client's own validators on."""
+    resp.close()
+    return passed_not_modified(resp.headers)
+
+
+def passed_not_modified(headers):
+    """upstream_not_modified() given only the 304's headers (the response already read)."""
+    stats.incr("upstream_not_modified")
+    return b"", 304, not_modified_headers(headers)
+
+
+def revalidated(size):
+    """Upstream confirmed a cached body of `size` bytes with a 304."""
+    stats.incr("upstream_bytes_avoided", size)
+
+
+def browser_cache_headers(headers) -> dict:
+    """Headers for a page we rewrote: without upstream freshness the browser is told
+    to revalidate every use (answered with a cheap 304) rather than guess a lifetime."""
+    if get_header(headers, "Cache-Control") is None and get_header(headers, "Expires") is None:
+        headers = dict(headers, **{"Cache-Control": "no-cache"})
+    return headers
+
+
+def content_etag(body: bytes) -> str:
+    """Strong validator for a body we produced ourselves (e.g. a Chrome render)."""
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
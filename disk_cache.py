@@ -0,0 +1,445 @@
+# disk_cache.py - persistent content-addressed asset store shared by all workers
+#
+# Under `gunicorn app:app` every worker has its own AssetCache and a restart
+# empties them all.  This store keeps bodies on disk named by their SHA-256,
+# so identical bytes fetched from different URLs (the same library from three
+# CDNs) are written once, and keeps the URL → hash index in a memory-mapped
+# file that every worker process maps.  Hits are returned as open files so the
+# WSGI server can sendfile() them.
+#
+# Layout under the cache root:
+#   index.bin            header + fixed-size open-addressing slots (mmap)
+#   lock                 flock()ed around index writes / eviction
+#   objects/ab/ab12...   bodies, named by content hash
+#   tmp/                 bodies being written (<pid>-<n>.part)
+import hashlib
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from asset_cache import StoredResponse, freshness_lifetime, merge_revalidation, shareable_headers
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process locking, one worker per cache dir
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"RPDC"
+_FORMAT = 1
+# magic, format, slot count, slot size, total object bytes, object count
+_HEADER = struct.Struct("<4sIIIQQ")
+_HEADER_SIZE = 64
+# seq, state, key hash, content hash, status, size, stored_at, expires_at,
+# last_access, meta length  (followed by meta JSON up to the slot size)
+_SLOT = struct.Struct("<IB16s32sHQdddH")
+_SLOT_SIZE = 1024
+_META_MAX = _SLOT_SIZE - _SLOT.size
+_ACCESS_OFFSET = struct.calcsize("<IB16s32sHQdd")
+
+_EMPTY, _USED = 0, 1
+_MAX_PROBE = 32
+_EVICT_TO = 0.9        # evict down to this fraction of max_bytes
+
+
+def _key_hash(key) -> bytes:
+    return hashlib.sha256(repr(key).encode("utf-8", "surrogatepass")).digest()[:16]
+
+
+class DiskEntry(StoredResponse):
+    """A stored response whose body is an open file (caller must close it)."""
+
+    __slots__ = ("file", "digest")
+
+    def __init__(self, status, headers, size, stored_at, expires_at, digest, file):
+        super().__init__(status, headers, size, 0, stored_at)
+        self.expires_at = expires_at
+        self.digest = digest
+        self.file = file
+
+    def close(self):
+        try:
+            self.file.close()
+        except OSError:
+            pass
+
+
+def _drop_tmp(out, tmp_path):
+    """Close and remove a partly written temp file, ignoring disk errors; returns None."""
+    for step in (out.close, lambda: os.unlink(tmp_path)):
+        try:
+            step()
+        except OSError:
+            pass
+    return None
+
+
+class DiskCache:
+    """Cross-process, crash-safe, size-bounded content-addressed store."""
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, index_slots=65536,
+                 max_entry_bytes=64 * 1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.slots = index_slots
+        self._objects = os.path.join(self.root, "objects")
+        self._tmp = os.path.join(self.root, "tmp")
+        self._tmp_seq = itertools.count()
+        self._thread_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = dict.fromkeys(
+            ("hits", "misses", "stores", "dedup_stores", "evictions", "bytes_served"), 0)
+
+        os.makedirs(self._objects, exist_ok=True)
+        os.makedirs(self._tmp, exist_ok=True)
+        self._lock_file = open(os.path.join(self.root, "lock"), "a+b")
+        self._index_size = _HEADER_SIZE + self.slots * _SLOT_SIZE
+        with self._locked():
+            self._index_file = self._open_index()
+            self._map = mmap.mmap(self._index_file.fileno(), self._index_size)
+            self._recover()
+
+    # ── locking ──────────────────────────────────
+    @contextmanager
+    def _locked(self):
+        """Exclusive across threads (Lock) and worker processes (flock)."""
+        with self._thread_lock:
+            if fcntl:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _count(self, field, n=1):
+        with self._stats_lock:
+            self._stats[field] += n
+
+    # ── index file ───────────────────────────────
+    def _open_index(self):
+        path = os.path.join(self.root, "index.bin")
+        f = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), "r+b")
+        header = f.read(_HEADER.size)
+        valid = (
+            len(header) == _HEADER.size
+            and os.fstat(f.fileno()).st_size == self._index_size
+            and _HEADER.unpack(header)[:4] == (_MAGIC, _FORMAT, self.slots, _SLOT_SIZE)
+        )
+        if not valid:
+            logger.warning(f"Disk cache index at {path} missing or incompatible, rebuilding")
+            f.truncate(0)
+            f.truncate(self._index_size)
+            f.seek(0)
+            f.write(_HEADER.pack(_MAGIC, _FORMAT, self.slots, _SLOT_SIZE, 0, 0))
+            f.flush()
+        return f
+
+    def _slot_offset(self, i):
+        return _HEADER_SIZE + i * _SLOT_SIZE
+
+    def _read_slot(self, i):
+        """Seqlock read: retry while a writer (any process) is mid-update."""
+        off = self._slot_offset(i)
+        for _ in range(100):
+            raw = self._map[off:off + _SLOT_SIZE]
+            fields = _SLOT.unpack_from(raw)
+            seq = fields[0]
+            if seq & 1 == 0 and struct.unpack_from("<I", self._map, off)[0] == seq:
+                return fields, raw
+        return None, None
+
+    def _write_slot(self, i, state, key=b"", digest=b"", status=0, size=0,
+                    stored_at=0.0, expires_at=0.0, meta=b""):
+        off = self._slot_offset(i)
+        seq = struct.unpack_from("<I", self._map, off)[0]
+        struct.pack_into("<I", self._map, off, seq | 1)
+        _SLOT.pack_into(self._map, off, seq | 1, state, key, digest, status, size,
+                        stored_at, expires_at, time.time(), len(meta))
+        self._map[off + _SLOT.size:off + _SLOT.size + len(meta)] = meta
+        struct.pack_into("<I", self._map, off, (seq | 1) + 1)
+
+    def _totals(self):
+        return _HEADER.unpack_from(self._map, 0)[4:]
+
+    def _set_totals(self, total_bytes, objects):
+        _HEADER.pack_into(self._map, 0, _MAGIC, _FORMAT, self.slots, _SLOT_SIZE,
+                          max(0, total_bytes), max(0, objects))
+
+    def _probe(self, key):
+        start = int.from_bytes(key[:8], "little") % self.slots
+        return [(start + n) % self.slots for n in range(min(_MAX_PROBE, self.slots))]
+
+    def _object_path(self, digest: bytes):
+        name = digest.hex()
+        return os.path.join(self._objects, name[:2], name)
+
+    # ── crash recovery ───────────────────────────
+    def _recover(self):
+        """Make the index consistent with the object files (caller holds the lock).
+
+        Torn slot writes (odd sequence), entries whose object vanished and
+        .part files left by dead processes are dropped; totals are recounted
+        from the files actually on disk.
+        """
+        dropped = 0
+        for i in range(self.slots):
+            off = self._slot_offset(i)
+            seq, state = struct.unpack_from("<IB", self._map, off)
+            if state == _EMPTY and seq & 1 == 0:
+                continue
+            fields = _SLOT.unpack_from(self._map, off)
+            if seq & 1 or state != _USED or not os.path.exists(self._object_path(fields[3])):
+                self._write_slot(i, _EMPTY)
+                dropped += 1
+
+        for name in os.listdir(self._tmp):
+            pid = name.split("-", 1)[0]
+            if not pid.isdigit() or not pid_alive(int(pid)):
+                try:
+                    os.unlink(os.path.join(self._tmp, name))
+                except OSError:
+                    pass
+
+        referenced = {_SLOT.unpack_from(self._map, self._slot_offset(i))[3]
+                      for i in range(self.slots)
+                      if struct.unpack_from("<IB", self._map, self._slot_offset(i))[1] == _USED}
+        total, count = self._scan_objects(keep=referenced)
+        self._set_totals(total, count)
+        if dropped:
+            logger.warning(f"Disk cache recovery dropped {dropped} stale index slots")
+        logger.info(f"Disk cache ready at {self.root}: {count} objects, {total} bytes")
+
+    def _scan_objects(self, keep):
+        """Recount object bytes, deleting objects no index slot refers to."""
+        total = count = 0
+        for sub in os.scandir(self._objects):
+            if not sub.is_dir():
+                continue
+            for obj in os.scandir(sub.path):
+                try:
+                    digest = bytes.fromhex(obj.name)
+                except ValueError:
+                    digest = None
+                if digest not in keep:
+                    try:
+                        os.unlink(obj.path)
+                    except OSError:
+                        pass
+                    continue
+                total += obj.stat().st_size
+                count += 1
+        return total, count
+
+    # ── lookups ──────────────────────────────────
+    def _find(self, key):
+        for i in self._probe(key):
+            fields, raw = self._read_slot(i)
+            if fields is None:
+                continue
+            if fields[1] == _USED and fields[2] == key:
+                return i, fields, raw
+        return None, None, None
+
+    def lookup(self, key):
+        """Return a DiskEntry (with its body file open) or None."""
+        kh = _key_hash(key)
+        i, fields, raw = self._find(kh)
+        if fields is None:
+            self._count("misses")
+            return None
+        _, _, _, digest, status, size, stored_at, expires_at, _, meta_len = fields
+        try:
+            headers = json.loads(raw[_SLOT.size:_SLOT.size + meta_len])
+            body = open(self._object_path(digest), "rb")
+        except (OSError, ValueError):
+            self._count("misses")
+            return None
+        # Unlocked LRU stamp; a lost update only makes eviction slightly less exact
+        struct.pack_into("<d", self._map, self._slot_offset(i) + _ACCESS_OFFSET, time.time())
+        entry = DiskEntry(status, headers, size, stored_at, expires_at, digest, body)
+        self._count("hits" if entry.is_fresh() else "misses")
+        return entry
+
+    def serve(self, entry):
+        self._count("bytes_served", entry.size)
+        return entry.file
+
+    # ── stores ───────────────────────────────────
+    def _commit(self, key, status, headers, lifetime, tmp_path, digest, size, now=None):
+        now = time.time() if now is None else now
+        meta = json.dumps(headers, separators=(",", ":")).encode()
+        if len(meta) > _META_MAX:
+            os.unlink(tmp_path)
+            return False
+        kh = _key_hash(key)
+        path = self._object_path(digest)
+        with self._locked():
+            total, count = self._totals()
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+                self._count("dedup_stores")
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+                total += size
+                count += 1
+            self._set_totals(total, count)
+
+            target = None
+            oldest = None
+            for i in self._probe(kh):
+                fields = _SLOT.unpack_from(self._map, self._slot_offset(i))
+                if fields[1] == _USED and fields[2] == kh:
+                    target = i
+                    break
+                if target is None and fields[1] == _EMPTY:
+                    target = i
+                if fields[1] == _USED and (oldest is None or fields[8] < oldest[1]):
+                    oldest = (i, fields[8])
+            if target is None:
+                target = oldest[0]   # probe window full: replace the coldest slot
+            self._write_slot(target, _USED, kh, digest, status, size, now, now + lifetime, meta)
+            self._count("stores")
+
+            if total > self.max_bytes:
+                self._evict()
+        return True
+
+    def _evict(self):
+        """Drop least-recently-used objects until under budget (caller holds the lock)."""
+        last_access = {}
+        slots_by_digest = {}
+        for i in range(self.slots):
+            fields = _SLOT.unpack_from(self._map, self._slot_offset(i))
+            if fields[1] != _USED:
+                continue
+            digest = fields[3]
+            slots_by_digest.setdefault(digest, []).append(i)
+            last_access[digest] = max(last_access.get(digest, 0.0), fields[8])
+
+        # Objects nothing points at any more (slot replaced or re-pointed) go first
+        total, count = self._scan_objects(keep=last_access)
+        target = self.max_bytes * _EVICT_TO
+        for digest in sorted(last_access, key=last_access.get):
+            if total <= target:
+                break
+            path = self._object_path(digest)
+            try:
+                size = os.path.getsize(path)
+                os.unlink(path)
+            except OSError:
+                size = 0
+            for i in slots_by_digest[digest]:
+                self._write_slot(i, _EMPTY)
+            total -= size
+            count -= 1
+            self._count("evictions")
+        self._set_totals(total, count)
+
+    def tee(self, key, status, headers, chunks):
+        """Pass chunks through while writing them to a temp file, then commit.
+
+        The temp file is only promoted to objects/ once the body completed;
+        an aborted or oversized body leaves nothing behind.
+        """
+        lifetime = freshness_lifetime(headers) if status == 200 else None
+        if lifetime is None:
+            yield from chunks
+            return
+
+        tmp_path = os.path.join(self._tmp, f"{os.getpid()}-{next(self._tmp_seq)}.part")
+        try:
+            out = open(tmp_path, "wb")
+        except OSError as e:
+            logger.error(f"Disk cache store failed: {e}")
+            out = None
+        digest = hashlib.sha256()
+        size = 0
+        complete = False
+        try:
+            for chunk in chunks:
+                if out is not None:
+                    size += len(chunk)
+                    if size > self.max_entry_bytes:
+                        out = _drop_tmp(out, tmp_path)
+                    else:
+                        try:
+                            out.write(chunk)
+                            digest.update(chunk)
+                        except OSError as e:
+                            # only the side copy is lost; the client still gets the body
+                            logger.error(f"Disk cache store failed: {e}")
+                            out = _drop_tmp(out, tmp_path)
+                yield chunk
+            complete = True
+        finally:
+            if out is not None:
+                if complete:
+                    try:
+                        out.close()
+                        self._commit(key, status, shareable_headers(headers),
+                                     lifetime, tmp_path, digest.digest(), size)
+                    except OSError as e:
+                        logger.error(f"Disk cache store failed: {e}")
+                        _drop_tmp(out, tmp_path)
+                else:
+                    _drop_tmp(out, tmp_path)
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+
+    def revalidated(self, key, entry, headers):
+        """Apply a 304: rewrite the index slot with refreshed headers/expiry."""
+        merged = merge_revalidation(entry.headers, headers)
+        lifetime = freshness_lifetime(merged)
+        if lifetime is None:
+            return entry
+        meta = json.dumps(merged, separators=(",", ":")).encode()
+        if len(meta) > _META_MAX:
+            return entry
+        kh = _key_hash(key)
+        now = time.time()
+        with self._locked():
+            for i in self._probe(kh):
+                fields = _SLOT.unpack_from(self._map, self._slot_offset(i))
+                if fields[1] == _USED and fields[2] == kh and fields[3] == entry.digest:
+                    self._write_slot(i, _USED, kh, entry.digest, entry.status, entry.size,
+                                     now, now + lifetime, meta)
+                    break
+        return DiskEntry(entry.status, merged, entry.size, now, now + lifetime,
+                         entry.digest, entry.file)
+
+    def snapshot(self) -> dict:
+        with self._stats_lock:
+            info = dict(self._stats)
+        total, count = self._totals()
+        lookups = info["hits"] + info["misses"]
+        info.update(bytes=total, objects=count, max_bytes=self.max_bytes,
+                    hit_ratio=round(info["hits"] / lookups, 4) if lookups else 0.0)
+        return info
+
+    def close(self):
+        self._map.close()
+        self._index_file.close()
+        self._lock_file.close()
+
+
+def pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
@@ -0,0 +1,212 @@
+# dns_cache.py - in-process resolver cache with an SSRF guard on the resolved address
+#
+# is_dangerous_url() used to look only at the hostname string, after which
+# requests (and the TCP proxy) resolved the name again on every connect - a
+# resolver round trip per fetch and a window in which a rebinding DNS server
+# could hand out a private address after the check.  This resolver caches
+# getaddrinfo() answers (and failures) for a TTL, collapses concurrent lookups
+# of the same name into one, and validates the addresses it returns.  Callers
+# connect to exactly those addresses, so the check and the use agree.
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from ipaddress import ip_address
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 60.0              # getaddrinfo() exposes no record TTLs
+DEFAULT_NEGATIVE_TTL = 10.0     # NXDOMAIN / resolver failures
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class BlockedAddressError(ConnectionRefusedError):
+    """A name resolved to a private, loopback, link-local or otherwise internal address."""
+
+
+def is_public_address(address: str) -> bool:
+    ip = ip_address(address.split("%", 1)[0])
+    mapped = getattr(ip, "ipv4_mapped", None)
+    if mapped is not None:
+        ip = mapped
+    return not (
+        ip.is_private
+        or ip.is_loopback
+        or ip.is_link_local
+        or ip.is_multicast
+        or ip.is_reserved
+        or ip.is_unspecified
+    )
+
+
+def _literal(host: str):
+    try:
+        return str(ip_address(host.strip("[]")))
+    except ValueError:
+        return None
+
+
+# ────────────────────────────────────────────────
+# Counters
+# ────────────────────────────────────────────────
+class ResolverStats:
+    FIELDS = ("lookups", "hits", "negative_hits", "misses", "coalesced", "failures",
+              "blocked", "resolve_seconds", "resolve_max_seconds")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(self.FIELDS, 0)
+
+    def incr(self, field: str, n=1):
+        with self._lock:
+            self._counts[field] += n
+
+    def record_resolve(self, seconds: float):
+        with self._lock:
+            self._counts["misses"] += 1
+            self._counts["resolve_seconds"] += seconds
+            self._counts["resolve_max_seconds"] = max(self._counts["resolve_max_seconds"], seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+        served = counts["hits"] + counts["negative_hits"]
+        counts["hit_ratio"] = round(served / counts["lookups"], 4) if counts["lookups"] else 0.0
+        counts["resolve_avg_ms"] = (round(counts["resolve_seconds"] / counts["misses"] * 1000, 3)
+                                    if counts["misses"] else 0.0)
+        counts["resolve_max_ms"] = round(counts.pop("resolve_max_seconds") * 1000, 3)
+        counts["resolve_seconds"] = round(counts["resolve_seconds"], 6)
+        return counts
+
+
+# ────────────────────────────────────────────────
+# Resolver
+# ────────────────────────────────────────────────
+class Resolver:
+    """Thread-safe caching resolver.  resolve() returns a tuple of IP strings."""
+
+    def __init__(self, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.stats = ResolverStats()
+        self._entries = OrderedDict()   # host -> (expires_at, addresses | gaierror)
+        self._inflight = {}             # host -> Event set when the lookup lands
+        self._lock = threading.Lock()
+
+    def _cached(self, host, now):
+        entry = self._entries.get(host)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[host]
+            return None
+        self._entries.move_to_end(host)
+        return entry
+
+    def _lookup(self, host):
+        """Cached answer for host, resolving (once across threads) on a miss."""
+        self.stats.incr("lookups")
+        waited = False
+        while True:
+            with self._lock:
+                entry = self._cached(host, time.monotonic())
+                if entry is None:
+                    event = self._inflight.get(host)
+                    if event is None:
+                        self._inflight[host] = threading.Event()
+                        break
+            if entry is not None:
+                if not waited:
+                    self.stats.incr("negative_hits" if isinstance(entry[1], Exception) else "hits")
+                return entry[1]
+            if not waited:
+                waited = True
+                self.stats.incr("coalesced")
+            event.wait()
+
+        start = time.perf_counter()
+        result = None
+        try:
+            infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+            result = tuple(dict.fromkeys(info[4][0] for info in infos))
+            ttl = self.ttl
+        except socket.gaierror as e:
+            self.stats.incr("failures")
+            result, ttl = e, self.negative_ttl
+        finally:
+            self.stats.record_resolve(time.perf_counter() - start)
+            with self._lock:
+                if result is not None:
+                    self._entries[host] = (time.monotonic() + ttl, result)
+                    self._entries.move_to_end(host)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                self._inflight.pop(host).set()
+        return result
+
+    def resolve(self, host: str, check: bool = False) -> tuple:
+        """Addresses for host (IP literals are returned as-is).
+
+        With check=True every address must be public, otherwise
+        BlockedAddressError is raised - one internal answer blocks the name.
+        Resolution failures raise socket.gaierror (cached for negative_ttl).
+        """
+        host = host.rstrip(".").lower()
+        literal = _literal(host)
+        addresses = (literal,) if literal else self._lookup(host)
+        if isinstance(addresses, Exception):
+            raise socket.gaierror(*addresses.args)
+        if check:
+            for address in addresses:
+                if not is_public_address(address):
+                    self.stats.incr("blocked")
+                    raise BlockedAddressError(f"{host} resolves to internal address {address}")
+        return addresses
+
+    async def resolve_async(self, host: str, check: bool = False) -> tuple:
+        """resolve() for event-loop callers: cache hits stay on the loop thread."""
+        key = host.rstrip(".").lower()
+        with self._lock:
+            cached = _literal(key) or self._cached(key, time.monotonic())
+        if cached:
+            return self.resolve(host, check)
+        return await asyncio.get_running_loop().run_in_executor(None, self.resolve, host, check)
+
+    def snapshot(self) -> dict:
+        info = self.stats.snapshot()
+        with self._lock:
+            info.update(entries=len(self._entries), inflight=len(self._inflight))
+        info.update(ttl=self.ttl, negative_ttl=self.negative_ttl)
+        return info
+
+
+_resolver = None
+_resolver_pid = None
+_resolver_settings = {}
+_resolver_lock = threading.Lock()
+
+
+def configure(**settings):
+    """Set TTLs / size for the process-wide resolver (call before first use)."""
+    global _resolver
+    with _resolver_lock:
+        _resolver_settings.update(settings)
+        _resolver = None
+
+
+def get_resolver() -> Resolver:
+    """Return the process-wide resolver, rebuilding it after a fork."""
+    global _resolver, _resolver_pid
+    resolver = _resolver
+    if resolver is not None and _resolver_pid == os.getpid():
+        return resolver
+    with _resolver_lock:
+        if _resolver is None or _resolver_pid != os.getpid():
+            _resolver = Resolver(**_resolver_settings)
+            _resolver_pid = os.getpid()
+        return _resolver
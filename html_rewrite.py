@@ -0,0 +1,255 @@
+# html_rewrite.py - HTML link rewriting for the proxy routes
+import re
+import time
+from functools import lru_cache
+from html import unescape
+from urllib.parse import urljoin, quote_plus
+
+import metrics
+
+# Attributes whose URLs are pulled back through /p/<netloc>/...
+PREFIX_ATTRS = ("data-background", "data-lazy-src", "data-poster", "data-src",
+                "action", "poster", "href", "src")
+
+# Upper bound on whitespace tolerated around '=' and inside url( ... ).  Keeps
+# the longest possible match (and therefore the carried-over tail) bounded.
+_MAX_SPACE = 16
+
+REWRITE_CPU = metrics.counter("reidproxy_rewrite_cpu_seconds_total", "CPU time spent rewriting HTML, by rewriter.",
+                              ("rewriter",), (("html_stream", "html_proxy_links"),))
+
+
+@lru_cache(maxsize=256)
+def _prefix_pattern(netloc: str) -> "re.Pattern[bytes]":
+    attrs = b"|".join(re.escape(a.encode()) for a in PREFIX_ATTRS)
+    space = rb"[ \t\r\n]{0,%d}" % _MAX_SPACE
+    return re.compile(
+        rb"(?P<attr>" + attrs + rb")" + space + rb"=" + space + rb"(?P<q>[\"'])"
+        rb"(?:(?P<proto>//)|(?P<root>/)(?!/)|(?P<abs>https?://" + re.escape(netloc.encode()) + rb"))"
+        rb"|(?P<css>url\(" + space + rb")(?P<cq>[\"']?)/(?!/)",
+        re.IGNORECASE,
+    )
+
+
+class StreamingHtmlRewriter:
+    """Single-pass, chunk-at-a-time rewriter for pages served under /p/<netloc>.
+
+    Works on raw bytes (every pattern is ASCII, so any ASCII-compatible charset
+    passes through untouched) and rewrites in one scan:
+
+        href="/x"              →  href="/p/<netloc>/x"
+        src='//cdn.com/x'      →  src='/p/cdn.com/x'
+        action="https://<netloc>/x"  →  action="/p/<netloc>/x"
+        url("/x.png")          →  url("/p/<netloc>/x.png")
+
+    A match can straddle two network chunks, so the last few bytes of every
+    chunk are held back until the next one arrives; memory stays bounded by
+    chunk size plus that tail no matter how large the page is.
+    """
+
+    def __init__(self, netloc: str):
+        self.netloc = netloc
+        self.prefix = f"/p/{netloc}".encode()
+        self._pattern = _prefix_pattern(netloc)
+        # attr + spaces + '=' + spaces + quote + "https://" + netloc, plus one
+        # byte for the (?!/) lookahead
+        self._hold = max(len(a) for a in PREFIX_ATTRS) + 2 * _MAX_SPACE + len(netloc.encode()) + 16
+        self._buf = b""
+
+    def _replace(self, m) -> bytes:
+        if m.group("css") is not None:
+            return m.group("css") + m.group("cq") + self.prefix + b"/"
+        head = m.group("attr") + b"=" + m.group("q")
+        if m.group("proto") is not None:
+            return head + b"/p/"
+        if m.group("root") is not None:
+            return head + self.prefix + b"/"
+        return head + self.prefix
+
+    def _rewrite(self, buf: bytes, limit: int):
+        """Rewrite matches beginning before `limit`; return (output, resume_pos)."""
+        start = time.thread_time()
+        out = []
+        pos = 0
+        for m in self._pattern.finditer(buf):
+            if m.start() >= limit:
+                break
+            out.append(buf[pos:m.start()])
+            out.append(self._replace(m))
+            pos = m.end()
+        end = max(pos, limit)
+        out.append(buf[pos:end])
+        out = b"".join(out)
+        REWRITE_CPU.inc("html_stream", amount=time.thread_time() - start)
+        return out, end
+
+    def feed(self, chunk: bytes) -> bytes:
+        buf = self._buf + chunk if self._buf else chunk
+        limit = len(buf) - self._hold
+        if limit <= 0:
+            self._buf = buf
+            return b""
+        out, end = self._rewrite(buf, limit)
+        self._buf = buf[end:]
+        return out
+
+    def flush(self) -> bytes:
+        out, _ = self._rewrite(self._buf, len(self._buf))
+        self._buf = b""
+        return out
+
+    def rewrite(self, html: bytes) -> bytes:
+        """Convenience one-shot rewrite of a complete document."""
+        return self.feed(html) + self.flush()
+
+
+# ────────────────────────────────────────────────
+# /proxy?url= rewriting (3.1/app_with_chrome.py)
+# ────────────────────────────────────────────────
+_SKIP_PREFIXES = ("#", "mailto:", "javascript:", "data:", "tel:", "/proxy?url=")
+_DUP_SLASHES = re.compile(r'(?<!:)(?<!^)//+')
+
+
+def normalize_url(url):
+    """
+    Normalize URLs to fix common issues:
+    - Replace backslashes with forward slashes
+    - Handle spaces properly
+    - Remove duplicate slashes
+    """
+    if not url:
+        return url
+    
+    url = url.strip()
+
+    # Replace backslashes with forward slashes
+    url = url.replace('\\', '/')
+    
+    # Handle spaces
+    url = url.replace(' ', '%20')
+
+    # Remove duplicate slashes (except after protocol or at the beginning)
+    url = _DUP_SLASHES.sub('/', url)
+    
+    return url
+
+
+@lru_cache(maxsize=65536)
+def proxify_url(base_url, raw_url):
+    """Resolve a link found on base_url into a /proxy?url= link (memoized)"""
+    if not raw_url:
+        return raw_url
+    raw_url = raw_url.strip()
+
+    if raw_url.startswith(_SKIP_PREFIXES):
+        return raw_url
+
+    absolute = normalize_url(urljoin(base_url, normalize_url(raw_url)))
+    return f"/proxy?url={quote_plus(absolute)}"
+
+
+# '<!--', '<!doctype'/'<?pi', or a start/end tag name
+_MARKUP_RE = re.compile(r"<(?:(!--)|([!?])|(/?)([a-zA-Z][^\s/>]*))")
+# One attribute (name [= value]) or the closing '>' of a start tag
+_ATTR_RE = re.compile(
+    r"""[\s/]*(?:(>)|([^\s/>=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*)))?)"""
+)
+_RAWTEXT_END = {
+    "script": re.compile(r"</script[\s/>]", re.IGNORECASE),
+    "style": re.compile(r"</style[\s/>]", re.IGNORECASE),
+}
+
+
+def rewrite_proxy_links(base_url, html_text):
+    """Point href/src (and form action) values at /proxy?url=, editing in place.
+
+    A small lexer walks the markup once: comments, doctypes and <script>/<style>
+    bodies are skipped exactly as html.parser does, and only the value span of
+    a matching attribute is replaced, so the rest of the document is returned
+    byte-for-byte.  Produces the same attribute values as rewrite_links_soup().
+    """
+    started = time.thread_time()
+    out = []
+    pos = 0      # start of text not yet copied to out
+    scan = 0     # where to look for the next piece of markup
+    end_of_text = len(html_text)
+    search_markup = _MARKUP_RE.search
+    match_attr = _ATTR_RE.match
+
+    while True:
+        m = search_markup(html_text, scan)
+        if m is None:
+            break
+
+        if m.group(1) or m.group(2) or m.group(3):
+            close = "-->" if m.group(1) else ">"
+            end = html_text.find(close, m.end())
+            scan = end_of_text if end < 0 else end + len(close)
+            continue
+
+        tag = m.group(4).lower()
+        i = m.end()
+        closed = False
+        while True:
+            a = match_attr(html_text, i)
+            if a is None:
+                break
+            i = a.end()
+            closing, name, dq, sq, uq = a.groups()
+            if closing:
+                closed = True
+                break
+
+            name = name.lower()
+            if name not in ("href", "src") and not (name == "action" and tag == "form"):
+                continue
+
+            if dq is not None:
+                raw, group = dq, 3
+            elif sq is not None:
+                raw, group = sq, 4
+            elif uq is not None:
+                raw, group = uq, 5
+            else:
+                continue
+            value = unescape(raw) if "&" in raw else raw
+            new = proxify_url(base_url, value)
+            if new == value.strip():
+                continue
+
+            out.append(html_text[pos:a.start(group)])
+            out.append(new if group != 5 else f'"{new}"')
+            pos = a.end(group)
+
+        if not closed:
+            # Malformed tag (e.g. a stray '='): resume after its '>' rather than stop rewriting
+            end = html_text.find(">", i)
+            scan = end_of_text if end < 0 else end + 1
+            continue
+        scan = i
+        if tag in _RAWTEXT_END:
+            end = _RAWTEXT_END[tag].search(html_text, i)
+            scan = end_of_text if end is None else end.start()
+
+    out.append(html_text[pos:])
+    out = "".join(out)
+    REWRITE_CPU.inc("html_proxy_links", amount=time.thread_time() - started)
+    return out
+
+
+def rewrite_links_soup(base_url, html_text):
+    """Reference BeautifulSoup implementation (builds and re-serializes a full tree)"""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html_text, "html.parser")
+
+    for tag in soup.find_all(href=True):
+        tag["href"] = proxify_url(base_url, tag["href"])
+
+    for tag in soup.find_all(src=True):
+        tag["src"] = proxify_url(base_url, tag["src"])
+
+    for tag in soup.find_all("form", action=True):
+        tag["action"] = proxify_url(base_url, tag["action"])
+
+    return str(soup)
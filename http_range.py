@@ -0,0 +1,148 @@
+# http_range.py - byte ranges (Range / If-Range, 206 / 416) for proxied media
+#
+# Game and video sites seek inside large .wasm / .data / .mp4 files with
+# Range requests.  The proxy routes used to drop the header (and one even
+# buffered the whole body), so every seek re-downloaded the file from the
+# start.  Ranges are now forwarded upstream with their If-Range, a 206 or
+# 416 is streamed back verbatim, and when the complete body is already
+# cached the range is cut from the cache without touching upstream.
+#
+# One range per request is served; a multi-range request gets the whole
+# body with 200, which RFC 9110 §14.2 allows.
+import re
+
+import compression
+from asset_cache import get_header
+from shared_state import SharedableStats
+
+FORWARDED = ("Range", "If-Range")
+UNSATISFIABLE = "unsatisfiable"
+
+_BYTES_RANGE = re.compile(r"bytes=([0-9]*)-([0-9]*)", re.IGNORECASE)
+
+
+# ────────────────────────────────────────────────
+# Counters
+# ────────────────────────────────────────────────
+class RangeStats(SharedableStats):
+    """Range requests passed upstream and slices served from the caches."""
+
+    FIELDS = ("forwarded", "upstream_partial", "upstream_unsatisfiable",
+              "cache_partial", "cache_unsatisfiable", "cache_partial_bytes")
+
+
+stats = RangeStats()
+
+
+# ────────────────────────────────────────────────
+# Parsing
+# ────────────────────────────────────────────────
+def forward_headers(request_headers) -> dict:
+    """The client's Range and If-Range, to send upstream as they are."""
+    headers = {name: request_headers.get(name) for name in FORWARDED if request_headers.get(name)}
+    if "Range" not in headers:
+        return {}
+    stats.incr("forwarded")
+    return headers
+
+
+def parse_range(header, size):
+    """Range header against a body of `size` bytes.
+
+    Returns (start, end) inclusive, None to serve the whole body (no header,
+    another unit, several ranges or bad syntax), or UNSATISFIABLE (416).
+    """
+    m = _BYTES_RANGE.fullmatch((header or "").strip())
+    if m is None:
+        return None
+    first, last = m.groups()
+    if not first:
+        if not last:
+            return None
+        length = int(last)
+        if length == 0 or size == 0:
+            return UNSATISFIABLE
+        return max(0, size - length), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return UNSATISFIABLE
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def if_range_allows(if_range, headers) -> bool:
+    """True unless If-Range names something other than the stored representation.
+
+    A strong ETag must match exactly; a date must equal Last-Modified.
+    """
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', "W/")):
+        etag = (get_header(headers, "ETag") or "").strip()
+        return not if_range.startswith("W/") and not etag.startswith("W/") and etag == if_range
+    return if_range == (get_header(headers, "Last-Modified") or "").strip()
+
+
+def select(request_headers, headers, size):
+    """What to answer for a complete stored body: None (200), UNSATISFIABLE or (start, end)."""
+    if not request_headers.get("Range") or not if_range_allows(request_headers.get("If-Range"), headers):
+        return None
+    selected = parse_range(request_headers.get("Range"), size)
+    if selected == UNSATISFIABLE:
+        stats.incr("cache_unsatisfiable")
+    elif selected is not None:
+        stats.incr("cache_partial")
+        stats.incr("cache_partial_bytes", selected[1] - selected[0] + 1)
+    return selected
+
+
+# ────────────────────────────────────────────────
+# Responses
+# ────────────────────────────────────────────────
+def partial_headers(headers, start, end, size) -> dict:
+    out = {k: v for k, v in headers.items() if k.lower() not in ("content-length", "content-range")}
+    out["Content-Range"] = f"bytes {start}-{end}/{size}"
+    out["Content-Length"] = str(end - start + 1)
+    return out
+
+
+def upstream_partial(resp):
+    """(body, status, headers) forwarding an upstream 206 / 416 byte for byte.
+
+    The body is never decoded (Content-Range counts encoded bytes) and never cached.
+    """
+    stats.incr("upstream_partial" if resp.status_code == 206 else "upstream_unsatisfiable")
+    return compression.iter_raw(resp), resp.status_code, compression.passthrough_headers(resp)
+
+
+def unsatisfiable_headers(size) -> dict:
+    return {"Content-Range": f"bytes */{size}", "Content-Length": "0", "Accept-Ranges": "bytes"}
+
+
+def slice_chunks(chunks, start, end):
+    """Bytes start..end (inclusive) of a body held as a sequence of chunks."""
+    offset = 0
+    for chunk in chunks:
+        n = len(chunk)
+        if offset + n > start:
+            yield chunk[max(0, start - offset):end - offset + 1]
+        offset += n
+        if offset > end:
+            break
+
+
+def read_file_range(f, start, end, chunk_size=65536):
+    """Bytes start..end (inclusive) of an open file, which is closed afterwards."""
+    try:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
@@ -0,0 +1,440 @@
+# metrics.py - Prometheus metrics (GET /metrics) with lock-free recording
+#
+# /debug and /health show point-in-time state; nothing recorded how long
+# requests took or where the time went.  This module keeps counters and
+# histograms and renders them in the Prometheus text format.
+#
+# Every series is preallocated when its metric is declared (label values
+# included), so a metric is a fixed run of float64 cells.  Each thread
+# records into its own row of cells - a memoryview, one indexed add per
+# counter, two per histogram observation - with no lock, because no other
+# thread writes that row.  A scrape adds the rows up.  Once opened on a
+# file (under /dev/shm, see shared_state.py) the rows of every worker
+# process live in the same mapping, so any worker answers a scrape for
+# the whole host; rows of exited threads and processes are reused with
+# their totals.
+#
+# Metrics must be declared at import time, in the same order in every
+# worker, before open(): the layout (and a fingerprint of it, kept in the
+# file header) is fixed from then on.  Gauges that describe live objects
+# (queue depth, open tunnels) are read at scrape time through callback().
+import bisect
+import hashlib
+import itertools
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from disk_cache import pid_alive
+
+try:
+    import fcntl
+except ImportError:  # Windows: in-process rows only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RENDER_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0)
+CODE_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+
+_MAGIC = b"RPMX"
+_FORMAT = 1
+# magic, format, rows, cells, layout fingerprint
+_HEADER = struct.Struct("<4sIII32s")
+_HEADER_SIZE = 64
+_OWNER = struct.Struct("<QQ")   # pid, thread ident (0, 0 = free)
+
+
+def _number(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _label_text(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{name}="{v}"' for (name, _), v in zip(pairs, escaped)) + "}"
+
+
+# ────────────────────────────────────────────────
+# Metrics
+# ────────────────────────────────────────────────
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, registry, name, help_text, labelnames, labelvalues, cells_per_series):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.series = list(itertools.product(*labelvalues)) if labelnames else [()]
+        self._registry = registry
+        base = registry._declare(self, len(self.series) * cells_per_series)
+        self._cells = {labels: base + i * cells_per_series for i, labels in enumerate(self.series)}
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, registry, name, help_text, labelnames=(), labelvalues=()):
+        super().__init__(registry, name, help_text, labelnames, labelvalues, 1)
+
+    def inc(self, *labels, amount=1):
+        self._registry.row()[self._cells[labels]] += amount
+
+    def lines(self, totals):
+        out = self._header()
+        for labels in self.series:
+            out.append(f"{self.name}{_label_text(self.labelnames, labels)} {_number(totals[self._cells[labels]])}")
+        return out
+
+
+class Histogram(_Metric):
+    """Cells per series: one per bucket (not cumulative), +Inf, then the sum."""
+
+    kind = "histogram"
+
+    def __init__(self, registry, name, help_text, labelnames=(), labelvalues=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._sum = len(self.buckets) + 1
+        super().__init__(registry, name, help_text, labelnames, labelvalues, len(self.buckets) + 2)
+
+    def observe(self, value, *labels):
+        base = self._cells[labels]
+        row = self._registry.row()
+        row[base + bisect.bisect_left(self.buckets, value)] += 1
+        row[base + self._sum] += value
+
+    def lines(self, totals):
+        out = self._header()
+        for labels in self.series:
+            base = self._cells[labels]
+            count = 0
+            for i, bound in enumerate(self.buckets + (math.inf,)):
+                count += totals[base + i]
+                le = _label_text(self.labelnames, labels, [("le", _number(bound) if bound == math.inf
+                                                              else repr(float(bound)))])
+                out.append(f"{self.name}_bucket{le} {_number(count)}")
+            text = _label_text(self.labelnames, labels)
+            out.append(f"{self.name}_sum{text} {_number(totals[base + self._sum])}")
+            out.append(f"{self.name}_count{text} {_number(count)}")
+        return out
+
+
+class _Callback:
+    """A metric read at scrape time: fn() returns a number or {label values: number}."""
+
+    def __init__(self, name, help_text, kind, fn, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def lines(self, totals):
+        try:
+            values = self.fn()
+        except Exception as e:
+            logger.error(f"Metric {self.name} failed: {e}")
+            return []
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in values.items():
+            labels = labels if isinstance(labels, tuple) else (labels,)
+            out.append(f"{self.name}{_label_text(self.labelnames, labels)} {_number(value)}")
+        return out
+
+
+# ────────────────────────────────────────────────
+# Registry and per-thread rows
+# ────────────────────────────────────────────────
+class Registry:
+    def __init__(self, rows=256):
+        self.rows = rows
+        self.path = None
+        self._metrics = []
+        self._cells = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._buf = None
+        self._file = None
+        self._spill = None      # shared by threads that found no free row (may drop updates)
+        os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _declare(self, metric, cells) -> int:
+        with self._lock:
+            if self._buf is not None:
+                raise RuntimeError(f"metric {metric.name} declared after the registry was opened")
+            if any(m.name == metric.name for m in self._metrics):
+                raise ValueError(f"metric {metric.name} declared twice")
+            base = self._cells
+            self._cells += cells
+            self._metrics.append(metric)
+            return base
+
+    def counter(self, name, help_text, labelnames=(), labelvalues=()) -> Counter:
+        return Counter(self, name, help_text, labelnames, labelvalues)
+
+    def histogram(self, name, help_text, labelnames=(), labelvalues=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return Histogram(self, name, help_text, labelnames, labelvalues, buckets)
+
+    def callback(self, name, help_text, fn, kind="gauge", labelnames=()):
+        with self._lock:
+            self._metrics.append(_Callback(name, help_text, kind, fn, labelnames))
+
+    # ── storage ──────────────────────────────────
+    @property
+    def _row_size(self):
+        return _OWNER.size + self._cells * 8
+
+    def _fingerprint(self) -> bytes:
+        layout = [(m.name, m.kind, m.labelnames, getattr(m, "series", None), getattr(m, "buckets", None))
+                  for m in self._metrics if isinstance(m, _Metric)]
+        return hashlib.sha256(repr(layout).encode()).digest()
+
+    def open(self, path=None):
+        """Fix the layout and allocate rows: in `path`, shared by every worker, or privately."""
+        with self._lock:
+            if self._buf is not None:
+                return
+            size = _HEADER_SIZE + self.rows * self._row_size
+            if path and fcntl:
+                try:
+                    self._file, self._buf = self._open_file(path, size)
+                    self.path = path
+                except OSError as e:
+                    logger.error(f"Shared metrics disabled ({path}): {e}")
+            if self._buf is None:
+                self._buf = bytearray(size)
+            self._spill = memoryview(bytearray(self._cells * 8)).cast("d")
+
+    def _open_file(self, path, size):
+        f = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), "r+b")
+        fcntl.lockf(f.fileno(), fcntl.LOCK_EX)
+        try:
+            expected = (_MAGIC, _FORMAT, self.rows, self._cells, self._fingerprint())
+            header = f.read(_HEADER.size)
+            if len(header) == _HEADER.size and os.fstat(f.fileno()).st_size == size \
+                    and _HEADER.unpack(header) == expected:
+                return f, mmap.mmap(f.fileno(), size)
+            if os.fstat(f.fileno()).st_size >= _HEADER_SIZE and self._live_owners(f):
+                # Workers running other code (a rolling restart) still write here
+                f.close()
+                raise OSError(f"{path} is in use with a different metric layout")
+            logger.info(f"Metrics file {path} missing or from other code, initialising")
+            f.truncate(0)
+            f.truncate(size)
+            f.seek(0)
+            f.write(_HEADER.pack(*expected))
+            f.flush()
+            return f, mmap.mmap(f.fileno(), size)
+        finally:
+            if not f.closed:
+                fcntl.lockf(f.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def _live_owners(f) -> bool:
+        f.seek(0)
+        magic, _, rows, cells, _ = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != _MAGIC:
+            return False
+        for r in range(rows):
+            f.seek(_HEADER_SIZE + r * (_OWNER.size + cells * 8))
+            raw = f.read(_OWNER.size)
+            if len(raw) < _OWNER.size:
+                break
+            pid = _OWNER.unpack(raw)[0]
+            if pid and pid != os.getpid() and pid_alive(pid):
+                return True
+        return False
+
+    def row(self):
+        """This thread's cells (a memoryview of float64) to add into."""
+        try:
+            return self._local.row
+        except AttributeError:
+            return self._claim()
+
+    def _claim(self):
+        if self._buf is None:
+            self.open()
+        pid = os.getpid()
+        live_threads = {t.ident for t in threading.enumerate()}
+        alive = {pid: True}
+        row = None
+        with self._lock:
+            if self._file is not None:
+                fcntl.lockf(self._file.fileno(), fcntl.LOCK_EX, 1, 0)
+            try:
+                for r in range(self.rows):
+                    off = _HEADER_SIZE + r * self._row_size
+                    owner, thread = _OWNER.unpack_from(self._buf, off)
+                    if owner == pid:
+                        free = thread not in live_threads
+                    elif owner:
+                        if owner not in alive:
+                            alive[owner] = pid_alive(owner)
+                        free = not alive[owner]
+                    else:
+                        free = True
+                    if free:
+                        _OWNER.pack_into(self._buf, off, pid, threading.get_ident())
+                        start = off + _OWNER.size
+                        row = memoryview(self._buf)[start:start + self._cells * 8].cast("d")
+                        break
+            finally:
+                if self._file is not None:
+                    fcntl.lockf(self._file.fileno(), fcntl.LOCK_UN, 1, 0)
+        if row is None:
+            logger.warning(f"All {self.rows} metric rows in use; this thread shares a spill row")
+            row = self._spill
+        self._local.row = row
+        return row
+
+    # ── exposition ───────────────────────────────
+    def totals(self) -> list:
+        if self._buf is None:
+            return [0.0] * self._cells
+        values = struct.Struct(f"<{self._cells}d")
+        totals = list(self._spill)
+        for r in range(self.rows):
+            off = _HEADER_SIZE + r * self._row_size
+            if _OWNER.unpack_from(self._buf, off)[0]:
+                totals = [a + b for a, b in zip(totals, values.unpack_from(self._buf, off + _OWNER.size))]
+        return totals
+
+    def exposition(self) -> str:
+        totals = self.totals()
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.lines(totals))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text, labelnames=(), labelvalues=()) -> Counter:
+    return REGISTRY.counter(name, help_text, labelnames, labelvalues)
+
+
+def histogram(name, help_text, labelnames=(), labelvalues=(), buckets=LATENCY_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, help_text, labelnames, labelvalues, buckets)
+
+
+def callback(name, help_text, fn, kind="gauge", labelnames=()):
+    REGISTRY.callback(name, help_text, fn, kind, labelnames)
+
+
+# ────────────────────────────────────────────────
+# Flask
+# ────────────────────────────────────────────────
+class _CountedBody:
+    """A response body that adds the length of each chunk it yields to counted[0]."""
+
+    def __init__(self, body, counted):
+        self._body = body
+        self._counted = counted
+
+    def __iter__(self):
+        for chunk in self._body:
+            self._counted[0] += len(chunk)
+            yield chunk
+
+    def close(self):
+        close = getattr(self._body, "close", None)
+        if close is not None:
+            close()
+
+
+def _after_close(body, fn):
+    """Run fn once the server closes body; right away if its close() cannot be hooked."""
+    close = getattr(body, "close", None)
+
+    def close_then():
+        try:
+            if close is not None:
+                close()
+        finally:
+            fn()
+
+    try:
+        body.close = close_then
+    except AttributeError:
+        fn()
+
+
+def instrument(app, path=None, registry=REGISTRY):
+    """Time every request per route and serve GET /metrics; then opens the registry.
+
+    Call once every route is registered: routes are label values.  Duration
+    and bytes run to the last body byte sent, so streamed bodies count in full.
+    """
+    from flask import Response, request
+
+    routes = sorted({rule.endpoint for rule in app.url_map.iter_rules()} | {"metrics", "other"})
+    known = frozenset(routes)
+    requests_total = registry.counter("reidproxy_http_requests_total", "Requests answered, by route and status class.",
+                                      ("route", "code"), (routes, CODE_CLASSES))
+    duration = registry.histogram("reidproxy_http_request_duration_seconds",
+                                  "Time from request start to the last response byte, by route.",
+                                  ("route",), (routes,))
+    sent = registry.counter("reidproxy_http_response_bytes_total", "Response body bytes sent, by route.",
+                            ("route",), (routes,))
+
+    @app.before_request
+    def _metrics_start():
+        request.environ["reidproxy.metrics_start"] = time.perf_counter()
+
+    @app.after_request
+    def _metrics_observe(response):
+        start = request.environ.get("reidproxy.metrics_start")
+        if start is None:
+            return response
+        route = request.url_rule.endpoint if request.url_rule is not None else "other"
+        route = route if route in known else "other"
+        code = CODE_CLASSES[min(4, max(0, response.status_code // 100 - 1))]
+        counted = [response.content_length]
+        if counted[0] is None:
+            counted[0] = 0
+            response.response = _CountedBody(response.response, counted)
+
+        def done():
+            duration.observe(time.perf_counter() - start, route)
+            requests_total.inc(route, code)
+            sent.inc(route, amount=counted[0])
+
+        if response.direct_passthrough:
+            # Handed to the server as is (send_file): werkzeug adds no closing
+            # wrapper, so call_on_close would never run; hooking the body's
+            # close() keeps wsgi.file_wrapper (sendfile) in play
+            _after_close(response.response, done)
+        else:
+            response.call_on_close(done)
+        return response
+
+    def metrics_view():
+        return Response(registry.exposition(), content_type=CONTENT_TYPE)
+
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+    registry.open(path)
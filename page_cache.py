@@ -0,0 +1,264 @@
+# page_cache.py - cache of final, rewritten HTML pages
+#
+# Popular landing pages went through fetch → decode → rewrite (→ Chrome
+# render) on every hit even when upstream answered with the same ETag.  This
+# cache keeps the finished bytes, already compressed, keyed by target URL and
+# rewrite mode.  The upstream validators travel with each entry: a stale entry
+# is revalidated with If-None-Match/If-Modified-Since and a 304 skips the
+# rewrite entirely, while entries inside their stale-while-revalidate window
+# are served immediately and refreshed on a background worker.
+#
+# Concurrent misses for the same key share one producer (coalesce()), so ten
+# users opening the same Chrome-rendered page cost one render, not ten.
+import gzip
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlunsplit
+
+import compression
+from asset_cache import (StoredResponse, freshness_lifetime, merge_revalidation,
+                         parse_cache_control, get_header)
+
+logger = logging.getLogger(__name__)
+
+# Rewrite modes (part of the key: the same URL rewritten differently is a different page)
+MODE_STEALTH = "stealth"      # app.py /p/ streaming rewriter
+MODE_REQUESTS = "requests"    # /proxy via requests + lexer rewrite
+MODE_CHROME = "chrome"        # /proxy via headless Chrome + lexer rewrite
+
+_STORE_LEVEL = 9              # compressed once per store, so spend the CPU
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def canonical_url(url):
+    """url with scheme and host lower-cased and the default port and fragment dropped."""
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ""
+    if ":" in host:
+        host = f"[{host}]"
+    netloc = host if port in (None, _DEFAULT_PORTS.get(scheme)) else f"{host}:{port}"
+    if "@" in parts.netloc:
+        netloc = parts.netloc.rsplit("@", 1)[0] + "@" + netloc
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+def make_key(url, mode):
+    return (canonical_url(url), mode)
+
+
+class _Flight:
+    """One in-progress coalesced production and its outcome."""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class PageEntry(StoredResponse):
+    """A rewritten page held compressed with `encoding`."""
+
+    __slots__ = ("body", "encoding", "raw_size", "stale_until")
+
+    def __init__(self, status, headers, body, encoding, raw_size, lifetime, stale_seconds, now=None):
+        super().__init__(status, headers, len(body), lifetime, now)
+        self.body = body
+        self.encoding = encoding
+        self.raw_size = raw_size
+        self.stale_until = self.expires_at + stale_seconds
+
+    def can_serve_stale(self, now=None):
+        return (time.time() if now is None else now) < self.stale_until
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return compression.brotli.compress(data, quality=11)
+    if encoding == "gzip":
+        return gzip.compress(data, _STORE_LEVEL)
+    return zlib.compress(data, _STORE_LEVEL)
+
+
+def _decompress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return compression.brotli.decompress(data)
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    return zlib.decompress(data)
+
+
+class PageCache:
+    """Byte-bounded LRU of rewritten pages with stale-while-revalidate."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, stale_seconds=60, refresh_workers=2):
+        self.max_bytes = max_bytes
+        self.stale_seconds = stale_seconds
+        self.encoding = compression.PRODUCIBLE[0]
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._flights = {}
+        self._executor = ThreadPoolExecutor(max_workers=refresh_workers,
+                                            thread_name_prefix="page-refresh")
+        self._stats = dict.fromkeys(
+            ("lookups", "hits", "stale_hits", "revalidated", "stores", "evictions",
+             "refreshes", "refresh_errors", "rewrite_bytes_skipped", "produced", "coalesced"), 0)
+
+    def _count(self, field, n=1):
+        with self._lock:
+            self._stats[field] += n
+
+    def lookup(self, key):
+        with self._lock:
+            self._stats["lookups"] += 1
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def store(self, key, status, headers, html: bytes, lifetime=None, stale=None):
+        """Compress and keep a freshly rewritten page; returns the entry or None.
+
+        `lifetime` overrides upstream freshness (used for Chrome renders, which
+        carry no cache headers) and `stale` the stale-while-revalidate window.
+        """
+        if lifetime is None and status == 200:
+            lifetime = freshness_lifetime(headers)
+        if status != 200 or lifetime is None:
+            self.discard(key)
+            return None
+        stale = self._stale_window(headers, stale)
+
+        headers = {k: v for k, v in headers.items()
+                   if k.lower() not in ("content-encoding", "content-length", "vary")}
+        entry = PageEntry(status, headers, _compress(html, self.encoding), self.encoding,
+                          len(html), lifetime, stale)
+        if entry.size > self.max_bytes:
+            self.discard(key)
+            return None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            self._stats["stores"] += 1
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self._stats["evictions"] += 1
+        return entry
+
+    def _stale_window(self, headers, stale=None):
+        """Seconds a page may be served stale while it is refreshed in the background."""
+        directives = parse_cache_control(get_header(headers, "Cache-Control"))
+        stale = self.stale_seconds if stale is None else stale
+        if "no-cache" in directives or "must-revalidate" in directives:
+            stale = 0   # never used unrevalidated, unless upstream grants a window itself
+        swr = directives.get("stale-while-revalidate")
+        if swr and swr.isdigit():
+            stale = max(stale, int(swr))
+        return stale
+
+    def revalidated(self, key, entry, headers, lifetime=None):
+        """Upstream said 304: keep the rewritten bytes, refresh freshness."""
+        merged = merge_revalidation(entry.headers, headers)
+        if lifetime is None:
+            lifetime = freshness_lifetime(merged)
+        self._count("revalidated")
+        if lifetime is None:
+            return entry
+        fresh = PageEntry(entry.status, merged, entry.body, entry.encoding, entry.raw_size,
+                          lifetime, self._stale_window(merged, entry.stale_until - entry.expires_at))
+        with self._lock:
+            if self._entries.get(key) is entry:
+                self._entries[key] = fresh
+        return fresh
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry.size
+
+    def coalesce(self, key, produce):
+        """Return produce(), running it once for all concurrent callers with key.
+
+        Callers that arrive while a producer runs wait for it and share its
+        result (or its exception).
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._stats["produced"] += 1
+            else:
+                self._stats["coalesced"] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = produce()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def refresh_async(self, key, refresh):
+        """Run refresh() on a background worker unless one is already running for key."""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            self._stats["refreshes"] += 1
+
+        def run():
+            try:
+                refresh()
+            except Exception as e:
+                self._count("refresh_errors")
+                logger.warning(f"Background page refresh failed for {key[0]}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._executor.submit(run)
+        return True
+
+    def body_for(self, entry, accept_encoding, cache_status="HIT"):
+        """(body, headers) for a client: stored encoding if accepted, else identity."""
+        self._count("stale_hits" if cache_status == "STALE" else "hits")
+        self._count("rewrite_bytes_skipped", entry.raw_size)
+        headers = entry.response_headers(cache_status)
+        headers.pop("Content-Length", None)
+        if entry.encoding in compression.accepted(accept_encoding, (entry.encoding,)):
+            return entry.body, compression.encoded_headers(headers, entry.encoding)
+        return _decompress(entry.body, entry.encoding), headers
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            info = dict(self._stats)
+            info.update(entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes,
+                        refreshing=len(self._refreshing), in_flight=len(self._flights))
+        served = info["hits"] + info["stale_hits"]
+        info["hit_ratio"] = round(served / info["lookups"], 4) if info["lookups"] else 0.0
+        return info
@@ -0,0 +1,201 @@
+# policy.py - compiled host policy for blocklists, allowlists and Chrome routing
+#
+# Every request used to walk three matchers linearly: substring tests over
+# DENY_LIST_SUBSTRINGS, exact-match domain sets, and a `chrome_domain in
+# domain` loop that also matched "notreddit.com.evil".  HostPolicy compiles
+# any number of named lists once: domains go into a trie keyed by reversed
+# labels (an entry covers the name and all its subdomains), networks into a
+# table of masked prefixes per prefix length, and per-host answers are kept
+# in an LRU.  A lookup costs O(labels) or O(distinct prefix lengths) no
+# matter how many entries the lists hold.
+import ipaddress
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 65536
+_END = ""  # trie key holding the list bits of a complete entry (labels are never empty)
+
+
+def normalize_host(host: str) -> str:
+    return (host or "").strip().strip("[]").rstrip(".").lower()
+
+
+def _address(host: str):
+    if not host or not (host[0].isdigit() or ":" in host):
+        return None
+    try:
+        ip = ipaddress.ip_address(host.split("%", 1)[0])
+    except ValueError:
+        return None
+    mapped = getattr(ip, "ipv4_mapped", None)
+    return mapped if mapped is not None else ip
+
+
+def parse_entry(line: str):
+    """One list line → ("domain", name) / ("network", ip_network) / None.
+
+    Accepts plain names, "*.name" / ".name", hosts-file lines
+    ("0.0.0.0 ads.example.com"), adblock "||name^" and IPs / CIDRs.
+    """
+    line = line.split("#", 1)[0].strip()
+    if not line:
+        return None
+    token = line.split()[-1]
+    if token.startswith("||"):
+        token = token[2:].rstrip("^")
+    try:
+        return "network", ipaddress.ip_network(token.strip("[]"), strict=False)
+    except ValueError:
+        pass
+    name = normalize_host(token.lstrip("*").lstrip("."))
+    if not name or "/" in name:
+        return None
+    return "domain", name
+
+
+def match_suffix(mapping: dict, host: str):
+    """Value of the longest key in mapping that is host or one of its parent domains."""
+    labels = normalize_host(host).split(".")
+    for i in range(len(labels)):
+        value = mapping.get(".".join(labels[i:]))
+        if value is not None:
+            return value
+    return None
+
+
+def load_list(path: str) -> list:
+    """Lines of a blocklist file (one entry per line, see parse_entry)."""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return f.read().splitlines()
+
+
+# ────────────────────────────────────────────────
+# Matchers
+# ────────────────────────────────────────────────
+class DomainTrie:
+    """Reversed-label trie: "reddit.com" matches reddit.com and *.reddit.com only."""
+
+    def __init__(self):
+        self._root = {}
+        self.size = 0
+
+    def add(self, name: str, bits: int):
+        node = self._root
+        for label in reversed(name.split(".")):
+            node = node.setdefault(label, {})
+        if _END not in node:
+            self.size += 1
+        node[_END] = node.get(_END, 0) | bits
+
+    def match(self, host: str) -> int:
+        """OR of the bits of every entry that is host or a parent of it."""
+        bits = 0
+        node = self._root
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            bits |= node.get(_END, 0)
+        return bits
+
+
+class NetworkTable:
+    """Networks grouped by prefix length; a lookup masks the address once per length."""
+
+    def __init__(self):
+        self._tables = {4: {}, 6: {}}   # version -> {prefixlen: {network int >> host bits: bits}}
+        self.size = 0
+
+    def add(self, network, bits: int):
+        host_bits = network.max_prefixlen - network.prefixlen
+        table = self._tables[network.version].setdefault(network.prefixlen, {})
+        key = int(network.network_address) >> host_bits
+        if key not in table:
+            self.size += 1
+        table[key] = table.get(key, 0) | bits
+
+    def match(self, ip) -> int:
+        bits = 0
+        value = int(ip)
+        for prefixlen, table in self._tables[ip.version].items():
+            bits |= table.get(value >> (ip.max_prefixlen - prefixlen), 0)
+        return bits
+
+
+# ────────────────────────────────────────────────
+# Compiled policy
+# ────────────────────────────────────────────────
+class HostPolicy:
+    """Named host lists compiled for constant-cost lookups.
+
+        policy = HostPolicy(block=[...], allow=[...], chrome=[...])
+        policy.matches("www.reddit.com")  ->  frozenset({"chrome"})
+    """
+
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE, **lists):
+        self.names = tuple(lists)
+        self.cache_size = cache_size
+        self._bits = {name: 1 << i for i, name in enumerate(self.names)}
+        self._domains = DomainTrie()
+        self._networks = NetworkTable()
+        self._counts = dict.fromkeys(self.names, 0)
+        for name, entries in lists.items():
+            for entry in entries or ():
+                parsed = parse_entry(entry)
+                if parsed is None:
+                    continue
+                kind, value = parsed
+                if kind == "domain":
+                    self._domains.add(value, self._bits[name])
+                else:
+                    self._networks.add(value, self._bits[name])
+                self._counts[name] += 1
+        self._verdicts = OrderedDict()  # host -> frozenset of list names
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(("lookups", "hits", "evictions"), 0)
+
+    def has(self, name: str) -> bool:
+        """True if list `name` has any entries (an empty allowlist allows everything)."""
+        return bool(self._counts.get(name))
+
+    def _compute(self, host: str) -> frozenset:
+        ip = _address(host)
+        bits = self._networks.match(ip) if ip is not None else self._domains.match(host)
+        return frozenset(name for name, bit in self._bits.items() if bits & bit)
+
+    def matches(self, host: str) -> frozenset:
+        """Names of the lists that cover host (a domain, or an IP against the networks)."""
+        host = normalize_host(host)
+        with self._lock:
+            self._stats["lookups"] += 1
+            verdict = self._verdicts.get(host)
+            if verdict is not None:
+                self._stats["hits"] += 1
+                self._verdicts.move_to_end(host)
+                return verdict
+        verdict = self._compute(host)
+        with self._lock:
+            self._verdicts[host] = verdict
+            if len(self._verdicts) > self.cache_size:
+                self._verdicts.popitem(last=False)
+                self._stats["evictions"] += 1
+        return verdict
+
+    def address_matches(self, address: str) -> frozenset:
+        """Lists whose networks contain a resolved address (not cached)."""
+        ip = _address(normalize_host(address))
+        if ip is None:
+            return frozenset()
+        bits = self._networks.match(ip)
+        return frozenset(name for name, bit in self._bits.items() if bits & bit)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            info = dict(self._stats)
+            info["cached"] = len(self._verdicts)
+        info["hit_ratio"] = round(info["hits"] / info["lookups"], 4) if info["lookups"] else 0.0
+        info.update(lists=dict(self._counts), domains=self._domains.size, networks=self._networks.size)
+        return info
@@ -0,0 +1,121 @@
+# rate_limit.py - per-client rate limiting with constant memory per key
+#
+# The old limiter kept a deque of request timestamps per IP (up to
+# RATE_LIMIT floats each) in a dict that was never pruned, behind one global
+# lock taken on every /proxy call.  This one implements GCRA, the
+# token-bucket equivalent that needs a single float per key: the
+# "theoretical arrival time" (TAT) at which the key's bucket is full again.
+#
+#   interval = window / max_requests       one token per interval
+#   burst    = window - interval           max_requests back to back
+#   allow if TAT - now <= burst, then TAT = max(TAT, now) + interval
+#
+# Keys are spread over independently locked shards, and a key whose TAT is
+# in the past holds a full bucket - exactly what an absent key means - so
+# the sweeper can drop it without changing any future decision.
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARDS = 64
+
+
+class _Shard:
+    __slots__ = ("lock", "tats")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tats = {}   # key -> theoretical arrival time (time.monotonic())
+
+
+class RateLimiter:
+    """max_requests per window seconds per key (GCRA), O(1) state per active key.
+
+        limiter = RateLimiter(2000, 60).start()   # start() runs the idle-key sweeper
+        limiter.is_allowed(client_ip)
+    """
+
+    def __init__(self, max_requests=60, window=60, shards=DEFAULT_SHARDS, sweep_interval=30.0):
+        self.max_requests = max_requests
+        self.window = window
+        self.interval = window / max_requests
+        self.burst = window - self.interval
+        self.sweep_interval = sweep_interval
+        self._shards = tuple(_Shard() for _ in range(shards))
+        self._stats_lock = threading.Lock()
+        self._stats = dict.fromkeys(("denied", "evicted", "sweeps"), 0)
+        self._stop = threading.Event()
+        self._sweeper = None
+
+    def _shard(self, key) -> _Shard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def is_allowed(self, key, now=None) -> bool:
+        now = time.monotonic() if now is None else now
+        shard = self._shard(key)
+        with shard.lock:
+            tat = shard.tats.get(key, now)
+            if tat < now:
+                tat = now
+            if tat - now > self.burst:
+                allowed = False
+            else:
+                shard.tats[key] = tat + self.interval
+                allowed = True
+        if not allowed:
+            with self._stats_lock:
+                self._stats["denied"] += 1
+        return allowed
+
+    def retry_after(self, key, now=None) -> int:
+        """Whole seconds until key may make its next request (0 if it may now)."""
+        now = time.monotonic() if now is None else now
+        shard = self._shard(key)
+        with shard.lock:
+            tat = shard.tats.get(key, now)
+        return max(0, math.ceil(tat - self.burst - now))
+
+    # ── idle keys ────────────────────────────────
+    def sweep(self, now=None) -> int:
+        """Drop keys whose bucket has refilled; one shard locked at a time."""
+        now = time.monotonic() if now is None else now
+        evicted = 0
+        for shard in self._shards:
+            with shard.lock:
+                idle = [key for key, tat in shard.tats.items() if tat <= now]
+                for key in idle:
+                    del shard.tats[key]
+            evicted += len(idle)
+        with self._stats_lock:
+            self._stats["evicted"] += evicted
+            self._stats["sweeps"] += 1
+        return evicted
+
+    def _sweep_loop(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Rate limiter sweep failed: {e}")
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="rate-limit-sweep", daemon=True)
+            self._sweeper.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def __len__(self):
+        return sum(len(shard.tats) for shard in self._shards)
+
+    def snapshot(self) -> dict:
+        with self._stats_lock:
+            info = dict(self._stats)
+        info.update(keys=len(self), shards=len(self._shards), max_requests=self.max_requests,
+                    window=self.window)
+        return info
@@ -0,0 +1,138 @@
+# render_queue.py - admission control for headless Chrome renders
+#
+# When every Chrome tab was busy the pool used to start more browsers
+# without limit, so a burst of traffic to Chrome-rendered domains could
+# exhaust the host's RAM.  Renders now take a slot from this queue first:
+# at most `slots` run at once, at most `max_depth` wait, waiters are served
+# by priority class (interactive navigations before background refreshes
+# before retries) and FIFO within a class, and each carries a deadline.
+# A full queue or a missed deadline raises Overloaded with a Retry-After
+# estimate; the caller answers 503 or degrades to a plain fetch.
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+PRIORITY_INTERACTIVE = 0   # a user navigating to the page
+PRIORITY_BACKGROUND = 1    # stale-while-revalidate refreshes
+PRIORITY_RETRY = 2         # re-render after a failure
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background",
+                  PRIORITY_RETRY: "retry"}
+
+_SERVICE_ALPHA = 0.2       # EWMA weight of the latest render time
+
+QUEUE_WAIT = metrics.histogram("reidproxy_chrome_queue_wait_seconds",
+                               "Time renders waited for a Chrome slot, by priority class.",
+                               ("priority",), (tuple(PRIORITY_NAMES.values()),), buckets=metrics.RENDER_BUCKETS)
+
+
+class Overloaded(Exception):
+    """No render slot: `reason` is "full" or "timeout"; retry_after is in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"render queue {reason}, retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class RenderQueue:
+    """Bounded priority queue in front of `slots` concurrent renders."""
+
+    def __init__(self, slots, max_depth=32, initial_service_seconds=3.0):
+        self.slots = max(1, slots)
+        self.max_depth = max_depth
+        self._cond = threading.Condition()
+        self._heap = []                 # [priority, seq, deadline]
+        self._seq = itertools.count()
+        self._inflight = 0
+        self._service = initial_service_seconds
+        self._stats = dict.fromkeys(("admitted", "queued", "rejected_full", "timed_out", "degraded",
+                                     "max_depth_seen"), 0)
+        self._waits = {name: [0, 0.0, 0.0] for name in PRIORITY_NAMES.values()}  # count, total, max
+
+    def _record_wait(self, priority, seconds):
+        name = PRIORITY_NAMES.get(priority, "retry")
+        QUEUE_WAIT.observe(seconds, name)
+        w = self._waits[name]
+        w[0] += 1
+        w[1] += seconds
+        w[2] = max(w[2], seconds)
+
+    def retry_after(self) -> int:
+        """Seconds until a newly queued render would likely get a slot."""
+        with self._cond:
+            return self._retry_after()
+
+    def _retry_after(self):
+        return max(1, math.ceil((len(self._heap) + 1) / self.slots * self._service))
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, deadline=None):
+        """Wait for a slot until deadline (time.monotonic()); raises Overloaded."""
+        start = time.monotonic()
+        with self._cond:
+            if self._inflight < self.slots and not self._heap:
+                self._inflight += 1
+                self._stats["admitted"] += 1
+                self._record_wait(priority, 0.0)
+                return
+            if len(self._heap) >= self.max_depth:
+                self._stats["rejected_full"] += 1
+                raise Overloaded("full", self._retry_after())
+            ticket = [priority, next(self._seq), deadline]
+            heapq.heappush(self._heap, ticket)
+            self._stats["queued"] += 1
+            self._stats["max_depth_seen"] = max(self._stats["max_depth_seen"], len(self._heap))
+            while True:
+                if self._heap[0] is ticket and self._inflight < self.slots:
+                    heapq.heappop(self._heap)
+                    self._inflight += 1
+                    self._stats["admitted"] += 1
+                    self._record_wait(priority, time.monotonic() - start)
+                    self._cond.notify_all()
+                    return
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._heap.remove(ticket)
+                    heapq.heapify(self._heap)
+                    self._stats["timed_out"] += 1
+                    self._cond.notify_all()
+                    raise Overloaded("timeout", self._retry_after())
+                self._cond.wait(remaining)
+
+    def release(self, service_seconds=None):
+        with self._cond:
+            self._inflight -= 1
+            if service_seconds is not None:
+                self._service += _SERVICE_ALPHA * (service_seconds - self._service)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority=PRIORITY_INTERACTIVE, deadline=None):
+        self.acquire(priority, deadline)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    def count(self, field, n=1):
+        with self._cond:
+            self._stats[field] += n
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            info = dict(self._stats)
+            info.update(slots=self.slots, max_depth=self.max_depth, inflight=self._inflight,
+                        depth=len(self._heap), service_avg_ms=round(self._service * 1000, 1),
+                        retry_after=self._retry_after())
+            waits = {name: list(w) for name, w in self._waits.items()}
+        info["wait"] = {
+            name: {"count": n, "avg_ms": round(total / n * 1000, 1) if n else 0.0,
+                   "max_ms": round(peak * 1000, 1)}
+            for name, (n, total, peak) in waits.items()
+        }
+        return info
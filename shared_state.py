@@ -0,0 +1,325 @@
+# shared_state.py - rate limiting and counters shared by every worker process
+#
+# Under `gunicorn -w N` each worker had its own RateLimiter, so a client got
+# N times its budget, and each stats object only counted the requests its
+# own worker served.  Both now live in files that every worker maps, under
+# /dev/shm (i.e. in shared memory) where it exists - the same mechanism
+# disk_cache.py uses for its index:
+#
+#   <name>           header + fixed-size GCRA slots (key hash, TAT) split
+#                    into stripes; a stripe is held with a Lock (threads)
+#                    plus an fcntl byte-range lock on byte <stripe> (workers)
+#   <name>.counters  header + one row of counters per worker process; each
+#                    row has a single writer, so increments take no
+#                    cross-process lock and readers add the rows up
+#
+# A mapped file rather than multiprocessing.shared_memory: workers need not
+# share a Python parent that owns the segment, and the shared_memory
+# resource tracker unlinks a segment when the process that created it exits.
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from disk_cache import pid_alive
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process locking, one worker per file
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+_LIMIT_MAGIC = b"RPRL"
+_COUNTERS_MAGIC = b"RPCT"
+_FORMAT = 1
+# magic, format, slots / rows, stripes / fields
+_HEADER = struct.Struct("<4sIII")
+_HEADER_SIZE = 64
+# key hash (0 = never used), theoretical arrival time (time.time())
+_SLOT = struct.Struct("<Qd")
+_MAX_PROBE = 16
+_PID = struct.Struct("<Q")
+_VALUE = struct.Struct("<d")
+
+
+def _open_mapped(path, magic, count, width, size):
+    """(file, mmap) of path, replaced by a fresh file unless its header already matches.
+
+    Never truncated in place: workers still mapping an incompatible file (a
+    rolling deploy that changed its layout) would get SIGBUS.  They keep the
+    old file, unlinked, until they exit.
+    """
+    header = _HEADER.pack(magic, _FORMAT, count, width)
+    while True:
+        f = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), "r+b")
+        found = None
+        if fcntl:
+            fcntl.lockf(f.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                pass    # replaced while we waited for the lock: open the new file
+            elif os.fstat(f.fileno()).st_size == size and f.read(_HEADER.size) == header:
+                found = f
+            else:
+                logger.info(f"Shared state {path} missing or incompatible, initialising")
+                found = _replace_file(path, header, size)
+        finally:
+            if fcntl:
+                fcntl.lockf(f.fileno(), fcntl.LOCK_UN)
+            if found is not f:
+                f.close()
+        if found is not None:
+            return found, mmap.mmap(found.fileno(), size)
+
+
+def _replace_file(path, header, size):
+    """A file of size bytes starting with header, renamed over path once complete."""
+    new_path = f"{path}.{os.getpid()}.new"
+    f = os.fdopen(os.open(new_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600), "r+b")
+    try:
+        f.truncate(size)
+        f.write(header)
+        f.flush()
+        os.replace(new_path, path)
+    except BaseException:
+        f.close()
+        os.unlink(new_path)
+        raise
+    return f
+
+
+def _key_hash(key) -> int:
+    """Stable across processes (unlike hash()), and a third of blake2b's cost.
+
+    CRC-32 (low bits: stripe and probe start) plus Adler-32; 0 marks empty slots.
+    """
+    data = str(key).encode("utf-8", "surrogatepass")
+    return (zlib.adler32(data) << 32 | zlib.crc32(data)) or 1
+
+
+# ────────────────────────────────────────────────
+# Counters
+# ────────────────────────────────────────────────
+class SharedCounters:
+    """incr() / snapshot() like the modules' stats objects, totalled over every worker.
+
+    A worker takes a row on its first increment (again after a fork); rows of
+    dead workers are taken over with their totals, so restarts lose nothing.
+    """
+
+    def __init__(self, path, fields, rows=256):
+        self.path = path
+        self.fields = tuple(fields)
+        self.rows = rows
+        self._index = {field: i for i, field in enumerate(self.fields)}
+        self._values = struct.Struct(f"<{len(self.fields)}d")
+        self._row_size = _PID.size + self._values.size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._row = None
+        self._local = dict.fromkeys(self.fields, 0)  # only when every row is taken
+        self._file, self._map = _open_mapped(path, _COUNTERS_MAGIC, rows, len(self.fields),
+                                             _HEADER_SIZE + rows * self._row_size)
+
+    def _claim(self):
+        pid = os.getpid()
+        if fcntl:
+            fcntl.lockf(self._file.fileno(), fcntl.LOCK_EX, 1, 0)
+        try:
+            for r in range(self.rows):
+                off = _HEADER_SIZE + r * self._row_size
+                owner = _PID.unpack_from(self._map, off)[0]
+                if owner == 0 or (owner != pid and not pid_alive(owner)):
+                    _PID.pack_into(self._map, off, pid)
+                    return off + _PID.size
+        finally:
+            if fcntl:
+                fcntl.lockf(self._file.fileno(), fcntl.LOCK_UN, 1, 0)
+        logger.warning(f"No free row in {self.path}, counting for this worker only")
+        return None
+
+    def incr(self, field: str, n=1):
+        i = self._index[field]
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._row = self._claim()
+            if self._row is None:
+                self._local[field] += n
+                return
+            off = self._row + i * _VALUE.size
+            _VALUE.pack_into(self._map, off, _VALUE.unpack_from(self._map, off)[0] + n)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            totals = [self._local[field] for field in self.fields]
+        for r in range(self.rows):
+            off = _HEADER_SIZE + r * self._row_size
+            if _PID.unpack_from(self._map, off)[0]:
+                for i, value in enumerate(self._values.unpack_from(self._map, off + _PID.size)):
+                    totals[i] += value
+        return {field: int(v) if float(v).is_integer() else v for field, v in zip(self.fields, totals)}
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class SharedableStats:
+    """Named counters kept in-process until share() hands them to SharedCounters.
+
+    Subclasses set FIELDS; a module keeps one instance as `stats` so that
+    share_stats() can find it.
+    """
+
+    FIELDS = ()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(self.FIELDS, 0)
+        self._shared = None
+
+    def share(self, counters):
+        """Count into a SharedCounters from now on (totals over every worker)."""
+        self._shared = counters
+
+    def incr(self, field: str, n=1):
+        if self._shared is not None:
+            self._shared.incr(field, n)
+            return
+        with self._lock:
+            self._counts[field] += n
+
+    def snapshot(self) -> dict:
+        if self._shared is not None:
+            return self._shared.snapshot()
+        with self._lock:
+            return dict(self._counts)
+
+
+def share_stats(directory, prefix, *modules):
+    """Make each module's `stats` object count into SharedCounters under directory."""
+    for module in modules:
+        stats = module.stats
+        stats.share(SharedCounters(os.path.join(directory, f"{prefix}-{module.__name__}.counters"),
+                                   stats.FIELDS))
+
+
+# ────────────────────────────────────────────────
+# Rate limiting
+# ────────────────────────────────────────────────
+class SharedRateLimiter:
+    """rate_limit.RateLimiter whose state every worker on the host maps: one budget per client.
+
+    Slots whose bucket has refilled are free for reuse, so no sweeper is
+    needed.  When every probed slot is live the one refilling soonest is
+    given up (that client starts afresh); these are counted as "overflow".
+    """
+
+    def __init__(self, path, max_requests=60, window=60, slots=1 << 20, stripes=64):
+        self.path = path
+        self.max_requests = max_requests
+        self.window = window
+        self.interval = window / max_requests
+        self.burst = window - self.interval
+        self.stripes = stripes
+        self._per_stripe = max(_MAX_PROBE, slots // stripes)
+        self.slots = self._per_stripe * stripes
+        self._locks = tuple(threading.Lock() for _ in range(stripes))
+        self._file, self._map = _open_mapped(path, _LIMIT_MAGIC, self.slots, stripes,
+                                             _HEADER_SIZE + self.slots * _SLOT.size)
+        self._fd = self._file.fileno()
+        self._counters = SharedCounters(path + ".counters", ("denied", "overflow"))
+
+    def _find(self, h, stripe, now):
+        """(offset, tat, overflow) for h: its slot, else a free one, else the soonest to refill."""
+        per_stripe, unpack, m = self._per_stripe, _SLOT.unpack_from, self._map
+        base = _HEADER_SIZE + stripe * per_stripe * _SLOT.size
+        start = (h // self.stripes) % per_stripe
+        off = base + start * _SLOT.size
+        slot_hash, tat = unpack(m, off)
+        if slot_hash == h or slot_hash == 0:    # the usual case: decided by the first probe
+            return off, (tat if slot_hash else now), False
+        free = victim = None
+        victim_tat = 0.0
+        for n in range(_MAX_PROBE):
+            off = base + (start + n) % per_stripe * _SLOT.size
+            slot_hash, tat = unpack(m, off)
+            if slot_hash == h:
+                return off, tat, False
+            if slot_hash == 0:      # never used: h is not further along
+                return (off if free is None else free), now, False
+            if free is None:
+                if tat <= now:
+                    free = off
+                elif victim is None or tat < victim_tat:
+                    victim, victim_tat = off, tat
+        if free is not None:
+            return free, now, False
+        return victim, now, True
+
+    def is_allowed(self, key, now=None) -> bool:
+        now = time.time() if now is None else now
+        h = _key_hash(key)
+        stripe = h % self.stripes
+        with self._locks[stripe]:
+            if fcntl:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                off, tat, overflow = self._find(h, stripe, now)
+                if tat < now:
+                    tat = now
+                allowed = tat - now <= self.burst
+                if allowed:
+                    _SLOT.pack_into(self._map, off, h, tat + self.interval)
+            finally:
+                if fcntl:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+        if not allowed:
+            self._counters.incr("denied")
+        if overflow and allowed:
+            self._counters.incr("overflow")
+        return allowed
+
+    def retry_after(self, key, now=None) -> int:
+        """Whole seconds until key may make its next request (0 if it may now)."""
+        now = time.time() if now is None else now
+        h = _key_hash(key)
+        stripe = h % self.stripes
+        with self._locks[stripe]:
+            if fcntl:
+                fcntl.lockf(self._fd, fcntl.LOCK_SH, 1, stripe)
+            try:
+                _, tat, _ = self._find(h, stripe, now)
+            finally:
+                if fcntl:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+        return max(0, math.ceil(tat - self.burst - now))
+
+    def start(self):
+        return self   # nothing to sweep: refilled slots are reused in place
+
+    def __len__(self):
+        now = time.time()
+        with memoryview(self._map) as raw, raw[_HEADER_SIZE:].cast("d") as doubles:
+            with doubles[1::2] as tats:
+                return sum(1 for tat in tats if tat > now)
+
+    def snapshot(self) -> dict:
+        info = self._counters.snapshot()
+        info.update(keys=len(self), slots=self.slots, stripes=self.stripes,
+                    max_requests=self.max_requests, window=self.window, shared=self.path)
+        return info
+
+    def close(self):
+        self._counters.close()
+        self._map.close()
+        self._file.close()
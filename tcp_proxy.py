@@ -0,0 +1,1104 @@
+# tcp_proxy.py - forward proxy engines for the port-6767 listener
+#
+# Two interchangeable engines serve CONNECT tunnels and plain-HTTP requests:
+#
+#   threaded  the original design: listen() backlog, one daemon thread per
+#             accepted socket and a select() loop per tunnel.
+#   asyncio   one event loop; every tunnel is a pair of asyncio.Protocol
+#             objects that hand data straight to the peer transport, with
+#             flow control (pause_reading/resume_writing) instead of threads
+#             and a per-tunnel idle timer.  Tens of thousands of tunnels cost
+#             a few KB each rather than a thread stack each.  Plain-HTTP
+#             clients get HTTP/1.1 keep-alive and pipelining: requests are
+#             parsed incrementally, bodies stream in both directions framed
+#             by Content-Length/chunked, and origin connections are reused
+#             from a per-host idle pool.
+#
+# Both engines resolve upstream names through dns_cache and connect to the
+# exact addresses it returned; with block_private those addresses must be
+# public (403 otherwise).
+#
+# Once a CONNECT tunnel is established the asyncio engine can hand its two
+# sockets to a raw relay (RELAY_SPLICE / RELAY_RECV_INTO) that moves bytes
+# kernel-to-kernel with os.splice through a pipe, or through one reusable
+# buffer per direction, instead of allocating a bytes object per read.
+#
+# benchmarks/bench_tcp_proxy.py compares the engines,
+# benchmarks/bench_tunnel_throughput.py the relay modes.
+import asyncio
+import logging
+import os
+import select
+import socket
+import threading
+from collections import OrderedDict
+
+import dns_cache
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+MAX_HEAD_BYTES = 64 * 1024
+
+# CONNECT relay modes
+RELAY_STREAM = "stream"        # asyncio transports (bytes object per read)
+RELAY_RECV_INTO = "recv_into"  # reusable buffer + memoryview per direction
+RELAY_SPLICE = "splice"        # os.splice through a pipe (Linux), no user-space copy
+RELAY_BUFFER_SIZE = 256 * 1024
+_F_SETPIPE_SZ = 1031           # fcntl.F_SETPIPE_SZ (Linux), exposed by Python 3.10+ only
+
+
+# ────────────────────────────────────────────────
+# Request parsing (shared by both engines)
+# ────────────────────────────────────────────────
+def parse_http_target(url: str):
+    """'http://host:8080/path' or 'host/path' → (host, port)"""
+    http_pos = url.find("://")
+    temp = url if http_pos == -1 else url[http_pos + 3:]
+
+    port_pos = temp.find(":")
+    webserver_pos = temp.find("/")
+    if webserver_pos == -1:
+        webserver_pos = len(temp)
+
+    if port_pos == -1 or webserver_pos < port_pos:
+        return temp[:webserver_pos], 80
+    return temp[:port_pos], int(temp[port_pos + 1:webserver_pos])
+
+
+def parse_connect_target(host_port: str):
+    """'example.com:443' or '[::1]:443' → (host, port)"""
+    host, sep, port = host_port.rpartition(":")
+    if not sep or not host:
+        raise ValueError("Invalid host:port format")
+    return host.strip("[]"), int(port)
+
+
+def parse_request_head(head: bytes):
+    """Return (method, host, port) for the first request line of head."""
+    first_line = head.split(b"\n", 1)[0].decode("ascii", errors="ignore").strip()
+    parts = first_line.split(" ")
+    if len(parts) < 3:
+        raise ValueError("Invalid HTTP request")
+    method, target = parts[0], parts[1]
+    if method == "CONNECT":
+        host, port = parse_connect_target(target)
+    else:
+        host, port = parse_http_target(target)
+    if not host:
+        raise ValueError("Missing host")
+    return method, host, port
+
+
+# Hop-by-hop headers (RFC 9110 §7.6.1) are never forwarded; Transfer-Encoding
+# is kept because chunked bodies are relayed with their framing intact
+HOP_BY_HOP = ("connection", "proxy-connection", "keep-alive", "proxy-authorization",
+              "proxy-authenticate", "te", "trailer", "upgrade")
+
+
+class HttpHead:
+    """Start line and header fields of an HTTP/1.x request or response head."""
+
+    __slots__ = ("start", "headers")
+
+    def __init__(self, raw: bytes):
+        lines = raw.decode("latin-1").split("\r\n")
+        self.start = lines[0].split(" ", 2)
+        if len(self.start) < 2:
+            raise ValueError(f"Malformed start line: {lines[0][:80]!r}")
+        self.headers = []
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(":")
+            if not sep or not name or name != name.strip():
+                raise ValueError(f"Malformed header line: {line[:80]!r}")
+            self.headers.append((name, value.strip()))
+
+    def get(self, name):
+        name = name.lower()
+        for key, value in reversed(self.headers):
+            if key.lower() == name:
+                return value
+        return None
+
+    def tokens(self, name) -> set:
+        """Lower-cased comma-separated tokens across every instance of a header."""
+        name = name.lower()
+        return {t.strip().lower() for key, value in self.headers if key.lower() == name
+                for t in value.split(",") if t.strip()}
+
+    def forwardable(self):
+        """Headers minus hop-by-hop ones and anything named in Connection."""
+        drop = set(HOP_BY_HOP) | self.tokens("connection")
+        return [(k, v) for k, v in self.headers if k.lower() not in drop]
+
+
+def serialize_head(start_line: str, headers) -> bytes:
+    lines = [start_line] + [f"{k}: {v}" for k, v in headers]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def keep_alive(version: str, head: HttpHead) -> bool:
+    connection = head.tokens("connection") | head.tokens("proxy-connection")
+    if version == "HTTP/1.1":
+        return "close" not in connection
+    return "keep-alive" in connection
+
+
+def body_framing(head: HttpHead, request_method=None, status=None):
+    """How a message body is delimited: ("none"|"length"|"chunked"|"close", length).
+
+    request_method/status are given for responses: HEAD, 1xx, 204 and 304
+    responses never carry a body, and a response without framing runs to EOF.
+    """
+    if status is not None and (request_method == "HEAD" or status < 200 or status in (204, 304)):
+        return "none", 0
+    codings = [t.strip().lower() for key, value in head.headers if key.lower() == "transfer-encoding"
+               for t in value.split(",") if t.strip()]
+    if codings:
+        if codings[-1] == "chunked":
+            return "chunked", None
+        if status is None:
+            raise ValueError("Request body with unknown length")
+        return "close", None
+    lengths = {v.strip() for k, v in head.headers if k.lower() == "content-length"}
+    if lengths:
+        if len(lengths) > 1 or not next(iter(lengths)).isdigit():
+            raise ValueError("Invalid Content-Length")
+        return "length", int(lengths.pop())
+    return ("none", 0) if status is None else ("close", None)
+
+
+def origin_target(target: str, host_header):
+    """Absolute-form or origin-form request target → (host, port, origin-form path)."""
+    if target.startswith("/"):
+        if not host_header:
+            raise ValueError("Missing Host header")
+        authority, path = host_header, target
+    else:
+        rest = target.split("://", 1)[-1]
+        slash = rest.find("/")
+        authority, path = (rest, "/") if slash == -1 else (rest[:slash], rest[slash:])
+    host, port = parse_http_target(authority)
+    if not host:
+        raise ValueError("Missing host")
+    return host.strip("[]"), port, path
+
+
+def connect_resolved(host, port, timeout, block_private=False):
+    """Blocking connect to the first reachable address dns_cache gives for host."""
+    error = OSError(f"No addresses for {host}")
+    for address in dns_cache.get_resolver().resolve(host, check=block_private):
+        try:
+            return socket.create_connection((address, port), timeout)
+        except OSError as e:
+            error = e
+    raise error
+
+
+async def open_resolved(engine, host, port, connect):
+    """await connect(address) for each resolved address until one succeeds."""
+    addresses = await dns_cache.get_resolver().resolve_async(host, check=engine.block_private)
+    error = OSError(f"No addresses for {host}")
+    for address in addresses:
+        try:
+            return await asyncio.wait_for(connect(address), engine.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            error = e
+    raise error
+
+
+def raise_fd_limit():
+    """Lift the soft open-files limit to the hard limit (each tunnel holds two sockets)."""
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError) as e:
+            logger.warning(f"Could not raise open-files limit: {e}")
+    return soft
+
+
+# ────────────────────────────────────────────────
+# Threaded engine (one thread per connection)
+# ────────────────────────────────────────────────
+def handle_client(client_socket, socket_timeout=10, block_private=False):
+    try:
+        request_data = client_socket.recv(1024)
+        if not request_data:
+            client_socket.close()
+            return
+
+        first_line = request_data.split(b'\n')[0]
+        method = first_line.split(b' ')[0]
+
+        if method == b'CONNECT':
+            handle_https_request(client_socket, request_data, socket_timeout, block_private)
+        else:
+            handle_http_request(client_socket, request_data, socket_timeout, block_private)
+    except Exception as e:
+        logger.error(f"Client handling error: {e}")
+    finally:
+        try:
+            client_socket.close()
+        except:
+            pass
+
+
+def handle_http_request(client_socket, request_data, socket_timeout=10, block_private=False):
+    try:
+        _, webserver, port = parse_request_head(request_data)
+
+        s = connect_resolved(webserver, port, socket_timeout, block_private)
+        s.sendall(request_data)
+
+        while True:
+            data = s.recv(4096)
+            if not data:
+                break
+            client_socket.sendall(data)
+
+        s.close()
+    except Exception as e:
+        logger.error(f"HTTP proxy error: {e}")
+    finally:
+        try:
+            client_socket.close()
+        except:
+            pass
+
+
+def handle_https_request(client_socket, request_data, socket_timeout=10, block_private=False):
+    s = None
+    try:
+        _, host, port = parse_request_head(request_data)
+        s = connect_resolved(host, port, socket_timeout, block_private)
+
+        client_socket.sendall(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+        sockets = [client_socket, s]
+        buf = bytearray(RELAY_BUFFER_SIZE)
+        view = memoryview(buf)
+
+        while sockets:
+            try:
+                readable, _, exceptional = select.select(sockets, [], sockets, socket_timeout)
+
+                if exceptional:
+                    break
+
+                if not readable:
+                    continue
+
+                for sock in readable:
+                    other_sock = s if sock is client_socket else client_socket
+                    n = sock.recv_into(buf)
+                    if not n:
+                        # Half-close: pass the FIN on, keep relaying the other way
+                        sockets.remove(sock)
+                        other_sock.shutdown(socket.SHUT_WR)
+                        continue
+                    other_sock.sendall(view[:n])
+
+            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+                logger.debug("Connection closed by peer")
+                break
+
+    except Exception as e:
+        logger.error(f"HTTPS proxy error: {e}")
+    finally:
+        try:
+            client_socket.close()
+        except:
+            pass
+        if s:
+            try:
+                s.close()
+            except:
+                pass
+
+
+def serve_threaded(host, port, backlog=1024, socket_timeout=10, block_private=False):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(backlog)
+    logger.info(f"TCP Proxy (threaded) listening on {host}:{port}")
+
+    while True:
+        try:
+            client_socket, addr = server.accept()
+            logger.debug(f"Connection from {addr}")
+
+            threading.Thread(
+                target=handle_client,
+                args=(client_socket, socket_timeout, block_private),
+                daemon=True
+            ).start()
+        except Exception as e:
+            logger.error(f"Server accept error: {e}")
+
+
+# ────────────────────────────────────────────────
+# asyncio engine
+# ────────────────────────────────────────────────
+class ProxyStats:
+    """Engine counters.  Only the event loop thread writes them, so no lock;
+    snapshot() from another thread sees plain ints."""
+
+    FIELDS = ("connections", "active", "connect_tunnels", "http_requests", "http_keepalive_requests",
+              "upstream_connects", "upstream_reused", "bytes_up", "bytes_down", "idle_timeouts",
+              "upstream_errors", "bad_requests", "blocked")
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def snapshot(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class _Tunnel:
+    """A client connection and (once opened) its upstream connection."""
+
+    __slots__ = ("engine", "client", "upstream", "relay", "last_active", "closed", "_timer")
+
+    def __init__(self, engine, client):
+        self.engine = engine
+        self.client = client
+        self.upstream = None
+        self.relay = None
+        self.closed = False
+        self.last_active = engine.loop.time()
+        self._timer = engine.loop.call_later(engine.idle_timeout, self._check_idle)
+        engine.stats.connections += 1
+        engine.stats.active += 1
+
+    def touch(self):
+        self.last_active = self.engine.loop.time()
+
+    def _check_idle(self):
+        idle = self.engine.loop.time() - self.last_active
+        if idle >= self.engine.idle_timeout:
+            self.engine.stats.idle_timeouts += 1
+            self.close()
+        else:
+            self._timer = self.engine.loop.call_later(self.engine.idle_timeout - idle, self._check_idle)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._timer.cancel()
+        self.engine.stats.active -= 1
+        if self.relay is not None:
+            self.relay.close()
+        for side in (self.client, self.upstream):
+            if side is not None and side.transport is not None:
+                side.transport.close()
+
+    def fail(self, status: bytes):
+        """Answer the client with an error status and drop the tunnel."""
+        self.client.transport.write(b"HTTP/1.1 " + status + b"\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        self.close()
+
+    async def open(self, head: bytes, rest: bytes):
+        """Connect upstream for a CONNECT request and start relaying."""
+        engine = self.engine
+        stats = engine.stats
+        try:
+            _, host, port = parse_request_head(head)
+        except ValueError as e:
+            stats.bad_requests += 1
+            logger.debug(f"Bad proxy request: {e}")
+            return self.fail(b"400 Bad Request")
+
+        try:
+            _, upstream = await open_resolved(engine, host, port, lambda address: engine.loop.create_connection(
+                lambda: _Side(self, "bytes_down"), address, port))
+        except dns_cache.BlockedAddressError as e:
+            stats.blocked += 1
+            logger.warning(f"Blocked CONNECT to {host}:{port}: {e}")
+            return self.fail(b"403 Forbidden")
+        except (OSError, asyncio.TimeoutError) as e:
+            stats.upstream_errors += 1
+            logger.debug(f"Upstream connect failed {host}:{port}: {e!r}")
+            return self.fail(b"502 Bad Gateway")
+
+        if self.closed:
+            upstream.transport.close()
+            return
+        self.upstream = upstream
+        self.client.peer = upstream
+        upstream.peer = self.client
+        self.touch()
+
+        stats.connect_tunnels += 1
+        self.client.transport.write(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+        if rest:
+            upstream.transport.write(rest)
+        if (engine.relay_mode != RELAY_STREAM and not self.client.eof
+                and not self.client.transport.get_write_buffer_size()
+                and not upstream.transport.get_write_buffer_size()):
+            self.relay = _SocketRelay(self, engine.relay_mode)
+            return
+        if self.client.eof and upstream.transport.can_write_eof():
+            upstream.transport.write_eof()
+        upstream.transport.resume_reading()
+        self.client.transport.resume_reading()
+
+
+class _Side(asyncio.Protocol):
+    """One socket of a tunnel: whatever it reads is written to the peer."""
+
+    def __init__(self, tunnel, counter):
+        self.tunnel = tunnel
+        self.counter = counter
+        self.transport = None
+        self.peer = None
+        self.eof = False
+
+    def connection_made(self, transport):
+        # Upstream may speak first; hold its bytes in the kernel until linked
+        self.transport = transport
+        transport.pause_reading()
+
+    def data_received(self, data):
+        tunnel = self.tunnel
+        tunnel.touch()
+        stats = tunnel.engine.stats
+        setattr(stats, self.counter, getattr(stats, self.counter) + len(data))
+        self.peer.transport.write(data)
+
+    def eof_received(self):
+        # Half-close: pass the FIN on and keep the other direction open
+        self.eof = True
+        if self.peer is None or self.peer.eof:
+            self.tunnel.close()
+            return False
+        if self.peer.transport.can_write_eof():
+            self.peer.transport.write_eof()
+        return True
+
+    # Backpressure: stop reading from the peer while our send buffer is full
+    def pause_writing(self):
+        if self.peer is not None:
+            self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        if self.peer is not None:
+            self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        self.tunnel.close()
+
+
+class _ClientSide(_Side):
+    """Accepted socket: buffers the request head, then becomes a plain relay."""
+
+    def __init__(self, engine):
+        super().__init__(None, "bytes_up")
+        self.engine = engine
+        self.reader = None  # StreamReader once in plain-HTTP mode
+        self._head = bytearray()
+        self._opening = False
+        self._write_paused = False
+        self._drain_waiter = None
+        self._task = None   # the loop only holds tasks weakly
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.tunnel = _Tunnel(self.engine, self)
+
+    def data_received(self, data):
+        if self.peer is not None:
+            return super().data_received(data)
+        self.tunnel.touch()
+        if self.reader is not None:
+            self.reader.feed_data(data)
+            return
+        self._head += data
+        end = self._head.find(b"\r\n\r\n")
+        if end < 0:
+            if len(self._head) > self.engine.max_head_bytes:
+                self.engine.stats.bad_requests += 1
+                self.tunnel.fail(b"431 Request Header Fields Too Large")
+            return
+        if self._opening:
+            return
+        self._opening = True
+        if not self._head.startswith(b"CONNECT "):
+            # Plain HTTP: parse requests off a stream for as long as the client keeps the connection
+            self.reader = asyncio.StreamReader(limit=self.engine.max_head_bytes, loop=self.engine.loop)
+            self.reader.set_transport(self.transport)
+            self.reader.feed_data(bytes(self._head))
+            self._head = None
+            self._task = self.engine.loop.create_task(_HttpSession(self.tunnel).run())
+            return
+        self.transport.pause_reading()
+        head, rest = bytes(self._head[:end + 4]), bytes(self._head[end + 4:])
+        self._head = None
+        self._task = self.engine.loop.create_task(self.tunnel.open(head, rest))
+
+    def eof_received(self):
+        if self.reader is not None and self.peer is None:
+            self.eof = True
+            self.reader.feed_eof()
+            return True  # still sending the response
+        if self.peer is None and self._opening:
+            self.eof = True
+            return True
+        return super().eof_received()
+
+    # Writer interface for _HttpSession (mirrors StreamWriter.write/drain)
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        if self.transport.is_closing():
+            raise ConnectionResetError("Client connection closed")
+        if self._write_paused:
+            self._drain_waiter = self.engine.loop.create_future()
+            await self._drain_waiter
+
+    def pause_writing(self):
+        if self.peer is not None:
+            return super().pause_writing()
+        self._write_paused = True
+
+    def resume_writing(self):
+        if self.peer is not None:
+            return super().resume_writing()
+        self._write_paused = False
+        self._wake_drain()
+
+    def _wake_drain(self, exc=None):
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+    def connection_lost(self, exc):
+        if self.reader is not None:
+            if not self.eof:
+                self.reader.feed_eof()
+            self._wake_drain(ConnectionResetError("Client connection lost"))
+        super().connection_lost(exc)
+
+
+# ────────────────────────────────────────────────
+# Plain HTTP: persistent client connections, pooled upstreams
+# ────────────────────────────────────────────────
+_COPY_SIZE = 64 * 1024
+
+
+class _UpstreamPool:
+    """Idle keep-alive connections to origin servers, per (host, port).
+
+    A reaper timer closes connections idle past idle_timeout or closed by
+    the origin, whichever host they belong to; at most max_idle are kept
+    in all, the least recently used host giving up its oldest first.
+    """
+
+    def __init__(self, max_idle_per_host=8, idle_timeout=30.0, max_idle=256):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self._idle = OrderedDict()   # (host, port) -> [(reader, writer, since)], least recently used first
+        self._count = 0
+        self._reaper = None
+
+    async def get(self, engine, host, port):
+        """(reader, writer, reused) - an idle connection if a usable one exists."""
+        key = (host, port)
+        conns = self._idle.get(key)
+        now = engine.loop.time()
+        while conns:
+            reader, writer, since = conns.pop()
+            self._count -= 1
+            if not conns:
+                del self._idle[key]
+            if now - since < self.idle_timeout and not reader.at_eof() and not writer.is_closing():
+                engine.stats.upstream_reused += 1
+                return reader, writer, True
+            writer.close()
+        reader, writer = await open_resolved(engine, host, port, lambda address: asyncio.open_connection(
+            address, port, limit=engine.max_head_bytes))
+        engine.stats.upstream_connects += 1
+        return reader, writer, False
+
+    def put(self, engine, host, port, reader, writer):
+        key = (host, port)
+        conns = self._idle.setdefault(key, [])
+        self._idle.move_to_end(key)
+        conns.append((reader, writer, engine.loop.time()))
+        self._count += 1
+        if len(conns) > self.max_idle_per_host:
+            self._evict(key)
+        while self._count > self.max_idle:
+            self._evict(next(iter(self._idle)))
+        if self._reaper is None:
+            self._reaper = engine.loop.call_later(self.idle_timeout, self._reap, engine.loop)
+
+    def _evict(self, key):
+        """Close the oldest idle connection to key."""
+        conns = self._idle[key]
+        conns.pop(0)[1].close()
+        self._count -= 1
+        if not conns:
+            del self._idle[key]
+
+    def _reap(self, loop):
+        self._reaper = None
+        now = loop.time()
+        for key in list(self._idle):
+            kept = []
+            for reader, writer, since in self._idle[key]:
+                if now - since < self.idle_timeout and not reader.at_eof() and not writer.is_closing():
+                    kept.append((reader, writer, since))
+                else:
+                    writer.close()
+            self._count -= len(self._idle[key]) - len(kept)
+            if kept:
+                self._idle[key] = kept
+            else:
+                del self._idle[key]
+        if self._idle:
+            oldest = min(conns[0][2] for conns in self._idle.values())
+            self._reaper = loop.call_later(max(0.0, oldest + self.idle_timeout - now), self._reap, loop)
+
+    def idle_count(self) -> int:
+        return self._count
+
+    def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for conns in self._idle.values():
+            for _, writer, _ in conns:
+                writer.close()
+        self._idle.clear()
+        self._count = 0
+
+
+class _HttpSession:
+    """Serves every request a plain-HTTP client sends on one connection, in order."""
+
+    def __init__(self, tunnel):
+        self.tunnel = tunnel
+        self.engine = tunnel.engine
+        self.client = tunnel.client
+        self.stats = tunnel.engine.stats
+
+    async def run(self):
+        reader = self.client.reader
+        served = 0
+        try:
+            while not self.tunnel.closed:
+                try:
+                    raw = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    break  # client closed between requests
+                except asyncio.LimitOverrunError:
+                    self.stats.bad_requests += 1
+                    return self.tunnel.fail(b"431 Request Header Fields Too Large")
+                try:
+                    request = HttpHead(raw)
+                    if len(request.start) != 3:
+                        raise ValueError("Malformed request line")
+                    host, port, path = origin_target(request.start[1], request.get("host"))
+                    framing = body_framing(request)
+                except ValueError as e:
+                    self.stats.bad_requests += 1
+                    logger.debug(f"Bad proxy request: {e}")
+                    return self.tunnel.fail(b"400 Bad Request")
+                self.stats.http_requests += 1
+                if served:
+                    self.stats.http_keepalive_requests += 1
+                served += 1
+                if not await self._forward(request, host, port, path, framing):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, OSError) as e:
+            logger.debug(f"HTTP proxy connection ended: {e!r}")
+        except (ValueError, asyncio.LimitOverrunError) as e:
+            # Bad framing in a body already being relayed (e.g. a chunk-size line):
+            # the response head has gone out, so all that is left is to close
+            self.stats.upstream_errors += 1
+            logger.debug(f"Bad message body, closing: {e!r}")
+        finally:
+            self.tunnel.close()
+
+    def _copy_counter(self, dst):
+        return "bytes_up" if dst is not self.client else "bytes_down"
+
+    async def _copy(self, reader, dst, framing, length=None):
+        """Relay one message body from reader to dst, framing included."""
+        counter = self._copy_counter(dst)
+        if framing == "length":
+            await self._copy_exact(reader, dst, length, counter)
+        elif framing == "chunked":
+            while True:
+                line = await reader.readuntil(b"\r\n")
+                dst.write(line)
+                size = int(line.split(b";", 1)[0].strip(), 16)
+                if size == 0:
+                    while line != b"\r\n":  # trailer section
+                        line = await reader.readuntil(b"\r\n")
+                        dst.write(line)
+                    break
+                await self._copy_exact(reader, dst, size + 2, counter)
+        elif framing == "close":
+            while True:
+                data = await reader.read(_COPY_SIZE)
+                if not data:
+                    break
+                await self._send(dst, data, counter)
+        await dst.drain()
+
+    async def _copy_exact(self, reader, dst, remaining, counter):
+        while remaining:
+            data = await reader.read(min(remaining, _COPY_SIZE))
+            if not data:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(data)
+            await self._send(dst, data, counter)
+
+    async def _send(self, dst, data, counter):
+        self.tunnel.touch()
+        setattr(self.stats, counter, getattr(self.stats, counter) + len(data))
+        dst.write(data)
+        await dst.drain()
+
+    def _request_head(self, request, host, port, path):
+        headers = request.forwardable()
+        if request.get("host") is None:
+            headers.insert(0, ("Host", host if port == 80 else f"{host}:{port}"))
+        upgrade = request.get("upgrade") if "upgrade" in request.tokens("connection") else None
+        if upgrade:
+            headers += [("Connection", "Upgrade"), ("Upgrade", upgrade)]
+        else:
+            headers.append(("Connection", "keep-alive"))
+        return serialize_head(f"{request.start[0]} {path} HTTP/1.1", headers)
+
+    async def _forward(self, request, host, port, path, framing):
+        """Send one request upstream and relay its response; returns True to keep the client."""
+        method, version = request.start[0], request.start[2]
+        head = self._request_head(request, host, port, path)
+        pool = self.engine.http_pool
+
+        for attempt in (0, 1):
+            try:
+                up_reader, up_writer, reused = await pool.get(self.engine, host, port)
+            except dns_cache.BlockedAddressError as e:
+                self.stats.blocked += 1
+                logger.warning(f"Blocked request to {host}:{port}: {e}")
+                self.tunnel.fail(b"403 Forbidden")
+                return False
+            except (OSError, asyncio.TimeoutError) as e:
+                self.stats.upstream_errors += 1
+                logger.debug(f"Upstream connect failed {host}:{port}: {e!r}")
+                self.tunnel.fail(b"502 Bad Gateway")
+                return False
+            up_writer.write(head)
+            # The body streams up while the response is awaited (Expect: 100-continue,
+            # early error responses); a reused connection is only retried without one
+            upload = None
+            if framing[0] != "none":
+                upload = self.engine.loop.create_task(
+                    self._copy(self.client.reader, up_writer, *framing))
+            try:
+                response = await self._response_head(up_reader)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError, OSError) as e:
+                up_writer.close()
+                if upload is not None:
+                    upload.cancel()
+                if reused and attempt == 0 and upload is None:
+                    continue  # stale keep-alive connection
+                self.stats.upstream_errors += 1
+                logger.debug(f"Upstream request failed {host}:{port}: {e!r}")
+                self.tunnel.fail(b"502 Bad Gateway")
+                return False
+            except (ValueError, asyncio.LimitOverrunError) as e:
+                # Garbled or oversized response head: no retry, the origin answered
+                up_writer.close()
+                if upload is not None:
+                    upload.cancel()
+                self.stats.upstream_errors += 1
+                logger.debug(f"Bad upstream response from {host}:{port}: {e!r}")
+                self.tunnel.fail(b"502 Bad Gateway")
+                return False
+
+        try:
+            status = int(response.start[1])
+            resp_framing = body_framing(response, method, status)
+        except ValueError:
+            up_writer.close()
+            self.stats.upstream_errors += 1
+            self.tunnel.fail(b"502 Bad Gateway")
+            return False
+        client_keep = keep_alive(version, request) and resp_framing[0] != "close" and status != 101
+        upstream_keep = keep_alive(response.start[0], response) and resp_framing[0] != "close"
+
+        headers = response.forwardable()
+        if status == 101:
+            headers += [("Connection", "Upgrade"), ("Upgrade", response.get("upgrade") or "")]
+        else:
+            headers.append(("Connection", "keep-alive" if client_keep else "close"))
+        self.client.write(serialize_head(" ".join(response.start), headers))
+        try:
+            await self._copy(up_reader, self.client, *resp_framing)
+            if status == 101:
+                await self._switch_protocols(up_reader, up_writer, upload)
+                return False
+            if upload is not None:
+                if upload.done():
+                    upload.result()
+                else:
+                    # Response finished before the request body: neither side is reusable
+                    upload.cancel()
+                    upstream_keep = client_keep = False
+        except BaseException:
+            up_writer.close()
+            if upload is not None:
+                upload.cancel()
+            raise
+        if upstream_keep:
+            pool.put(self.engine, host, port, up_reader, up_writer)
+        else:
+            up_writer.close()
+        return client_keep
+
+    async def _response_head(self, up_reader):
+        """Read the final response head, passing 1xx interim responses (except 101) to the client."""
+        while True:
+            response = HttpHead(await up_reader.readuntil(b"\r\n\r\n"))
+            status = response.start[1]
+            if not status.startswith("1") or status == "101":
+                return response
+            self.client.write(serialize_head(" ".join(response.start), response.forwardable()))
+
+    async def _switch_protocols(self, up_reader, up_writer, upload):
+        """After 101 both connections carry an opaque byte stream until either side closes."""
+        if upload is not None:
+            upload.cancel()
+
+        async def pump(reader, dst):
+            counter = self._copy_counter(dst)
+            while True:
+                data = await reader.read(_COPY_SIZE)
+                if not data:
+                    break
+                await self._send(dst, data, counter)
+
+        try:
+            await asyncio.gather(pump(self.client.reader, up_writer), pump(up_reader, self.client))
+        finally:
+            up_writer.close()
+
+
+def _detach(transport):
+    """Take a non-blocking duplicate of a transport's socket and retire the transport."""
+    sock = socket.socket(fileno=os.dup(transport.get_extra_info("socket").fileno()))
+    sock.setblocking(False)
+    transport.set_protocol(asyncio.Protocol())
+    transport.close()
+    return sock
+
+
+class _Direction:
+    """One direction of a raw relay: read src into a pipe/buffer, drain into dst."""
+
+    def __init__(self, relay, src, dst, counter, mode):
+        self.relay = relay
+        self.src = src
+        self.dst = dst
+        self.counter = counter
+        self.splice = mode == RELAY_SPLICE
+        self.size = RELAY_BUFFER_SIZE
+        self.pending = 0
+        self.done = False
+        self.waiting = False
+        if self.splice:
+            self._rfd, self._wfd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fcntl is not None:
+                try:
+                    self.size = fcntl.fcntl(self._wfd, _F_SETPIPE_SZ, RELAY_BUFFER_SIZE)
+                except OSError:
+                    self.size = 65536  # default pipe capacity
+        else:
+            self._buf = bytearray(RELAY_BUFFER_SIZE)
+            self._view = memoryview(self._buf)
+            self._offset = 0
+
+    def _fill(self):
+        if self.splice:
+            return os.splice(self.src.fileno(), self._wfd, self.size,
+                             flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        self._offset = 0
+        return self.src.recv_into(self._buf)
+
+    def _flush(self):
+        if self.splice:
+            return os.splice(self._rfd, self.dst.fileno(), self.pending,
+                             flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        sent = self.dst.send(self._view[self._offset:self._offset + self.pending])
+        self._offset += sent
+        return sent
+
+    def on_readable(self):
+        try:
+            n = self._fill()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            return self.relay.tunnel.close()
+        if not n:
+            return self._eof()
+        tunnel = self.relay.tunnel
+        tunnel.touch()
+        stats = tunnel.engine.stats
+        setattr(stats, self.counter, getattr(stats, self.counter) + n)
+        self.pending = n
+        self.drain()
+
+    def drain(self):
+        loop = self.relay.loop
+        while self.pending:
+            try:
+                self.pending -= self._flush()
+            except (BlockingIOError, InterruptedError):
+                if not self.waiting:
+                    # dst is full: stop reading src until it drains
+                    self.waiting = True
+                    loop.remove_reader(self.src.fileno())
+                    loop.add_writer(self.dst.fileno(), self.drain)
+                return
+            except OSError:
+                return self.relay.tunnel.close()
+        if self.waiting:
+            self.waiting = False
+            loop.remove_writer(self.dst.fileno())
+            loop.add_reader(self.src.fileno(), self.on_readable)
+
+    def _eof(self):
+        # Half-close: pass the FIN on and keep the other direction running
+        self.done = True
+        self.relay.loop.remove_reader(self.src.fileno())
+        try:
+            self.dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        self.relay.direction_done()
+
+    def close(self):
+        loop = self.relay.loop
+        loop.remove_reader(self.src.fileno())
+        loop.remove_writer(self.dst.fileno())
+        if self.splice:
+            os.close(self._rfd)
+            os.close(self._wfd)
+
+
+class _SocketRelay:
+    """CONNECT tunnel relayed on the raw sockets (splice or recv_into)."""
+
+    def __init__(self, tunnel, mode):
+        self.tunnel = tunnel
+        self.loop = tunnel.engine.loop
+        self.client = _detach(tunnel.client.transport)
+        self.upstream = _detach(tunnel.upstream.transport)
+        self.directions = (
+            _Direction(self, self.client, self.upstream, "bytes_up", mode),
+            _Direction(self, self.upstream, self.client, "bytes_down", mode),
+        )
+        for direction in self.directions:
+            self.loop.add_reader(direction.src.fileno(), direction.on_readable)
+
+    def direction_done(self):
+        if all(d.done for d in self.directions):
+            self.tunnel.close()
+
+    def close(self):
+        for direction in self.directions:
+            direction.close()
+        self.client.close()
+        self.upstream.close()
+
+
+class AsyncTcpProxy:
+    """Event-loop forward proxy (CONNECT and plain HTTP)."""
+
+    def __init__(self, host, port, backlog=1024, idle_timeout=300.0, connect_timeout=10.0,
+                 max_head_bytes=MAX_HEAD_BYTES, relay_mode=RELAY_SPLICE,
+                 upstream_idle_per_host=8, upstream_idle_timeout=30.0, upstream_idle_max=256,
+                 block_private=False):
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.max_head_bytes = max_head_bytes
+        if relay_mode == RELAY_SPLICE and not hasattr(os, "splice"):
+            relay_mode = RELAY_RECV_INTO  # Linux + Python 3.10 only
+        self.relay_mode = relay_mode
+        self.http_pool = _UpstreamPool(upstream_idle_per_host, upstream_idle_timeout, upstream_idle_max)
+        self.block_private = block_private
+        self.stats = ProxyStats()
+        self.loop = None
+        self.fd_limit = None
+        self._server = None
+        self._ready = threading.Event()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self._server = await self.loop.create_server(
+            lambda: _ClientSide(self), self.host, self.port,
+            backlog=self.backlog, reuse_address=True,
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"TCP Proxy (asyncio) listening on {self.host}:{self.port} "
+                    f"(backlog {self.backlog}, idle timeout {self.idle_timeout}s)")
+        self._ready.set()
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    def run(self):
+        """Blocking entry point (thread target)."""
+        self.fd_limit = raise_fd_limit()
+        asyncio.run(self.serve())
+
+    def start(self, timeout=5.0):
+        """Run in a daemon thread; returns once the socket is listening."""
+        thread = threading.Thread(target=self.run, name="tcp-proxy", daemon=True)
+        thread.start()
+        if not self._ready.wait(timeout):
+            raise RuntimeError("TCP proxy failed to start")
+        return thread
+
+    def stop(self):
+        if self.loop is not None and self._server is not None:
+            self.loop.call_soon_threadsafe(self._server.close)
+
+    def snapshot(self) -> dict:
+        info = self.stats.snapshot()
+        info.update(engine="asyncio", relay=self.relay_mode, backlog=self.backlog,
+                    idle_timeout=self.idle_timeout, fd_limit=self.fd_limit,
+                    upstream_idle=self.http_pool.idle_count(), block_private=self.block_private)
+        return info
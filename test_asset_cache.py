@@ -0,0 +1,58 @@
+from asset_cache import AssetCache, CacheEntry, freshness_lifetime, make_key
+
+
+def test_freshness_lifetime():
+    assert freshness_lifetime({"Cache-Control": "public, max-age=600"}) == 600
+    assert freshness_lifetime({"Cache-Control": "max-age=600", "Age": "100"}) == 500
+    assert freshness_lifetime({"Cache-Control": "no-store", "ETag": '"a"'}) is None
+    assert freshness_lifetime({"Cache-Control": "private, max-age=60"}) is None
+    assert freshness_lifetime({"Cache-Control": "no-cache", "ETag": '"a"'}) == 0
+    assert freshness_lifetime({"Cache-Control": "max-age=60", "Vary": "Cookie"}) is None
+    assert freshness_lifetime({"Cache-Control": "max-age=60", "Vary": "Accept-Encoding"}) == 60
+    assert freshness_lifetime({}) is None
+
+
+def test_tee_stores_complete_body_only():
+    cache = AssetCache(max_bytes=1000)
+    key = make_key("https://cdn.example/a.js", "gzip")
+    headers = {"Cache-Control": "max-age=60", "Set-Cookie": "a=1"}
+
+    body = cache.tee(key, 200, headers, iter([b"abc", b"def"]))
+    assert b"".join(body) == b"abcdef"
+    entry = cache.lookup(key)
+    assert entry.is_fresh()
+    assert b"".join(cache.serve(entry)) == b"abcdef"
+    assert "Set-Cookie" not in entry.response_headers()
+
+    other = make_key("https://cdn.example/b.js", "gzip")
+    body = cache.tee(other, 200, headers, iter([b"x", b"y"]))
+    next(body)
+    body.close()
+    assert cache.lookup(other) is None
+
+
+def test_lru_evicts_by_bytes_and_revalidates():
+    cache = AssetCache(max_bytes=10)
+    for name in ("a", "b", "c"):
+        cache.put(name, CacheEntry(200, {"ETag": '"v1"'}, [b"12345"], 60))
+    snap = cache.snapshot()
+    assert snap["entries"] == 2 and snap["bytes"] == 10 and snap["evictions"] == 1
+    assert cache.lookup("a") is None
+
+    stale = CacheEntry(200, {"ETag": '"v1"', "Cache-Control": "max-age=0"}, [b"12345"], 0)
+    cache.put("b", stale)
+    assert cache.lookup("b").conditional_headers() == {"If-None-Match": '"v1"'}
+    fresh = cache.revalidated("b", stale, {"cache-control": "max-age=30", "Content-Length": "0"})
+    assert fresh.is_fresh() and fresh.chunks == (b"12345",)
+    assert fresh.headers["cache-control"] == "max-age=30"
+
+
+def test_seed_stores_cacheable_bodies_only():
+    cache = AssetCache(max_bytes=1000, max_entry_bytes=10)
+    key = make_key("https://cdn.example/a.css")
+    assert cache.seed(key, 200, {"Cache-Control": "max-age=60"}, b"a{}")
+    assert not cache.seed(make_key("https://cdn.example/b.css"), 200, {"Cache-Control": "no-store"}, b"b{}")
+    assert not cache.seed(make_key("https://cdn.example/c.css"), 200, {"Cache-Control": "max-age=60"}, b"c" * 11)
+    assert cache.peek(key).is_fresh() and cache.snapshot()["hits"] == 0
+    assert b"".join(cache.serve(cache.lookup(key))) == b"a{}"
+    assert cache.snapshot()["seeded"] == 1
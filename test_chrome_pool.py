@@ -0,0 +1,152 @@
+import json
+import os
+import threading
+import time
+
+from chrome_pool import DriverPool, process_tree_rss
+
+
+class FakeSwitch:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def new_window(self, kind):
+        self.driver.handles.append(f"T{len(self.driver.handles)}")
+        self.driver.current_window_handle = self.driver.handles[-1]
+
+    def window(self, handle):
+        self.driver.switches += 1
+        self.driver.current_window_handle = handle
+
+
+class FakeDriver:
+    def __init__(self):
+        self.alive = True
+        self.quit_called = False
+        self.handles = ["T0"]
+        self.current_window_handle = "T0"
+        self.switch_to = FakeSwitch(self)
+        self.switches = 0
+        self.log = []
+
+    @property
+    def current_url(self):
+        if not self.alive:
+            raise RuntimeError("chrome not reachable")
+        return "about:blank"
+
+    def execute_script(self, script, *args):
+        return self.current_window_handle
+
+    def get_log(self, kind):
+        entries, self.log = self.log, []
+        return entries
+
+    def quit(self):
+        self.quit_called = True
+
+
+def make_pool(**kwargs):
+    created = []
+
+    def factory():
+        created.append(FakeDriver())
+        return created[-1]
+
+    kwargs.setdefault("check_interval", 0)
+    pool = DriverPool(factory, rss_probe=None, **kwargs)
+    pool._top_up()  # fill without starting the maintenance thread
+    return pool, created
+
+
+def test_checkout_reuses_without_probing_and_recycles_after_max_pages():
+    pool, created = make_pool(size=2, max_pages=2)
+    assert len(created) == 2
+
+    tab = pool.get_driver()
+    pool.return_driver(tab)
+    assert pool.get_driver() is tab
+    pool.return_driver(tab)
+    assert tab.browser.driver.quit_called and pool.snapshot()["retired_pages"] == 1
+
+    pool.maintain_once()
+    info = pool.snapshot()
+    assert len(created) == 3 and info["browsers"] == 2 and len(pool.drivers) == 2
+    assert info["inline_creates"] == 0
+
+
+def test_maintenance_replaces_dead_and_suspect_browsers():
+    pool, created = make_pool(size=2)
+    created[0].alive = False
+    pool.maintain_once()
+    assert created[0].quit_called and pool.snapshot()["retired_dead"] == 1
+    assert len(pool.drivers) == 2
+
+    tab = pool.get_driver()
+    tab.browser.driver.alive = False
+    pool.return_driver(tab, failed=True)
+    assert tab not in pool.drivers
+    pool.maintain_once()
+    assert tab.browser.driver.quit_called and len(pool.drivers) == 2
+
+    pool.shutdown()
+    assert all(d.quit_called for d in created)
+
+
+def test_rss_and_age_limits():
+    pool, created = make_pool(size=1, max_rss_mb=100)
+    pool.rss_probe = lambda pid: 200 * 1048576
+    pool.maintain_once()
+    info = pool.snapshot()
+    assert info["retired_rss"] == 1 and created[0].quit_called and len(created) == 2
+
+    pool.max_age = 0.01
+    pool.rss_probe = None
+    time.sleep(0.02)
+    pool.maintain_once()
+    assert pool.snapshot()["retired_age"] == 1 and created[1].quit_called
+
+
+def test_tabs_share_a_browser_and_the_pool_scales():
+    pool, created = make_pool(size=1, max_size=2, tabs_per_driver=3, idle_timeout=0.05)
+    tabs = [pool.get_driver() for _ in range(3)]
+    assert len(created) == 1 and len({t.handle for t in tabs}) == 3
+    assert [t.execute_script("") for t in tabs] == [t.handle for t in tabs]
+    assert created[0].switches >= 2
+
+    extra = pool.get_driver()  # every tab busy: grows to max_size
+    assert len(created) == 2 and extra.browser.driver is created[1]
+    more = [pool.get_driver() for _ in range(2)]
+    assert pool.get_driver(timeout=0.05) is None
+    assert pool.snapshot()["wait_timeouts"] == 1
+
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.get_driver(timeout=2)))
+    waiter.start()
+    time.sleep(0.05)
+    pool.return_driver(tabs[0])
+    waiter.join()
+    assert got == [tabs[0]]
+
+    for tab in tabs + [extra] + more:
+        pool.return_driver(tab)
+    time.sleep(0.06)
+    pool.maintain_once()
+    info = pool.snapshot()
+    assert info["browsers"] == 1 and info["retired_idle"] == 1 and info["busy_tabs"] == 0
+
+
+def test_performance_log_is_split_per_tab():
+    pool, created = make_pool(size=1, tabs_per_driver=2)
+    first, second = pool.get_driver(), pool.get_driver()
+    created[0].log = [{"message": json.dumps({"webview": first.handle, "message": {"method": "a"}})},
+                      {"message": json.dumps({"webview": second.handle, "message": {"method": "b"}})}]
+    assert [json.loads(e["message"])["message"]["method"] for e in second.get_log("performance")] == ["b"]
+    assert [json.loads(e["message"])["message"]["method"] for e in first.get_log("performance")] == ["a"]
+
+
+def test_process_tree_rss_reads_proc():
+    if not os.path.isdir("/proc"):
+        return
+    assert process_tree_rss(os.getpid()) > 0
+    assert process_tree_rss(None) is None
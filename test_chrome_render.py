@@ -0,0 +1,134 @@
+import time
+
+import pytest
+
+from chrome_render import (READY_DOM_QUIET, READY_NETWORK_IDLE, READY_SELECTOR, ReadyRule,
+                           RenderStats, instrument, rule_for, wait_until_ready)
+
+
+class ScriptedDriver:
+    """Answers the readiness probe from a list of states (the last one repeats)."""
+
+    def __init__(self, states, cdp=True):
+        self.states = list(states)
+        self.cdp = cdp
+        self.scripts = []
+
+    def execute_cdp_cmd(self, cmd, params):
+        if not self.cdp:
+            raise RuntimeError("not chrome")
+        self.scripts.append(cmd)
+
+    def execute_script(self, script, *args):
+        self.scripts.append(args)
+        return self.states.pop(0) if len(self.states) > 1 else self.states[0]
+
+
+def test_rules():
+    idle = ReadyRule(READY_NETWORK_IDLE, idle_ms=500)
+    assert not idle.satisfied(["complete", 1, 900, 900, False])
+    assert not idle.satisfied(["interactive", 0, 900, 900, False])
+    assert not idle.satisfied(["complete", 0, 100, 900, False])
+    assert idle.satisfied(["complete", 0, 600, 10, False])
+    quiet = ReadyRule(READY_DOM_QUIET, quiet_ms=300)
+    assert quiet.satisfied(["interactive", 4, 0, 400, False])
+    assert ReadyRule(selector="article").satisfied(["loading", 3, 0, 0, True])
+    with pytest.raises(ValueError):
+        ReadyRule(READY_SELECTOR)
+
+    rules = {"reddit.com": ReadyRule(selector="shreddit-post")}
+    assert rule_for("old.reddit.com", idle, rules).selector == "shreddit-post"
+    assert rule_for("notreddit.com", idle, rules) is idle
+
+
+def test_returns_as_soon_as_ready():
+    driver = ScriptedDriver([["loading", 2, 0, 0, False], ["complete", 1, 50, 50, False],
+                             ["complete", 0, 700, 700, False]])
+    assert instrument(driver) and instrument(driver)
+    assert driver.scripts.count("Page.addScriptToEvaluateOnNewDocument") == 1
+    readiness = wait_until_ready(driver, ReadyRule(), time.monotonic() + 5)
+    assert readiness.ready and readiness.strategy == READY_NETWORK_IDLE
+    assert readiness.seconds < 1
+
+
+def test_deadline_and_stats():
+    driver = ScriptedDriver([["complete", 3, 0, 0, False]], cdp=False)
+    assert not instrument(driver)
+    start = time.monotonic()
+    readiness = wait_until_ready(driver, ReadyRule(), start + 0.3, instrumented=False)
+    assert not readiness.ready and 0.2 < time.monotonic() - start < 1
+
+    stats = RenderStats()
+    stats.record("https://a.example/", readiness, 0.4)
+    info = stats.snapshot()
+    assert info["strategies"][READY_NETWORK_IDLE]["deadline"] == 1
+    assert info["recent"][0]["url"] == "https://a.example/" and info["recent"][0]["ready"] is False
+
+
+def test_block_patterns_and_network_summary():
+    from chrome_render import apply_blocking, block_patterns, drain_network_log, summarize_network
+    import json
+
+    patterns = block_patterns(("image", "analytics"), ("*/ads/*",))
+    assert "*.png*" in patterns and "*doubleclick.net/*" in patterns and patterns[-1] == "*/ads/*"
+    with pytest.raises(ValueError):
+        block_patterns(("stylesheet",))
+
+    driver = ScriptedDriver([None])
+    assert apply_blocking(driver, patterns) and apply_blocking(driver, patterns)
+    assert driver.scripts == ["Network.enable", "Network.setBlockedURLs"]
+
+    def entry(method, **params):
+        return {"message": json.dumps({"message": {"method": method, "params": params}})}
+    driver.get_log = lambda kind: [
+        entry("Network.requestWillBeSent"), entry("Network.requestWillBeSent"),
+        entry("Network.requestWillBeSent"), entry("Page.frameNavigated"),
+        entry("Network.loadingFailed", blockedReason="inspector"),
+        entry("Network.loadingFailed", errorText="net::ERR_FAILED"),
+        entry("Network.loadingFinished", encodedDataLength=1234),
+    ]
+    summary = summarize_network(drain_network_log(driver))
+    assert summary == {"requests": 3, "blocked": 1, "failed": 1, "bytes": 1234}
+
+    stats = RenderStats()
+    readiness = wait_until_ready(ScriptedDriver([["complete", 0, 900, 900, False]]), ReadyRule(),
+                                 time.monotonic() + 1)
+    stats.record("https://a.example/", readiness, 0.2, summary, blocking=True)
+    stats.record("https://a.example/", readiness, 0.6, {"requests": 9, "bytes": 9000})
+    info = stats.snapshot()["blocking"]
+    assert info["blocking"]["blocked"] == 1 and info["unblocked"]["bytes_per_render"] == 9000
+    assert info["blocking"]["render_avg_ms"] < info["unblocked"]["render_avg_ms"]
+
+
+def test_harvest_responses_collects_finished_static_bodies():
+    import base64
+    from chrome_render import harvest_responses
+
+    def received(request_id, url, kind="Script", status=200, **headers):
+        return {"method": "Network.responseReceived",
+                "params": {"requestId": request_id, "type": kind,
+                           "response": {"url": url, "status": status, "headers": headers}}}
+
+    def finished(request_id):
+        return {"method": "Network.loadingFinished", "params": {"requestId": request_id}}
+
+    events = [
+        received("1", "https://cdn.example/app.js", **{"Cache-Control": "max-age=60",
+                                                        "Content-Encoding": "br"}),
+        received("2", "https://cdn.example/logo.png", "Image"),
+        received("3", "https://a.example/", "Document"),
+        received("4", "https://cdn.example/missing.css", "Stylesheet", 404),
+        received("5", "https://cdn.example/never-finished.js"),
+        received("6", "https://cdn.example/skip.css", "Stylesheet"),
+        finished("1"), finished("2"), finished("3"), finished("4"), finished("6"),
+    ]
+    bodies = {"1": {"body": "var a = 1;", "base64Encoded": False},
+              "2": {"body": base64.b64encode(b"\x89PNG").decode(), "base64Encoded": True}}
+    driver = ScriptedDriver([None])
+    driver.execute_cdp_cmd = lambda cmd, params: bodies[params["requestId"]]
+
+    harvested = harvest_responses(driver, events, wanted=lambda url, headers: "skip" not in url)
+    assert [(h.url, h.body) for h in harvested] == [("https://cdn.example/app.js", b"var a = 1;"),
+                                                    ("https://cdn.example/logo.png", b"\x89PNG")]
+    assert harvested[0].headers == {"Cache-Control": "max-age=60"}
+    assert len(harvest_responses(driver, events, max_bytes=5)) == 1
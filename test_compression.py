@@ -0,0 +1,40 @@
+import gzip
+import zlib
+
+import compression
+
+
+class FakeResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def test_negotiate_respects_q_values():
+    assert compression.negotiate("gzip, deflate") == "gzip"
+    assert compression.negotiate("gzip;q=0, deflate") == "deflate"
+    assert compression.negotiate("identity") is None
+    assert compression.negotiate("") is None
+    assert compression.upstream_accept_encoding("br, gzip") == "br, gzip"
+    assert compression.upstream_accept_encoding("") == "identity"
+
+
+def test_can_passthrough_only_accepted_encodings():
+    assert compression.can_passthrough(FakeResponse({}), "")
+    assert compression.can_passthrough(FakeResponse({"Content-Encoding": "gzip"}), "gzip, br")
+    assert not compression.can_passthrough(FakeResponse({"Content-Encoding": "br"}), "gzip")
+
+
+def test_compress_stream_roundtrip():
+    chunks = [b"<p>hello</p>" * 500 for _ in range(5)]
+    body = b"".join(compression.compress_stream(iter(chunks), "gzip"))
+    assert gzip.decompress(body) == b"".join(chunks)
+    body = b"".join(compression.compress_stream(iter(chunks), "deflate"))
+    assert zlib.decompress(body) == b"".join(chunks)
+
+
+def test_encoded_headers_merges_vary():
+    headers = compression.encoded_headers(
+        {"content-length": "10", "vary": "Cookie", "Content-Type": "text/html"}, "gzip"
+    )
+    assert headers == {"Content-Type": "text/html", "Content-Encoding": "gzip",
+                       "Vary": "Cookie, Accept-Encoding"}
@@ -0,0 +1,33 @@
+from conditional import (browser_cache_headers, content_etag, forward_headers, is_not_modified,
+                         not_modified, stats)
+
+STORED = {"ETag": '"v1"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT", "Cache-Control": "max-age=60",
+          "Content-Type": "text/css", "Set-Cookie": "a=b"}
+
+
+def test_validators_match_stored_response():
+    assert is_not_modified({"If-None-Match": '"v1"'}, STORED)
+    assert is_not_modified({"If-None-Match": 'W/"v0", W/"v1"'}, STORED)
+    assert is_not_modified({"If-None-Match": "*"}, STORED)
+    assert not is_not_modified({"If-None-Match": '"v2"'}, STORED)
+    # If-None-Match wins over a matching If-Modified-Since
+    assert not is_not_modified({"If-None-Match": '"v2"', "If-Modified-Since": STORED["Last-Modified"]}, STORED)
+    assert is_not_modified({"If-Modified-Since": "Thu, 22 Oct 2015 07:28:00 GMT"}, STORED)
+    assert not is_not_modified({"If-Modified-Since": "Tue, 20 Oct 2015 07:28:00 GMT"}, STORED)
+    assert not is_not_modified({"If-Modified-Since": "garbage"}, STORED)
+    assert not is_not_modified({}, STORED)
+
+
+def test_local_304_headers_and_counters():
+    before = stats.snapshot()
+    headers = not_modified({"If-None-Match": '"v1"'}, STORED, 1234)
+    assert headers == {"ETag": '"v1"', "Last-Modified": STORED["Last-Modified"], "Cache-Control": "max-age=60"}
+    assert not_modified({"If-None-Match": '"v2"'}, STORED, 1234) is None
+    after = stats.snapshot()
+    assert after["local_not_modified"] - before["local_not_modified"] == 1
+    assert after["bytes_avoided"] - before["bytes_avoided"] == 1234
+
+    assert forward_headers({"If-None-Match": '"v1"', "Accept": "*/*"}) == {"If-None-Match": '"v1"'}
+    assert browser_cache_headers({"Content-Type": "text/html"})["Cache-Control"] == "no-cache"
+    assert browser_cache_headers({"Expires": "0"}) == {"Expires": "0"}
+    assert content_etag(b"page") == content_etag(b"page") != content_etag(b"page2")
@@ -0,0 +1,79 @@
+import os
+import struct
+
+import disk_cache
+from asset_cache import make_key
+
+HEADERS = {"Cache-Control": "max-age=600", "Content-Type": "text/javascript"}
+
+
+def store(cache, url, body):
+    key = make_key(url, "gzip")
+    assert b"".join(cache.tee(key, 200, HEADERS, iter([body[:3], body[3:]]))) == body
+    return key
+
+
+def test_identical_bodies_are_stored_once(tmp_path):
+    cache = disk_cache.DiskCache(str(tmp_path), index_slots=64)
+    a = store(cache, "https://cdn1.example/lib.js", b"library-bytes")
+    b = store(cache, "https://cdn2.example/lib.js", b"library-bytes")
+
+    snap = cache.snapshot()
+    assert snap["objects"] == 1 and snap["bytes"] == len(b"library-bytes")
+    assert snap["dedup_stores"] == 1
+
+    for key in (a, b):
+        entry = cache.lookup(key)
+        assert entry.is_fresh()
+        assert entry.headers["Content-Type"] == "text/javascript"
+        assert cache.serve(entry).read() == b"library-bytes"
+        entry.close()
+
+
+def test_index_survives_restart_and_drops_torn_slots(tmp_path):
+    cache = disk_cache.DiskCache(str(tmp_path), index_slots=64)
+    good = store(cache, "https://cdn.example/a.js", b"aaaa")
+    torn = store(cache, "https://cdn.example/b.js", b"bbbb")
+    slot, _, _ = cache._find(disk_cache._key_hash(torn))
+    # Simulate a crash in the middle of a slot write (odd sequence number)
+    struct.pack_into("<I", cache._map, cache._slot_offset(slot), 7)
+    cache.close()
+    os.makedirs(tmp_path / "tmp", exist_ok=True)
+    (tmp_path / "tmp" / "999999999-0.part").write_bytes(b"partial")
+
+    reopened = disk_cache.DiskCache(str(tmp_path), index_slots=64)
+    entry = reopened.lookup(good)
+    assert reopened.serve(entry).read() == b"aaaa"
+    entry.close()
+    assert reopened.lookup(torn) is None
+    assert reopened.snapshot()["objects"] == 1
+    assert os.listdir(tmp_path / "tmp") == []
+
+
+def test_evicts_least_recently_used_objects(tmp_path):
+    cache = disk_cache.DiskCache(str(tmp_path), max_bytes=100, index_slots=64)
+    keys = [store(cache, f"https://cdn.example/{i}.js", bytes([i]) * 40) for i in range(4)]
+    snap = cache.snapshot()
+    assert snap["bytes"] <= 100 and snap["evictions"] >= 2
+    assert cache.lookup(keys[0]) is None
+    entry = cache.lookup(keys[3])
+    assert entry is not None
+    entry.close()
+
+
+def test_disk_errors_never_cut_the_body_short(tmp_path, monkeypatch):
+    cache = disk_cache.DiskCache(str(tmp_path), index_slots=64)
+    os.rmdir(cache._tmp)                          # the temp file cannot even be opened
+    assert cache.lookup(store(cache, "https://cdn.example/a.js", b"abcdef")) is None
+
+    class FailingFile:
+        def write(self, data):
+            raise OSError(28, "No space left on device")
+
+        def close(self):
+            pass
+
+    os.mkdir(cache._tmp)
+    monkeypatch.setattr(disk_cache, "open", lambda *args: FailingFile(), raising=False)
+    assert cache.lookup(store(cache, "https://cdn.example/b.js", b"ghijkl")) is None
+    assert os.listdir(cache._tmp) == []
@@ -0,0 +1,79 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import dns_cache
+from dns_cache import BlockedAddressError, Resolver
+
+
+def fake_getaddrinfo(answers, calls, delay=0.0):
+    def getaddrinfo(host, port, *args, **kwargs):
+        calls.append(host)
+        time.sleep(delay)
+        if host not in answers:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (ip, 0)) for ip in answers[host]]
+    return getaddrinfo
+
+
+def test_positive_and_negative_caching(monkeypatch):
+    calls = []
+    monkeypatch.setattr(socket, "getaddrinfo", fake_getaddrinfo({"example.com": ["93.184.216.34"] * 2}, calls))
+    resolver = Resolver(ttl=0.2, negative_ttl=0.2)
+
+    assert resolver.resolve("Example.COM.") == ("93.184.216.34",)
+    assert resolver.resolve("example.com") == ("93.184.216.34",)
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            resolver.resolve("nxdomain.invalid")
+    assert calls == ["example.com", "nxdomain.invalid"]
+
+    time.sleep(0.25)
+    resolver.resolve("example.com")
+    assert calls.count("example.com") == 2
+    info = resolver.snapshot()
+    assert info["hits"] == 1 and info["negative_hits"] == 1 and info["failures"] == 1
+    assert info["misses"] == 3 and info["lookups"] == 5
+
+
+def test_concurrent_lookups_are_coalesced(monkeypatch):
+    calls = []
+    monkeypatch.setattr(socket, "getaddrinfo", fake_getaddrinfo({"slow.example": ["1.1.1.1"]}, calls, 0.2))
+    resolver = Resolver()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(resolver.resolve("slow.example")))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert calls == ["slow.example"] and results == [("1.1.1.1",)] * 8
+    assert resolver.snapshot()["coalesced"] == 7
+
+
+def test_check_blocks_internal_answers(monkeypatch):
+    calls = []
+    answers = {"rebind.example": ["8.8.8.8", "10.0.0.5"], "public.example": ["8.8.4.4"]}
+    monkeypatch.setattr(socket, "getaddrinfo", fake_getaddrinfo(answers, calls))
+    resolver = Resolver()
+
+    assert resolver.resolve("rebind.example") == ("8.8.8.8", "10.0.0.5")
+    with pytest.raises(BlockedAddressError):
+        resolver.resolve("rebind.example", check=True)
+    assert resolver.resolve("public.example", check=True) == ("8.8.4.4",)
+    for literal in ("127.0.0.1", "[::1]", "169.254.169.254", "::ffff:192.168.0.1"):
+        with pytest.raises(BlockedAddressError):
+            resolver.resolve(literal, check=True)
+    assert resolver.resolve("[2606:4700::1111]", check=True) == ("2606:4700::1111",)
+    assert calls == ["rebind.example", "public.example"]
+
+
+def test_get_resolver_applies_settings():
+    dns_cache.configure(ttl=5, negative_ttl=1)
+    try:
+        resolver = dns_cache.get_resolver()
+        assert dns_cache.get_resolver() is resolver and resolver.ttl == 5
+    finally:
+        dns_cache.configure(ttl=dns_cache.DEFAULT_TTL, negative_ttl=dns_cache.DEFAULT_NEGATIVE_TTL)
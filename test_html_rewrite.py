@@ -0,0 +1,61 @@
+from html_rewrite import StreamingHtmlRewriter, rewrite_proxy_links
+
+PAGE = (
+    b'<a href="/a">x</a><img src=\'//cdn.com/i.png\'>'
+    b'<form ACTION="https://example.com/post"><a href="https://other.com/">o</a>'
+    b'<div style="background:url( \'/bg.png\')" data-src="/lazy"></div>'
+    b'<a href="#top">t</a><p>caf\xc3\xa9 url(//cdn.com/x.png)</p>'
+)
+
+
+def test_streaming_rewriter_forms():
+    out = StreamingHtmlRewriter("example.com").rewrite(PAGE)
+    assert b'href="/p/example.com/a"' in out
+    assert b"src='/p/cdn.com/i.png'" in out
+    assert b'ACTION="/p/example.com/post"' in out
+    assert b'href="https://other.com/"' in out
+    assert b"url( '/p/example.com/bg.png')" in out
+    assert b'data-src="/p/example.com/lazy"' in out
+    assert b'href="#top"' in out
+    assert b"caf\xc3\xa9 url(//cdn.com/x.png)" in out
+
+
+def test_streaming_rewriter_chunk_boundaries():
+    page = PAGE * 20
+    expected = StreamingHtmlRewriter("example.com").rewrite(page)
+    for size in (1, 2, 5, 13, 64, 4096):
+        rewriter = StreamingHtmlRewriter("example.com")
+        out = b"".join(rewriter.feed(page[i:i + size]) for i in range(0, len(page), size))
+        assert out + rewriter.flush() == expected
+
+
+def test_streaming_rewriter_holds_back_bounded_tail():
+    rewriter = StreamingHtmlRewriter("example.com")
+    emitted = 0
+    for _ in range(1000):
+        emitted += len(rewriter.feed(PAGE))
+    assert emitted > len(PAGE) * 990
+    assert len(rewriter._buf) <= rewriter._hold
+
+
+def test_rewrite_proxy_links_edits_values_in_place():
+    page = (
+        "<!DOCTYPE html><!-- <a href='/old'> --><link rel=stylesheet href=/site.css>"
+        "<style>a{background:url(/bg.png)}</style><A HREF='rel?a=1&amp;b=2'>x</A>"
+        "<form action=/post><input src=\"//cdn.com/i.png\"></form><div action=\"/keep\"></div>"
+    )
+    out = rewrite_proxy_links("https://example.com/dir/", page)
+    assert out == (
+        "<!DOCTYPE html><!-- <a href='/old'> -->"
+        "<link rel=stylesheet href=\"/proxy?url=https%3A%2F%2Fexample.com%2Fsite.css\">"
+        "<style>a{background:url(/bg.png)}</style>"
+        "<A HREF='/proxy?url=https%3A%2F%2Fexample.com%2Fdir%2Frel%3Fa%3D1%26b%3D2'>x</A>"
+        "<form action=\"/proxy?url=https%3A%2F%2Fexample.com%2Fpost\">"
+        "<input src=\"/proxy?url=https%3A%2F%2Fcdn.com%2Fi.png\"></form><div action=\"/keep\"></div>"
+    )
+
+
+def test_rewrite_proxy_links_continues_past_malformed_tags():
+    out = rewrite_proxy_links("https://example.com/", '<a ="x" href="/a">x</a><p <b><img src="/c"><a href="/d">')
+    assert out == ('<a ="x" href="/a">x</a><p <b><img src="/proxy?url=https%3A%2F%2Fexample.com%2Fc">'
+                   '<a href="/proxy?url=https%3A%2F%2Fexample.com%2Fd">')
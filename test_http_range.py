@@ -0,0 +1,44 @@
+import io
+
+from http_range import (UNSATISFIABLE, forward_headers, if_range_allows, parse_range, partial_headers,
+                        read_file_range, select, slice_chunks)
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-499", 1000) == (0, 499)
+    assert parse_range("bytes=500-", 1000) == (500, 999)
+    assert parse_range("bytes=-200", 1000) == (800, 999)
+    assert parse_range("bytes=-5000", 1000) == (0, 999)
+    assert parse_range("bytes=900-5000", 1000) == (900, 999)
+    assert parse_range("bytes=1000-", 1000) == UNSATISFIABLE
+    assert parse_range("bytes=-0", 1000) == UNSATISFIABLE
+    for ignored in (None, "", "items=0-1", "bytes=5-1", "bytes=0-1,5-9", "bytes=-", "bytes= 1-2x"):
+        assert parse_range(ignored, 1000) is None
+
+
+def test_if_range_and_select():
+    stored = {"ETag": '"v1"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    assert if_range_allows(None, stored)
+    assert if_range_allows('"v1"', stored) and not if_range_allows('"v2"', stored)
+    assert not if_range_allows('W/"v1"', stored) and not if_range_allows('"v1"', {"ETag": 'W/"v1"'})
+    assert if_range_allows("Wed, 21 Oct 2015 07:28:00 GMT", stored)
+    assert not if_range_allows("Thu, 22 Oct 2015 07:28:00 GMT", stored)
+
+    assert select({"Range": "bytes=2-3"}, stored, 10) == (2, 3)
+    assert select({"Range": "bytes=2-3", "If-Range": '"old"'}, stored, 10) is None
+    assert select({}, stored, 10) is None
+    assert forward_headers({"If-Range": '"v1"'}) == {}
+    assert forward_headers({"Range": "bytes=0-", "If-Range": '"v1"'}) == {"Range": "bytes=0-",
+                                                                          "If-Range": '"v1"'}
+    headers = partial_headers({"Content-Length": "10", "Content-Type": "video/mp4"}, 2, 3, 10)
+    assert headers == {"Content-Type": "video/mp4", "Content-Range": "bytes 2-3/10", "Content-Length": "2"}
+
+
+def test_slices_of_chunks_and_files():
+    chunks = (b"abc", b"", b"defg", b"hij")
+    body = b"".join(chunks)
+    for start, end in ((0, 9), (0, 0), (2, 3), (3, 6), (4, 8), (9, 9)):
+        assert b"".join(slice_chunks(chunks, start, end)) == body[start:end + 1]
+        f = io.BytesIO(body)
+        assert b"".join(read_file_range(f, start, end, chunk_size=2)) == body[start:end + 1]
+        assert f.closed
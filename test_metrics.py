@@ -0,0 +1,94 @@
+import multiprocessing
+import threading
+
+import pytest
+
+from metrics import Registry
+
+fork = multiprocessing.get_context("fork")
+
+
+def test_counter_and_histogram_exposition():
+    registry = Registry(rows=4)
+    hits = registry.counter("hits_total", "Hits.", ("route", "code"), (("a", "b"), ("2xx", "5xx")))
+    latency = registry.histogram("latency_seconds", "Latency.", ("route",), (("a",),), buckets=(0.1, 1.0))
+    hits.inc("a", "2xx")
+    hits.inc("a", "2xx", amount=2)
+    latency.observe(0.05, "a")
+    latency.observe(0.5, "a")
+    latency.observe(7, "a")
+    lines = registry.exposition().splitlines()
+    assert "# TYPE hits_total counter" in lines
+    assert 'hits_total{route="a",code="2xx"} 3' in lines
+    assert 'hits_total{route="b",code="5xx"} 0' in lines
+    assert "# TYPE latency_seconds histogram" in lines
+    assert [line for line in lines if line.startswith("latency_seconds")] == [
+        'latency_seconds_bucket{route="a",le="0.1"} 1',
+        'latency_seconds_bucket{route="a",le="1.0"} 2',
+        'latency_seconds_bucket{route="a",le="+Inf"} 3',
+        'latency_seconds_sum{route="a"} 7.55',
+        'latency_seconds_count{route="a"} 3',
+    ]
+
+
+def test_threads_record_into_their_own_rows():
+    registry = Registry(rows=16)
+    hits = registry.counter("hits_total", "Hits.")
+    workers = [threading.Thread(target=lambda: [hits.inc() for _ in range(10_000)]) for _ in range(8)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert "hits_total 80000" in registry.exposition().splitlines()
+    # Rows of the finished threads are reused, their totals kept
+    worker = threading.Thread(target=hits.inc)
+    worker.start()
+    worker.join()
+    assert "hits_total 80001" in registry.exposition().splitlines()
+
+
+def test_declaring_after_open_is_an_error():
+    registry = Registry(rows=4)
+    registry.counter("early_total", "Early.").inc()
+    with pytest.raises(RuntimeError):
+        registry.counter("late_total", "Late.")
+    with pytest.raises(ValueError):
+        registry = Registry(rows=4)
+        registry.counter("twice_total", "Twice.")
+        registry.counter("twice_total", "Twice.")
+
+
+def test_callbacks_are_read_at_scrape_time():
+    registry = Registry(rows=4)
+    depth = {"waiting": 2, "rendering": 1}
+    registry.callback("queue", "Queue.", lambda: dict(depth), labelnames=("state",))
+    registry.callback("broken", "Broken.", lambda: 1 / 0)
+    depth["waiting"] = 5
+    lines = registry.exposition().splitlines()
+    assert 'queue{state="waiting"} 5' in lines and 'queue{state="rendering"} 1' in lines
+    assert not any(line.startswith("broken") for line in lines)
+
+
+def _record(hits, n):
+    for _ in range(n):
+        hits.inc()
+
+
+def test_workers_share_one_file(tmp_path):
+    pytest.importorskip("fcntl")
+    path = str(tmp_path / "metrics")
+    registry = Registry(rows=8)
+    hits = registry.counter("hits_total", "Hits.")
+    registry.open(path)
+    hits.inc()
+    workers = [fork.Process(target=_record, args=(hits, 100)) for _ in range(3)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert "hits_total 301" in registry.exposition().splitlines()
+    # A fresh process (a restarted worker) with the same layout sees the same totals
+    other = Registry(rows=8)
+    other.counter("hits_total", "Hits.")
+    other.open(path)
+    assert "hits_total 301" in other.exposition().splitlines()
@@ -0,0 +1,135 @@
+import threading
+
+import compression
+from page_cache import MODE_CHROME, MODE_STEALTH, PageCache, make_key
+
+HTML = b"<html><body>" + b"<a href='/p/example.com/x'>x</a>" * 200 + b"</body></html>"
+HEADERS = {"Content-Type": "text/html", "Cache-Control": "max-age=60", "ETag": '"v1"',
+           "Content-Length": "123", "Set-Cookie": "a=b"}
+
+
+def test_store_and_serve_compressed_or_identity():
+    cache = PageCache()
+    key = make_key("https://example.com/", MODE_STEALTH)
+    entry = cache.store(key, 200, HEADERS, HTML)
+    assert entry.size < len(HTML)
+    assert cache.lookup(key) is entry and entry.is_fresh()
+    assert cache.lookup(make_key("https://example.com/", MODE_CHROME)) is None
+
+    body, headers = cache.body_for(entry, "gzip, deflate, br")
+    assert headers["Content-Encoding"] == cache.encoding and body == entry.body
+    assert "Set-Cookie" not in headers and headers["X-Cache"] == "HIT"
+    body, headers = cache.body_for(entry, "identity")
+    assert body == HTML and "Content-Encoding" not in headers
+
+    info = cache.snapshot()
+    assert info["hits"] == 2 and info["lookups"] == 2 and info["rewrite_bytes_skipped"] == 2 * len(HTML)
+    assert compression.PRODUCIBLE[0] == cache.encoding
+
+
+def test_uncacheable_and_revalidation():
+    cache = PageCache()
+    key = make_key("https://example.com/", MODE_STEALTH)
+    assert cache.store(key, 200, {"Cache-Control": "no-store"}, HTML) is None
+    assert cache.store(key, 200, {}, HTML) is None
+
+    entry = cache.store(key, 200, {"Cache-Control": "no-cache", "ETag": '"v1"'}, HTML)
+    assert not entry.is_fresh() and entry.conditional_headers() == {"If-None-Match": '"v1"'}
+    fresh = cache.revalidated(key, entry, {"Cache-Control": "max-age=30", "ETag": '"v1"'})
+    assert fresh.is_fresh() and fresh.body is entry.body and cache.lookup(key) is fresh
+
+    chrome = make_key("https://reddit.com/", MODE_CHROME)
+    assert cache.store(chrome, 200, {"Content-Type": "text/html"}, HTML, lifetime=30).is_fresh()
+
+
+def test_no_cache_and_must_revalidate_pages_are_never_served_stale():
+    cache = PageCache(stale_seconds=60)
+    key = make_key("https://example.com/", MODE_STEALTH)
+    for cache_control in ("no-cache", "max-age=0, must-revalidate"):
+        entry = cache.store(key, 200, {"Cache-Control": cache_control, "ETag": '"v1"'}, HTML)
+        assert not entry.is_fresh() and not entry.can_serve_stale()
+        assert not cache.revalidated(key, entry, {"ETag": '"v1"'}).can_serve_stale()
+    # ... unless upstream grants the window explicitly
+    entry = cache.store(key, 200, {"Cache-Control": "no-cache, stale-while-revalidate=30", "ETag": '"v1"'}, HTML)
+    assert entry.can_serve_stale()
+    assert cache.store(key, 200, {"Cache-Control": "max-age=0", "ETag": '"v1"'}, HTML).can_serve_stale()
+
+
+def test_stale_while_revalidate_refreshes_once():
+    cache = PageCache(stale_seconds=0)
+    key = make_key("https://example.com/", MODE_STEALTH)
+    entry = cache.store(key, 200, {"Cache-Control": "max-age=0, stale-while-revalidate=30",
+                                   "ETag": '"v1"'}, HTML)
+    assert not entry.is_fresh() and entry.can_serve_stale()
+
+    release = threading.Event()
+    done = threading.Event()
+
+    def refresh():
+        release.wait(5)
+        cache.store(key, 200, {"Cache-Control": "max-age=60"}, b"<html>new</html>")
+        done.set()
+
+    assert cache.refresh_async(key, refresh)
+    assert not cache.refresh_async(key, refresh)
+    release.set()
+    assert done.wait(5)
+    body, _ = cache.body_for(cache.lookup(key), "")
+    assert body == b"<html>new</html>"
+    assert cache.snapshot()["refreshes"] == 1
+
+
+def test_byte_bound_evicts_lru():
+    cache = PageCache(max_bytes=1)
+    assert cache.store(make_key("https://a/", MODE_STEALTH), 200, HEADERS, HTML) is None
+    cache = PageCache()
+    first = cache.store(make_key("https://a/", MODE_STEALTH), 200, HEADERS, HTML)
+    cache.max_bytes = first.size * 2
+    cache.store(make_key("https://b/", MODE_STEALTH), 200, HEADERS, HTML)
+    cache.store(make_key("https://c/", MODE_STEALTH), 200, HEADERS, HTML)
+    assert cache.lookup(make_key("https://a/", MODE_STEALTH)) is None
+    assert cache.snapshot()["evictions"] == 1
+
+
+def test_concurrent_misses_coalesce_into_one_render():
+    cache = PageCache()
+    key = make_key("https://example.com/", MODE_CHROME)
+    calls = []
+    release = threading.Event()
+
+    def render():
+        calls.append(1)
+        release.wait(5)
+        return "page"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.coalesce(key, render)))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    while cache.snapshot()["coalesced"] < 7:
+        threading.Event().wait(0.01)
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert results == ["page"] * 8 and len(calls) == 1
+
+    def fail():
+        raise RuntimeError("boom")
+
+    try:
+        cache.coalesce(key, fail)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("error not propagated")
+    assert cache.coalesce(key, lambda: "again") == "again"
+    assert cache.snapshot()["in_flight"] == 0
+
+
+def test_keys_are_canonical_and_stale_window_overridable():
+    assert make_key("HTTPS://Example.COM:443#top", MODE_STEALTH) == make_key("https://example.com/", MODE_STEALTH)
+    assert make_key("http://example.com:8080/a?b", MODE_STEALTH)[0] == "http://example.com:8080/a?b"
+    cache = PageCache(stale_seconds=0)
+    entry = cache.store(make_key("https://a/", MODE_CHROME), 200, {}, HTML, lifetime=0, stale=60)
+    assert not entry.is_fresh() and entry.can_serve_stale()
@@ -0,0 +1,41 @@
+import ipaddress
+
+from policy import HostPolicy, load_list, parse_entry
+
+
+def test_parse_entry_formats():
+    assert parse_entry("Example.COM.") == ("domain", "example.com")
+    assert parse_entry("*.ads.example.com") == ("domain", "ads.example.com")
+    assert parse_entry("0.0.0.0 tracker.example.net  # hosts file") == ("domain", "tracker.example.net")
+    assert parse_entry("||doubleclick.net^") == ("domain", "doubleclick.net")
+    assert parse_entry("10.0.0.0/8") == ("network", ipaddress.ip_network("10.0.0.0/8"))
+    assert parse_entry("[::1]") == ("network", ipaddress.ip_network("::1/128"))
+    assert parse_entry("   # comment") is None
+
+
+def test_domain_suffixes_and_networks():
+    policy = HostPolicy(block=["reddit.com", "192.168.0.0/16", "fc00::/7", "203.0.113.7"],
+                        chrome=["x.com", "reddit.com"])
+    assert policy.matches("reddit.com") == {"block", "chrome"}
+    assert policy.matches("WWW.Reddit.com.") == {"block", "chrome"}
+    assert policy.matches("notreddit.com") == frozenset()
+    assert policy.matches("reddit.com.evil") == frozenset()
+    assert policy.matches("com") == frozenset()
+    assert policy.matches("192.168.4.4") == {"block"}
+    assert policy.matches("[fd12::1]") == {"block"}
+    assert policy.matches("::ffff:192.168.1.1") == {"block"}
+    assert policy.matches("203.0.113.8") == frozenset()
+    assert policy.address_matches("203.0.113.7") == {"block"}
+    assert policy.has("chrome") and not policy.has("allow")
+
+
+def test_verdict_cache_is_bounded(tmp_path):
+    path = tmp_path / "hosts.txt"
+    path.write_text("# list\n" + "\n".join(f"0.0.0.0 ads{i}.example.com" for i in range(1000)))
+    policy = HostPolicy(cache_size=10, block=load_list(str(path)))
+    for i in range(20):
+        assert policy.matches(f"x.ads{i}.example.com") == {"block"}
+    assert policy.matches("x.ads19.example.com") == {"block"}
+    info = policy.snapshot()
+    assert info["domains"] == 1000 and info["cached"] == 10
+    assert info["hits"] == 1 and info["evictions"] == 10
@@ -0,0 +1,42 @@
+import threading
+
+from rate_limit import RateLimiter
+
+
+def test_burst_then_one_per_interval():
+    limiter = RateLimiter(max_requests=3, window=3)
+    assert [limiter.is_allowed("a", now=100.0) for _ in range(4)] == [True, True, True, False]
+    assert limiter.retry_after("a", now=100.0) == 1
+    assert limiter.is_allowed("a", now=100.5) is False
+    assert limiter.is_allowed("a", now=101.0) is True
+    assert limiter.is_allowed("a", now=101.0) is False
+    assert limiter.is_allowed("b", now=101.0) is True
+    assert limiter.snapshot()["denied"] == 3
+
+
+def test_sweep_drops_only_refilled_keys():
+    limiter = RateLimiter(max_requests=2, window=10, shards=4)
+    limiter.is_allowed("idle", now=0.0)           # full again at t=5
+    for _ in range(2):
+        limiter.is_allowed("busy", now=8.0)       # full again at t=18
+    assert limiter.sweep(now=9.0) == 1
+    assert len(limiter) == 1
+    # An evicted key behaves exactly like one seen for the first time
+    assert limiter.is_allowed("idle", now=9.0) is True
+    assert limiter.is_allowed("busy", now=9.0) is False
+    assert limiter.snapshot()["evicted"] == 1
+
+
+def test_concurrent_checks_admit_exactly_the_burst():
+    limiter = RateLimiter(max_requests=50, window=3600)
+    allowed = []
+
+    def worker():
+        allowed.extend(limiter.is_allowed("ip", now=1.0) for _ in range(20))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(allowed) == 50
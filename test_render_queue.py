@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+from render_queue import (PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, PRIORITY_RETRY, Overloaded,
+                          RenderQueue)
+
+
+def test_full_queue_rejects_fast_with_retry_after():
+    queue = RenderQueue(slots=1, max_depth=1, initial_service_seconds=4)
+    queue.acquire()
+    waiter = threading.Thread(target=lambda: pytest.raises(Overloaded, queue.acquire,
+                                                           deadline=time.monotonic() + 0.3))
+    waiter.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    with pytest.raises(Overloaded) as info:
+        queue.acquire(deadline=time.monotonic() + 5)
+    assert time.monotonic() - start < 0.1
+    assert info.value.reason == "full" and info.value.retry_after == 8
+    waiter.join()
+    stats = queue.snapshot()
+    assert stats["rejected_full"] == 1 and stats["timed_out"] == 1 and stats["depth"] == 0
+
+
+def test_waiters_are_served_by_priority_then_fifo():
+    queue = RenderQueue(slots=1, max_depth=10)
+    queue.acquire()
+    order = []
+
+    def wait(name, priority):
+        queue.acquire(priority, time.monotonic() + 5)
+        order.append(name)
+        queue.release(0.01)
+
+    threads = []
+    for name, priority in (("retry", PRIORITY_RETRY), ("bg1", PRIORITY_BACKGROUND),
+                           ("user1", PRIORITY_INTERACTIVE), ("bg2", PRIORITY_BACKGROUND),
+                           ("user2", PRIORITY_INTERACTIVE)):
+        threads.append(threading.Thread(target=wait, args=(name, priority)))
+        threads[-1].start()
+        time.sleep(0.02)
+    queue.release()
+    for t in threads:
+        t.join()
+    assert order == ["user1", "user2", "bg1", "bg2", "retry"]
+
+    stats = queue.snapshot()
+    assert stats["admitted"] == 6 and stats["max_depth_seen"] == 5 and stats["inflight"] == 0
+    assert stats["wait"]["interactive"]["count"] == 3 and stats["wait"]["retry"]["max_ms"] > 0
+
+
+def test_slot_context_releases_on_error():
+    queue = RenderQueue(slots=1)
+    with pytest.raises(RuntimeError):
+        with queue.slot():
+            raise RuntimeError("render failed")
+    with queue.slot(deadline=time.monotonic() + 0.1):
+        assert queue.snapshot()["inflight"] == 1
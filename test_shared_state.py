@@ -0,0 +1,115 @@
+import multiprocessing
+from types import SimpleNamespace
+
+import pytest
+
+from shared_state import SharedableStats, SharedCounters, SharedRateLimiter, share_stats
+
+pytest.importorskip("fcntl")
+fork = multiprocessing.get_context("fork")
+
+
+def test_limiter_budget_is_shared_between_mappings(tmp_path):
+    path = str(tmp_path / "limit")
+    a = SharedRateLimiter(path, max_requests=3, window=3, slots=1024, stripes=4)
+    b = SharedRateLimiter(path, max_requests=3, window=3, slots=1024, stripes=4)
+    assert a.is_allowed("1.2.3.4", now=100.0) and b.is_allowed("1.2.3.4", now=100.0)
+    assert a.is_allowed("1.2.3.4", now=100.0)
+    assert b.is_allowed("1.2.3.4", now=100.0) is False
+    assert a.retry_after("1.2.3.4", now=100.0) == 1
+    assert b.is_allowed("1.2.3.4", now=101.0) is True
+    assert a.is_allowed("5.6.7.8", now=101.0) is True
+    info = a.snapshot()
+    assert info["denied"] == 1 and info["keys"] == 0   # both buckets refilled long ago in real time
+    a.close()
+    b.close()
+
+
+def test_refilled_slots_are_reused_and_overflow_counted(tmp_path):
+    limiter = SharedRateLimiter(str(tmp_path / "limit"), max_requests=1, window=10, slots=16, stripes=1)
+    for i in range(16):
+        assert limiter.is_allowed(f"ip{i}", now=0.0)
+    assert limiter.is_allowed("late", now=0.0)      # table full: the soonest to refill is given up
+    assert limiter.snapshot()["overflow"] == 1
+    for i in range(16):
+        assert limiter.is_allowed(f"next{i}", now=20.0)
+    assert limiter.snapshot()["overflow"] == 1
+    limiter.close()
+
+
+def _hammer(path, results):
+    limiter = SharedRateLimiter(path, max_requests=50, window=3600, slots=1024, stripes=4)
+    results.put(sum(limiter.is_allowed("client") for _ in range(40)))
+
+
+def test_workers_share_one_budget(tmp_path):
+    path = str(tmp_path / "limit")
+    results = fork.Queue()
+    workers = [fork.Process(target=_hammer, args=(path, results)) for _ in range(4)]
+    for w in workers:
+        w.start()
+    allowed = sum(results.get(timeout=30) for _ in workers)
+    for w in workers:
+        w.join()
+    assert allowed == 50
+
+
+def _count(counters, n):
+    for _ in range(n):
+        counters.incr("hits")
+    counters.incr("bytes", 0.5)
+
+
+def test_counters_total_over_processes_and_survive_them(tmp_path):
+    counters = SharedCounters(str(tmp_path / "stats.counters"), ("hits", "bytes"), rows=4)
+    counters.incr("hits")
+    workers = [fork.Process(target=_count, args=(counters, 100)) for _ in range(3)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert counters.snapshot() == {"hits": 301, "bytes": 1.5}
+    # Rows of the exited workers are taken over without losing their totals
+    worker = fork.Process(target=_count, args=(counters, 10))
+    worker.start()
+    worker.join()
+    assert counters.snapshot() == {"hits": 311, "bytes": 2}
+    counters.close()
+
+
+def test_new_layout_replaces_the_file_under_old_mappings(tmp_path):
+    path = str(tmp_path / "stats.counters")
+    old = SharedCounters(path, ("hits",), rows=4)
+    old.incr("hits", 5)
+    new = SharedCounters(path, ("hits", "misses"), rows=4)   # e.g. a rolling deploy added a field
+    new.incr("misses")
+    # The old worker's mapping still works on the old (now unlinked) file
+    old.incr("hits")
+    assert old.snapshot() == {"hits": 6}
+    assert new.snapshot() == {"hits": 0, "misses": 1}
+    assert SharedCounters(path, ("hits", "misses"), rows=4).snapshot() == {"hits": 0, "misses": 1}
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["stats.counters"]
+    old.close()
+    new.close()
+
+
+class _Stats(SharedableStats):
+    FIELDS = ("hits", "bytes")
+
+
+def _count_stats(stats):
+    stats.incr("hits")
+    stats.incr("bytes", 10)
+
+
+def test_stats_count_locally_until_shared(tmp_path):
+    module = SimpleNamespace(__name__="fake", stats=_Stats())
+    module.stats.incr("hits")
+    assert module.stats.snapshot() == {"hits": 1, "bytes": 0}
+    share_stats(str(tmp_path), "test", module)     # from here on, totals over every process
+    worker = fork.Process(target=_count_stats, args=(module.stats,))
+    worker.start()
+    worker.join()
+    module.stats.incr("hits")
+    assert module.stats.snapshot() == {"hits": 2, "bytes": 10}
+    assert (tmp_path / "test-fake.counters").exists()
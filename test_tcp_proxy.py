@@ -0,0 +1,325 @@
+import asyncio
+import socket
+import threading
+import time
+from types import SimpleNamespace
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from tcp_proxy import (RELAY_RECV_INTO, RELAY_SPLICE, RELAY_STREAM, AsyncTcpProxy, _UpstreamPool,
+                       parse_request_head)
+
+
+def start_echo_server():
+    """Echo until the client half-closes, then send 'bye' and close."""
+    server = socket.create_server(("127.0.0.1", 0))
+
+    def serve(conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                conn.sendall(data)
+            conn.sendall(b"bye")
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server.getsockname()[1]
+
+
+@pytest.fixture(scope="module", params=[RELAY_STREAM, RELAY_RECV_INTO, RELAY_SPLICE])
+def proxy(request):
+    engine = AsyncTcpProxy("127.0.0.1", 0, backlog=64, idle_timeout=0.5, connect_timeout=2,
+                           relay_mode=request.param)
+    engine.start()
+    yield engine
+    engine.stop()
+
+
+def recv_exactly(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def recv_until(sock, marker):
+    data = b""
+    while marker not in data:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def test_parse_request_head():
+    assert parse_request_head(b"CONNECT example.com:443 HTTP/1.1\r\n\r\n") == ("CONNECT", "example.com", 443)
+    assert parse_request_head(b"CONNECT [::1]:8443 HTTP/1.1\r\n\r\n") == ("CONNECT", "::1", 8443)
+    assert parse_request_head(b"GET http://a.com:8080/x HTTP/1.1\r\n\r\n") == ("GET", "a.com", 8080)
+    assert parse_request_head(b"GET http://a.com/x HTTP/1.1\r\n\r\n") == ("GET", "a.com", 80)
+    with pytest.raises(ValueError):
+        parse_request_head(b"garbage\r\n\r\n")
+
+
+def test_connect_tunnel_relays_and_half_closes(proxy):
+    port = start_echo_server()
+    with socket.create_connection(("127.0.0.1", proxy.port), timeout=5) as client:
+        client.sendall(f"CONNECT 127.0.0.1:{port} HTTP/1.1\r\nHost: x\r\n\r\n".encode())
+        assert recv_until(client, b"\r\n\r\n").startswith(b"HTTP/1.1 200")
+        payload = bytes(range(256)) * 4096
+        threading.Thread(target=client.sendall, args=(payload,), daemon=True).start()
+        assert recv_exactly(client, len(payload)) == payload
+        client.shutdown(socket.SHUT_WR)
+        assert recv_until(client, b"bye") == b"bye"
+        assert client.recv(10) == b""
+    assert proxy.stats.connect_tunnels >= 1
+    assert proxy.stats.bytes_down >= len(payload) + 3
+
+
+def test_upstream_speaking_first_is_not_lost(proxy):
+    server = socket.create_server(("127.0.0.1", 0))
+
+    def greet():
+        conn, _ = server.accept()
+        with conn:
+            conn.sendall(b"220 ready\r\n")
+            conn.recv(10)
+
+    threading.Thread(target=greet, daemon=True).start()
+    with socket.create_connection(("127.0.0.1", proxy.port), timeout=5) as client:
+        client.sendall(f"CONNECT 127.0.0.1:{server.getsockname()[1]} HTTP/1.1\r\n\r\n".encode())
+        data = recv_until(client, b"ready\r\n")
+        assert data.startswith(b"HTTP/1.1 200") and data.endswith(b"220 ready\r\n")
+    server.close()
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = set()
+
+    def do_GET(self):
+        EchoHandler.connections.add(self.client_address)
+        body = f"{self.command} {self.path} {self.headers.get('Connection')}".encode()
+        if self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for part in (body, b"-tail"):
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(part), part))
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Keep-Alive", "timeout=5")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            data = b""
+            while True:
+                size = int(self.rfile.readline(), 16)
+                data += self.rfile.read(size + 2)[:size]
+                if not size:
+                    break
+        else:
+            data = self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def http_port():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), EchoHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_port
+    server.shutdown()
+
+
+def read_response(reader, head=False):
+    """Minimal client-side response reader (Content-Length or chunked)."""
+    status = reader.readline()
+    headers = {}
+    while True:
+        line = reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if head:
+        body = b""
+    elif headers.get("transfer-encoding") == "chunked":
+        body = b""
+        while True:
+            size = int(reader.readline(), 16)
+            body += reader.read(size + 2)[:size]
+            if not size:
+                reader.readline()
+                break
+    else:
+        body = reader.read(int(headers.get("content-length", 0)))
+    return status, headers, body
+
+
+def test_plain_http_keep_alive_and_pipelining(proxy, http_port):
+    EchoHandler.connections.clear()
+    base = f"http://127.0.0.1:{http_port}"
+    with socket.create_connection(("127.0.0.1", proxy.port), timeout=5) as client:
+        reader = client.makefile("rb")
+        client.sendall(f"GET {base}/one HTTP/1.1\r\nHost: x\r\nProxy-Connection: keep-alive\r\n\r\n".encode())
+        status, headers, body = read_response(reader)
+        assert status.startswith(b"HTTP/1.1 200") and headers["connection"] == "keep-alive"
+        assert body == b"GET /one keep-alive" and "keep-alive" not in headers
+
+        pipelined = (f"GET {base}/a HTTP/1.1\r\nHost: x\r\n\r\n"
+                     f"HEAD {base}/b HTTP/1.1\r\nHost: x\r\n\r\n"
+                     f"GET {base}/chunked HTTP/1.1\r\nHost: x\r\n\r\n"
+                     f"POST {base}/p HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\nhello"
+                     f"POST {base}/p HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n"
+                     f"3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n")
+        client.sendall(pipelined.encode())
+        assert read_response(reader)[2] == b"GET /a keep-alive"
+        status, headers, body = read_response(reader, head=True)
+        assert status.startswith(b"HTTP/1.1 200") and headers["content-length"] == "18"
+        assert read_response(reader)[2] == b"GET /chunked keep-alive-tail"
+        assert read_response(reader)[2] == b"hello"
+        assert read_response(reader)[2] == b"abcde"
+
+        client.sendall(f"GET {base}/last HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n".encode())
+        status, headers, body = read_response(reader)
+        assert headers["connection"] == "close" and body == b"GET /last keep-alive"
+        assert client.recv(10) == b""
+    # Every request reused the same pooled upstream connection
+    assert len(EchoHandler.connections) == 1
+    assert proxy.stats.http_keepalive_requests >= 6
+
+
+def start_raw_origin(response: bytes):
+    """Answer every request with the given bytes, then close."""
+    server = socket.create_server(("127.0.0.1", 0))
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                recv_until(conn, b"\r\n\r\n")
+                conn.sendall(response)
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def test_plain_http_malformed_upstream_responses(proxy):
+    before = proxy.stats.upstream_errors
+    garbled = start_raw_origin(b"HTTP/1.1 200 OK\r\nno colon here\r\n\r\n")
+    with socket.create_connection(("127.0.0.1", proxy.port), timeout=5) as client:
+        client.sendall(f"GET http://127.0.0.1:{garbled}/ HTTP/1.1\r\nHost: x\r\n\r\n".encode())
+        assert recv_until(client, b"\r\n\r\n").startswith(b"HTTP/1.1 502")
+    bad_chunk = start_raw_origin(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\nxx\r\n")
+    with socket.create_connection(("127.0.0.1", proxy.port), timeout=5) as client:
+        client.sendall(f"GET http://127.0.0.1:{bad_chunk}/ HTTP/1.1\r\nHost: x\r\n\r\n".encode())
+        data = recv_until(client, b"never")   # head relayed, then the connection is closed
+        assert data.startswith(b"HTTP/1.1 200") and b"xx" not in data
+    assert proxy.stats.upstream_errors == before + 2
+
+
+def test_plain_http_bad_requests(proxy, http_port):
+    with socket.create_connection(("127.0.0.1", proxy.port), timeout=5) as client:
+        client.sendall(b"GET /relative HTTP/1.1\r\n\r\n")
+        assert recv_until(client, b"\r\n\r\n").startswith(b"HTTP/1.1 400")
+    with socket.create_connection(("127.0.0.1", proxy.port), timeout=5) as client:
+        client.sendall(f"POST http://127.0.0.1:{http_port}/ HTTP/1.1\r\nContent-Length: 1\r\n"
+                       f"Content-Length: 2\r\n\r\n".encode())
+        assert recv_until(client, b"\r\n\r\n").startswith(b"HTTP/1.1 400")
+
+
+class FakeConn:
+    def __init__(self):
+        self.eof = False
+        self.closed = False
+
+    def at_eof(self):
+        return self.eof
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+def test_upstream_pool_reaps_idle_and_caps_total():
+    async def scenario():
+        engine = SimpleNamespace(loop=asyncio.get_running_loop())
+        pool = _UpstreamPool(max_idle_per_host=2, idle_timeout=0.1, max_idle=3)
+        conns = [FakeConn() for _ in range(5)]
+        for i, conn in enumerate(conns[:4]):
+            pool.put(engine, f"host{i}", 80, conn, conn)
+        # Over the global cap: the least recently used host gave its connection up
+        assert conns[0].closed and pool.idle_count() == 3
+        conns[1].eof = True       # closed by the origin: reaped at the next pass
+        await asyncio.sleep(0.05)
+        pool.put(engine, "host4", 80, conns[4], conns[4])
+        await asyncio.sleep(0.08)
+        assert conns[1].closed and conns[2].closed and conns[3].closed and not conns[4].closed
+        assert pool.idle_count() == 1 and list(pool._idle) == [("host4", 80)]
+        await asyncio.sleep(0.1)
+        assert conns[4].closed and pool.idle_count() == 0 and not pool._idle
+
+    asyncio.run(scenario())
+
+
+def test_errors_and_idle_timeout(proxy):
+    with socket.create_connection(("127.0.0.1", proxy.port), timeout=5) as client:
+        client.sendall(b"nonsense\r\n\r\n")
+        assert recv_until(client, b"\r\n\r\n").startswith(b"HTTP/1.1 400")
+
+    closed = socket.create_server(("127.0.0.1", 0))
+    dead_port = closed.getsockname()[1]
+    closed.close()
+    with socket.create_connection(("127.0.0.1", proxy.port), timeout=5) as client:
+        client.sendall(f"CONNECT 127.0.0.1:{dead_port} HTTP/1.1\r\n\r\n".encode())
+        assert recv_until(client, b"\r\n\r\n").startswith(b"HTTP/1.1 502")
+
+    port = start_echo_server()
+    before = proxy.stats.idle_timeouts
+    with socket.create_connection(("127.0.0.1", proxy.port), timeout=5) as client:
+        client.sendall(f"CONNECT 127.0.0.1:{port} HTTP/1.1\r\n\r\n".encode())
+        recv_until(client, b"\r\n\r\n")
+        start = time.monotonic()
+        assert client.recv(10) == b""
+        assert time.monotonic() - start < 3
+    assert proxy.stats.idle_timeouts == before + 1
+
+
+def test_private_targets_are_blocked():
+    engine = AsyncTcpProxy("127.0.0.1", 0, connect_timeout=2, block_private=True)
+    engine.start()
+    try:
+        for request in (b"CONNECT 127.0.0.1:443 HTTP/1.1\r\n\r\n",
+                        b"GET http://localhost/ HTTP/1.1\r\nHost: localhost\r\n\r\n"):
+            with socket.create_connection(("127.0.0.1", engine.port), timeout=5) as client:
+                client.sendall(request)
+                assert recv_until(client, b"\r\n\r\n").startswith(b"HTTP/1.1 403")
+        assert engine.stats.blocked == 2
+    finally:
+        engine.stop()
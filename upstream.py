@@ -0,0 +1,406 @@
+# upstream.py - shared pooled HTTP client for all upstream fetches
+#
+# Every proxy route used to call the module-level requests.get(), which builds
+# a throwaway Session per call and therefore a new TCP + TLS handshake for every
+# page and every sub-resource.  This module keeps one process-wide client with
+# per-host keep-alive pools, TLS session resumption for new connections, idle
+# connection eviction and hit/miss counters.  New connections resolve through
+# dns_cache and connect to exactly the addresses it returned (and, with
+# block_private, validated).
+import http.client
+import io
+import logging
+import os
+import socket
+import ssl
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NameResolutionError, NewConnectionError
+
+import dns_cache
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_HOSTS = 100        # distinct upstream hosts kept warm
+DEFAULT_POOL_MAXSIZE = 32       # keep-alive sockets per host
+DEFAULT_IDLE_TIMEOUT = 60.0     # seconds before an idle socket is dropped
+
+
+# ────────────────────────────────────────────────
+# Counters
+# ────────────────────────────────────────────────
+class UpstreamStats:
+    """Connection reuse counters shared by every pool of one client."""
+
+    FIELDS = ("requests", "pool_hits", "pool_misses", "idle_evictions",
+              "tls_handshakes", "tls_resumed")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(self.FIELDS, 0)
+
+    def incr(self, field: str, n: int = 1):
+        with self._lock:
+            self._counts[field] += n
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+        checkouts = counts["pool_hits"] + counts["pool_misses"]
+        counts["pool_hit_ratio"] = round(counts["pool_hits"] / checkouts, 4) if checkouts else 0.0
+        return counts
+
+
+UPSTREAM_SECONDS = metrics.histogram(
+    "reidproxy_upstream_seconds",
+    "Upstream fetch phases: connect (TCP + TLS), ttfb (request sent to response headers, "
+    "excluding connect) and total (request sent to the last body byte).",
+    ("phase",), (("connect", "ttfb", "total"),))
+UPSTREAM_BYTES = metrics.counter(
+    "reidproxy_upstream_received_bytes_total",
+    "Bytes read from upstream sockets: status line, headers and body as sent (after TLS, before decoding).")
+
+
+# ────────────────────────────────────────────────
+# TLS session resumption
+# ────────────────────────────────────────────────
+class _ResumingSSLContext(ssl.SSLContext):
+    """SSLContext that offers the last TLS session seen for a host on new sockets.
+
+    urllib3 only ever calls wrap_socket(sock, server_hostname=...), so this is
+    the one place where a cached session can be injected.  TLS 1.3 tickets
+    arrive after the handshake, so sessions are captured again whenever a
+    socket goes back to its pool, and the last live socket per host is kept
+    (weakly) so its newest session can be read when the next one is opened.
+    """
+
+    def setup_resumption(self, stats: UpstreamStats, max_hosts: int):
+        self._stats = stats
+        self._max_hosts = max_hosts
+        self._sessions = OrderedDict()
+        self._live = {}
+        self._session_lock = threading.Lock()
+
+    def _session_for(self, host):
+        with self._session_lock:
+            ref = self._live.get(host)
+            live = ref() if ref is not None else None
+            if live is not None:
+                try:
+                    session = live.session
+                except (OSError, ValueError):
+                    session = None
+                if session is not None and session.has_ticket:
+                    self._sessions[host] = session
+            session = self._sessions.get(host)
+            if session is not None:
+                self._sessions.move_to_end(host)
+            return session
+
+    def remember(self, host, sock):
+        with self._session_lock:
+            self._live[host] = weakref.ref(sock)
+            session = sock.session
+            if session is not None and session.has_ticket:
+                self._sessions[host] = session
+                self._sessions.move_to_end(host)
+            while len(self._sessions) > self._max_hosts:
+                stale, _ = self._sessions.popitem(last=False)
+                self._live.pop(stale, None)
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None and server_hostname:
+            session = self._session_for(server_hostname)
+        try:
+            wrapped = super().wrap_socket(
+                sock, *args, server_hostname=server_hostname, session=session, **kwargs
+            )
+        except ValueError:
+            # Session belongs to a context/protocol that no longer applies; fall back
+            wrapped = super().wrap_socket(sock, *args, server_hostname=server_hostname, **kwargs)
+        self._stats.incr("tls_handshakes")
+        if wrapped.session_reused:
+            self._stats.incr("tls_resumed")
+        if server_hostname:
+            self.remember(server_hostname, wrapped)
+        return wrapped
+
+
+def _build_ssl_context(stats: UpstreamStats, max_hosts: int) -> ssl.SSLContext:
+    ctx = _ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.check_hostname = True
+    ctx.verify_mode = ssl.CERT_REQUIRED
+    ctx.load_default_certs()
+    ctx.setup_resumption(stats, max_hosts)
+    return ctx
+
+
+# ────────────────────────────────────────────────
+# Connections through the DNS cache
+# ────────────────────────────────────────────────
+class _CountingReader(io.RawIOBase):
+    """The socket reader under http.client's buffer, counting into UPSTREAM_BYTES.
+
+    Counted as the bytes arrive: urllib3 hands the connection back before it
+    has added the last read to response.tell(), and never does for chunked bodies.
+    """
+
+    def __init__(self, raw):
+        self._raw = raw
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._raw.readinto(b)
+        if n:
+            UPSTREAM_BYTES.inc(amount=n)
+        return n
+
+    def fileno(self):
+        return self._raw.fileno()
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super().close()
+
+
+class _CountedHTTPResponse(http.client.HTTPResponse):
+    def __init__(self, sock, *args, **kwargs):
+        super().__init__(sock, *args, **kwargs)
+        self.fp = io.BufferedReader(_CountingReader(self.fp.detach()))
+
+
+class _ResolvedConnectionMixin:
+    """Connects to the addresses dns_cache resolved (and checked) for the host.
+
+    urllib3 only uses _dns_host as the connect() target; the TLS server name
+    and Host header come from self.host, which is restored before returning.
+    """
+
+    response_class = _CountedHTTPResponse
+
+    def __init__(self, *args, resolver=None, block_private=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._resolver = resolver
+        self._block_private = block_private
+        self._upstream_connect_seconds = 0.0
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        self._upstream_connect_seconds = time.perf_counter() - start
+        UPSTREAM_SECONDS.observe(self._upstream_connect_seconds, "connect")
+
+    def _new_conn(self):
+        if self._resolver is None:
+            return super()._new_conn()
+        try:
+            addresses = self._resolver.resolve(self._dns_host, check=self._block_private)
+        except dns_cache.BlockedAddressError as e:
+            raise NewConnectionError(self, f"Blocked: {e}") from e
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+
+        dns_host = self._dns_host
+        error = NewConnectionError(self, f"No addresses for {self.host}")
+        try:
+            for address in addresses:
+                self._dns_host = address
+                try:
+                    return super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError) as e:
+                    error = e
+        finally:
+            self._dns_host = dns_host
+        raise error
+
+
+class _ResolvedHTTPConnection(_ResolvedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _ResolvedHTTPSConnection(_ResolvedConnectionMixin, HTTPSConnection):
+    pass
+
+
+# ────────────────────────────────────────────────
+# Connection pools with idle eviction + counters
+# ────────────────────────────────────────────────
+class _TrackedPoolMixin:
+    """Stamps sockets on release and closes ones idle longer than idle_timeout.
+
+    Also times each exchange: ttfb when the response headers arrive and total
+    when the body has been read and the connection comes back (release_conn).
+    """
+
+    def __init__(self, *args, upstream_stats=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._upstream_stats = upstream_stats
+        self._idle_timeout = idle_timeout
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        connected = getattr(conn, "sock", None) is not None
+        last_used = getattr(conn, "_upstream_last_used", None)
+        if connected and last_used is not None and time.monotonic() - last_used > self._idle_timeout:
+            conn.close()
+            connected = False
+            self._upstream_stats.incr("idle_evictions")
+        self._upstream_stats.incr("pool_hits" if connected else "pool_misses")
+        return conn
+
+    def _make_request(self, conn, *args, **kwargs):
+        conn._upstream_connect_seconds = 0.0
+        start = time.perf_counter()
+        response = super()._make_request(conn, *args, **kwargs)
+        UPSTREAM_SECONDS.observe(time.perf_counter() - start - conn._upstream_connect_seconds, "ttfb")
+        conn._upstream_exchange_start = start
+        return response
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            start = getattr(conn, "_upstream_exchange_start", None)
+            if start is not None:
+                conn._upstream_exchange_start = None
+                UPSTREAM_SECONDS.observe(time.perf_counter() - start, "total")
+            conn._upstream_last_used = time.monotonic()
+            # By now the response has been read, so any TLS 1.3 ticket has arrived
+            sock = getattr(conn, "sock", None)
+            if isinstance(sock, ssl.SSLSocket) and isinstance(sock.context, _ResumingSSLContext):
+                sock.context.remember(sock.server_hostname, sock)
+        super()._put_conn(conn)
+
+
+class _TrackedHTTPConnectionPool(_TrackedPoolMixin, HTTPConnectionPool):
+    ConnectionCls = _ResolvedHTTPConnection
+
+
+class _TrackedHTTPSConnectionPool(_TrackedPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = _ResolvedHTTPSConnection
+
+
+class _PooledAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter whose pool managers build tracked pools."""
+
+    def __init__(self, stats, idle_timeout, ssl_context, resolver=None, block_private=False, **kwargs):
+        self._stats = stats
+        self._idle_timeout = idle_timeout
+        self._ssl_context = ssl_context
+        self._resolver = resolver
+        self._block_private = block_private
+        super().__init__(**kwargs)
+
+    def _install_pool_classes(self, manager, block_private):
+        def factory(pool_cls):
+            def build(host, port=None, **kw):
+                return pool_cls(host, port, upstream_stats=self._stats,
+                                idle_timeout=self._idle_timeout, resolver=self._resolver,
+                                block_private=block_private, **kw)
+            return build
+        manager.pool_classes_by_scheme = {
+            "http": factory(_TrackedHTTPConnectionPool),
+            "https": factory(_TrackedHTTPSConnectionPool),
+        }
+        return manager
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault("ssl_context", self._ssl_context)
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self._install_pool_classes(self.poolmanager, self._block_private)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        fresh = proxy not in self.proxy_manager
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if fresh:
+            # Connections go to the configured proxy itself, which is often local
+            self._install_pool_classes(manager, block_private=False)
+        return manager
+
+
+# ────────────────────────────────────────────────
+# Client
+# ────────────────────────────────────────────────
+class UpstreamClient:
+    """Thread-safe pooled HTTP client used by every proxy route.
+
+    The underlying Session never stores cookies: it is shared by all visitors,
+    so upstream Set-Cookie headers must not leak from one user to the next.
+    With block_private, direct connections to names resolving to internal
+    addresses fail with a ConnectionError.
+    """
+
+    def __init__(self, pool_hosts=DEFAULT_POOL_HOSTS, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, block_private=False):
+        self.pool_hosts = pool_hosts
+        self.pool_maxsize = pool_maxsize
+        self.idle_timeout = idle_timeout
+        self.block_private = block_private
+        self.stats = UpstreamStats()
+
+        ssl_context = _build_ssl_context(self.stats, pool_hosts)
+        self.session = requests.Session()
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        for scheme in ("http://", "https://"):
+            self.session.mount(scheme, _PooledAdapter(
+                self.stats, idle_timeout, ssl_context,
+                resolver=dns_cache.get_resolver(), block_private=block_private,
+                pool_connections=pool_hosts,
+                pool_maxsize=pool_maxsize,
+            ))
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        self.stats.incr("requests")
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("allow_redirects", True)
+        return self.request("GET", url, **kwargs)
+
+    def snapshot(self) -> dict:
+        info = self.stats.snapshot()
+        info.update(pool_hosts=self.pool_hosts, pool_maxsize=self.pool_maxsize,
+                    idle_timeout=self.idle_timeout, block_private=self.block_private)
+        return info
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_pid = None
+_client_settings = {}
+_client_lock = threading.Lock()
+
+
+def configure(**settings):
+    """Set pool options for the process-wide client (call before first use)."""
+    global _client
+    with _client_lock:
+        _client_settings.update(settings)
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def get_client() -> UpstreamClient:
+    """Return the process-wide client, rebuilding it after a fork (gunicorn workers)."""
+    global _client, _client_pid
+    client = _client
+    if client is not None and _client_pid == os.getpid():
+        return client
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = UpstreamClient(**_client_settings)
+            _client_pid = os.getpid()
+            logger.info(f"Upstream client ready: {_client_settings or 'defaults'}")
+        return _client